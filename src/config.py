@@ -21,7 +21,9 @@ class Config:
         # training
         self.device = torch.device(args.device)
         self.num_epochs = args.num_epochs
-        self.fp16 = args.fp16
+        ## `--fp16 1` is kept as an alias of `--precision fp16`
+        self.precision = "fp16" if args.fp16 else args.precision
+        self.fp16 = int(self.precision == "fp16")
 
         # model
         self.model_folder = args.model_folder
@@ -29,6 +31,48 @@ class Config:
         self.bert_folder = args.bert_folder
         self.height = args.height
         self.var_update_mode = args.var_update_mode
+        self.factorized_projection = bool(args.factorized_projection)
+        self.fused_operators = bool(args.fused_operators)
+        self.constant_pair_cache = bool(args.constant_pair_cache)
+        self.eval_early_exit = bool(args.eval_early_exit)
+        self.train_compaction = bool(args.train_compaction)
+        self.height_parallel = bool(args.height_parallel)
+        self.incremental_scoring = bool(args.incremental_scoring)
+        self.star_attention = bool(args.star_attention)
+        self.pair_chunk_size = args.pair_chunk_size
+        self.activation_checkpointing = bool(args.activation_checkpointing)
+        self.pair_top_k = args.pair_top_k
+        self.sampled_negatives = args.sampled_negatives
+        self.negative_source = args.negative_source
+        self.exit_layers = args.exit_layers
+        self.adaptive_exit = bool(args.adaptive_exit)
+        self.exit_thresholds = args.exit_thresholds
+        self.exit_agreement = args.exit_agreement
+        self.full_scoring_interval = args.full_scoring_interval
+        self.frozen_encoder_cache = bool(args.frozen_encoder_cache)
+        self.encoder_cache_dir = args.encoder_cache_dir
+        self.static_inference = bool(args.static_inference)
+        self.static_compile = bool(args.static_compile)
+        self.static_seq_len_buckets = args.static_seq_len_buckets
+        self.static_num_variable_buckets = args.static_num_variable_buckets
+        self.static_height_buckets = args.static_height_buckets
+        self.quantize = bool(args.quantize)
+        self.low_rank = args.low_rank
+        self.low_rank_finetune_epochs = args.low_rank_finetune_epochs
+        self.pair_recall_ks = args.pair_recall_ks
+        self.beam_size = args.beam_size
+        self.lora_rank = args.lora_rank
+        self.lora_alpha = args.lora_alpha
+        self.lora_dropout = args.lora_dropout
+        self.teacher_folder = args.teacher_folder
+        self.student_num_layers = args.student_num_layers
+        self.student_hidden_size = args.student_hidden_size
+        self.student_num_attention_heads = args.student_num_attention_heads
+        self.student_intermediate_size = args.student_intermediate_size
+        self.distill_temperature = args.distill_temperature
+        self.distill_gold_weight = args.distill_gold_weight
+        self.distill_logits_weight = args.distill_logits_weight
+        self.distill_hidden_weight = args.distill_hidden_weight
 
 
         self.train_file = args.train_file
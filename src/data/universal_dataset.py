@@ -12,28 +12,64 @@ import collections
 import re
 from src.eval.utils import compute_value_for_incremental_equations
 import math
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from collections import Counter
 import logging
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-## "<quant>" token will be split into different subwords in different tokenizers
-class_name_2_quant_list = {
-    "bert-base-cased": ['<', 'q', '##uant', '>'],
-    "roberta-base": ['Ġ<', 'quant', '>'],
-    "coref-roberta-base": ['Ġ<', 'quant', '>'],
-    "roberta-large": ['Ġ<', 'quant', '>'],
-    "bert-base-multilingual-cased": ['<', 'quant', '>'],
-    "xlm-roberta-base": ['▁<', 'quant', '>'],
-    'bert-base-chinese': ['<', 'q', '##uan', '##t', '>'],
-    'hfl/chinese-bert-wwm-ext': ['<', 'q', '##uan', '##t', '>'],
-    'hfl/chinese-roberta-wwm-ext': ['<', 'q', '##uan', '##t', '>'],
-}
-
-UniFeature = collections.namedtuple('UniFeature', 'input_ids attention_mask token_type_ids variable_indexs_start variable_indexs_end num_variables variable_index_mask labels label_height_mask')
-UniFeature.__new__.__defaults__ = (None,) * 7
+## the variables (temp_a ... temp_z) are replaced with "<quant>", which is split into different subwords in different tokenizers,
+## so the variable positions are found from the character offsets of the tokens
+QUANT = "<quant>"
+VARIABLE_PATTERN = re.compile(r"temp_[a-z]")
+
+
+def get_input_text(text: str, file: str) -> str:
+    """
+    Replace the variables with <quant> and obtain the text string of the tokenizer input.
+    """
+    mapped_text = VARIABLE_PATTERN.sub(f" {QUANT} ", text)
+    if "math23k" in file:
+        ## the words are joined without spaces, except around the quantities and after the commas
+        words = []
+        for word in mapped_text.split():
+            if word == QUANT:
+                words.append(f" {QUANT} ")
+            elif word == "," or word == "，":
+                words.append(word + " ")
+            else:
+                words.append(word)
+        return "".join(words)
+    elif "MathQA" in file or "mawps" in file or "svamp" in file:
+        return ' '.join(mapped_text.split())
+    else:
+        raise NotImplementedError("The file type is not supported")
+
+
+def get_quant_token_spans(text: str, offsets: List[Tuple[int, int]]) -> Tuple[List[int], List[int]]:
+    """
+    :param text: the tokenizer input
+    :param offsets: the character offsets of the tokens (`return_offsets_mapping`), (0, 0) for the special tokens
+    :return: var_starts, var_ends: the first and the last token of each "<quant>" in the text
+    """
+    var_starts = []
+    var_ends = []
+    k = 0
+    for match in re.finditer(re.escape(QUANT), text):
+        char_start, char_end = match.span()
+        while k < len(offsets) and (offsets[k][0] == offsets[k][1] or offsets[k][1] <= char_start):
+            k += 1
+        var_starts.append(k)
+        while k + 1 < len(offsets) and offsets[k + 1][0] != offsets[k + 1][1] and offsets[k + 1][0] < char_end:
+            k += 1
+        var_ends.append(k)
+    return var_starts, var_ends
+
+
+## instance_id: the index of the feature in the dataset (e.g., the row of the encoder output cache)
+UniFeature = collections.namedtuple('UniFeature', 'input_ids attention_mask token_type_ids variable_indexs_start variable_indexs_end num_variables variable_index_mask labels label_height_mask instance_id')
+UniFeature.__new__.__defaults__ = (None,) * 8
 
 class UniversalDataset(Dataset):
 
@@ -52,7 +88,6 @@ class UniversalDataset(Dataset):
         self.constant_num = len(self.constant2id) if self.constant2id else 0
         self.data_max_height = data_max_height
         self.uni_labels = uni_labels
-        self.quant_list = class_name_2_quant_list[pretrained_model_name]
         filtered_steps = [int(v) for v in filtered_steps] if filtered_steps is not None else None
         self.read_math23k_file(file, tokenizer, number, filtered_steps)
 
@@ -77,40 +112,14 @@ class UniversalDataset(Dataset):
         filter_type_count = Counter()
         found_duplication_inst_num = 0
         filter_step_count = 0
-        for obj in tqdm(data, desc='Tokenization', total=len(data)):
-            mapped_text = obj["text"]
-            sent_len = len(mapped_text.split())
-            ## replace the variable with <quant>
-            for k in range(ord('a'), ord('a') + 26):
-                mapped_text = mapped_text.replace(f"temp_{chr(k)}", " <quant> ")
-            ## obtain the text string
-            if "math23k" in file:
-                mapped_text = mapped_text.split()
-                input_text = ""
-                for idx, word in enumerate(mapped_text):
-                    if word.strip() == "<quant>":
-                        input_text += " <quant> "
-                    elif word == "," or word == "，":
-                        input_text += word + " "
-                    else:
-                        input_text += word
-            elif "MathQA" in file or "mawps" in file or "svamp" in file:
-                input_text = ' '.join(mapped_text.split())
-            else:
-                raise NotImplementedError("The file type is not supported")
-            res = tokenizer.encode_plus(" " + input_text, add_special_tokens=True, return_attention_mask=True)
-            input_ids = res["input_ids"]
-            attention_mask = res["attention_mask"]
-            tokens = tokenizer.convert_ids_to_tokens(input_ids)
-            var_starts = []
-            var_ends = []
-            quant_num = len(self.quant_list)
-            # quants = ['<', 'q', '##uan', '##t', '>'] if not is_roberta_tokenizer else ['Ġ<', 'quant', '>']
-            # obtain the start and end position of "<quant>" token
-            for k, token in enumerate(tokens):
-                if (token == self.quant_list[0]) and tokens[k:k + quant_num] == self.quant_list:
-                    var_starts.append(k)
-                    var_ends.append(k + quant_num - 1)
+        ## the whole file in one batched call of the fast tokenizer
+        input_texts = [" " + get_input_text(obj["text"], file) for obj in data]
+        encodings = tokenizer(input_texts, add_special_tokens=True, return_attention_mask=True, return_offsets_mapping=True)
+        for inst_idx, obj in tqdm(enumerate(data), desc='Reading instances', total=len(data)):
+            sent_len = len(obj["text"].split())
+            input_ids = encodings["input_ids"][inst_idx]
+            attention_mask = encodings["attention_mask"][inst_idx]
+            var_starts, var_ends = get_quant_token_spans(input_texts[inst_idx], encodings["offset_mapping"][inst_idx])
 
             assert len(input_ids) < 512 ## make sure no error in tokenization
             num_variable = len(var_starts)
@@ -204,7 +213,8 @@ class UniversalDataset(Dataset):
                            num_variables=num_variable,
                            variable_index_mask=var_mask,
                            labels = labels,
-                           label_height_mask=label_height_mask)
+                           label_height_mask=label_height_mask,
+                           instance_id=len(self._features))
             )
             self.insts.append(obj)
         logger.info(f", total number instances: {len(self._features)} (before filter: {len(data)}), max num steps: {max_num_steps}")
@@ -348,7 +358,8 @@ class UniversalDataset(Dataset):
                                  num_variables=np.asarray(feature.num_variables),
                                  variable_index_mask=np.asarray(variable_index_mask),
                                  labels =np.asarray(labels),
-                                  label_height_mask=np.asarray(label_height_mask))
+                                  label_height_mask=np.asarray(label_height_mask),
+                                  instance_id=np.asarray(feature.instance_id))
         results = UniFeature(*(default_collate(samples) for samples in zip(*batch)))
         return results
 
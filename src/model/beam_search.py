@@ -0,0 +1,96 @@
+"""
+Beam search over the deductive steps.
+The encoder runs once per problem, then the variable states are expanded to `beam_size` rows per problem and the beams
+of all the problems are scored as one batch by the pair scoring and variable update of `deductive_forward`.
+A derivation is scored by the sum over its steps of the log-softmax of the step logits over all (pair, label, stop) of the height,
+so the score of a beam can only decrease and a problem is finished as soon as its `beam_size` best finished derivations
+are better than all its live beams. The finished problems are dropped from the batch.
+As in the usual beam search, a derivation only finishes (with the stop label) if its candidate is among the `beam_size` best
+candidates of the height, so a stop candidate that the greedy decoding would not take does not end the search with a
+shorter (better-scored) derivation: with `beam_size` 1, the beam search is the greedy decoding.
+"""
+
+import torch
+import torch.nn as nn
+from typing import List, Tuple
+from src.model.pair_index import get_batched_combination_mask, get_combination
+from src.model.static_inference import encode_variables
+from src.model.universal_model import score_pairs, update_var_hidden_states
+
+
+def beam_search(cls, encoder: nn.Module, input_ids: torch.Tensor, attention_mask: torch.Tensor, token_type_ids: torch.Tensor,
+                variable_indexs_start: torch.Tensor, variable_indexs_end: torch.Tensor, num_variables: torch.Tensor,
+                beam_size: int, max_height: int = None) -> List[List[Tuple[float, List[List[int]]]]]:
+    """
+    :return: the n-best derivations of each problem, best first: [(score, [[left_var_index, right_var_index, label_index, stop_id], ...]), ...],
+             a derivation ends with the stop label, or has max_height steps
+    """
+    max_height = max_height if max_height is not None else cls.max_height
+    device = input_ids.device
+    batch_size = input_ids.size(0)
+    var_hidden_states = encode_variables(cls, encoder, input_ids, attention_mask, token_type_ids, variable_indexs_start, variable_indexs_end)
+    _, max_num_variable, hidden_size = var_hidden_states.size()
+    num_variables = num_variables + cls.constant_num
+    ## batch_size * beam_size rows, only the first beam of each problem is live at the start
+    var_hidden_states = var_hidden_states.repeat_interleave(beam_size, dim=0)
+    beam_scores = torch.full((batch_size, beam_size), float("-inf"), device=device)
+    beam_scores[:, 0] = 0
+    histories = torch.zeros((batch_size, beam_size, 0, 4), dtype=torch.long, device=device)
+    active_problems = list(range(batch_size))
+    finished = [[] for _ in range(batch_size)]
+    best_label_rep = None
+    for i in range(max_height):
+        num_active = len(active_problems)
+        if i > 0:
+            var_hidden_states = update_var_hidden_states(cls, var_hidden_states, best_label_rep)
+        combination = get_combination(max_num_variable + i, device=device)
+        batched_combination_mask = get_batched_combination_mask(num_variables.repeat_interleave(beam_size) + i, max_num_variable + i)
+        combined_logits, label_rep = score_pairs(cls, var_hidden_states, combination, batched_combination_mask)
+        num_candidates = combined_logits[0].numel()  ## num_combinations * num_labels * 2
+        log_probs = combined_logits.view(num_active * beam_size, num_candidates).float().log_softmax(dim=-1)
+        candidate_scores = (beam_scores.view(-1, 1) + log_probs).view(num_active, beam_size * num_candidates)
+        ## with 2 * beam_size candidates there are at least beam_size live ones unless the problem has fewer candidates
+        top_scores, top_candidates = candidate_scores.topk(min(2 * beam_size, beam_size * num_candidates), dim=-1)
+        top_slots = top_candidates // num_candidates
+        top_combs = top_candidates % num_candidates // (cls.num_labels * 2)
+        top_labels = top_candidates % (cls.num_labels * 2) // 2
+        top_stops = top_candidates % 2
+        top_steps = torch.cat([combination[top_combs], top_labels.unsqueeze(-1), top_stops.unsqueeze(-1)], dim=-1)  ## num_active, 2 * beam_size, 4
+
+        ## a single host sync per height
+        top_scores_list, top_slots_list, top_stops_list = top_scores.tolist(), top_slots.tolist(), top_stops.tolist()
+        histories_list, top_steps_list = histories.tolist(), top_steps.tolist()
+        last_height = i == max_height - 1
+        next_candidates = []  ## (problem row, candidate) of the live beams, beam_size per problem (repeated if fewer)
+        next_scores = []
+        still_active = []
+        for row, problem in enumerate(active_problems):
+            live = []
+            for k, score in enumerate(top_scores_list[row]):
+                if score == float("-inf"):
+                    break
+                if top_stops_list[row][k] == 1 or last_height:
+                    if k < beam_size:
+                        finished[problem].append((score, histories_list[row][top_slots_list[row][k]] + [top_steps_list[row][k]]))
+                elif len(live) < beam_size:
+                    live.append(k)
+            finished[problem] = sorted(finished[problem], key=lambda derivation: -derivation[0])[:beam_size]
+            if last_height or len(live) == 0 or (len(finished[problem]) == beam_size and top_scores_list[row][live[0]] <= finished[problem][-1][0]):
+                continue
+            still_active.append(row)
+            next_candidates.append([row * 2 * beam_size + k for k in live] + [row * 2 * beam_size + live[0]] * (beam_size - len(live)))
+            next_scores.append([top_scores_list[row][k] for k in live] + [float("-inf")] * (beam_size - len(live)))
+        if len(still_active) == 0:
+            break
+        ## the beams of the problems still decoded, gathered from the selected candidates
+        next_candidates = torch.tensor(next_candidates, dtype=torch.long, device=device).view(-1)
+        candidate_rows = next_candidates // (2 * beam_size)
+        source_rows = candidate_rows * beam_size + top_slots.view(-1)[next_candidates]
+        var_hidden_states = var_hidden_states[source_rows]
+        best_label_rep = label_rep[source_rows, top_combs.view(-1)[next_candidates], top_labels.view(-1)[next_candidates]]
+        histories = torch.cat([histories.view(num_active * beam_size, i, 4)[source_rows],
+                               top_steps.view(-1, 4)[next_candidates].unsqueeze(1)], dim=1).view(len(still_active), beam_size, i + 1, 4)
+        beam_scores = torch.tensor(next_scores, device=device)
+        num_variables = num_variables[torch.tensor(still_active, dtype=torch.long, device=device)]
+        active_problems = [active_problems[row] for row in still_active]
+    return finished
@@ -0,0 +1,105 @@
+"""
+Distillation of a trained model (teacher) into a smaller student encoder with its own deductive head.
+The student config is built locally from the teacher config (fewer layers and/or a smaller hidden size), and the student matches
+the per-height teacher-forced logits (`all_logits`) and the encoder hidden states of the teacher.
+"""
+
+import copy
+import torch
+import torch.nn as nn
+from transformers import PretrainedConfig
+from typing import List, Tuple
+
+
+def build_student_config(teacher_config: PretrainedConfig, num_hidden_layers: int, hidden_size: int = 0, num_attention_heads: int = 0,
+                         intermediate_size: int = 0) -> PretrainedConfig:
+    """
+    The teacher config with the student sizes (0: same as the teacher, the intermediate size is 4x the hidden size if the hidden size changes).
+    """
+    student_config = copy.deepcopy(teacher_config)
+    student_config.num_hidden_layers = num_hidden_layers
+    if hidden_size > 0 and hidden_size != teacher_config.hidden_size:
+        student_config.hidden_size = hidden_size
+        student_config.intermediate_size = 4 * hidden_size
+    if num_attention_heads > 0:
+        student_config.num_attention_heads = num_attention_heads
+    if intermediate_size > 0:
+        student_config.intermediate_size = intermediate_size
+    if student_config.hidden_size % student_config.num_attention_heads != 0:
+        raise ValueError(f"The student hidden size ({student_config.hidden_size}) is not a multiple of the number of attention heads "
+                         f"({student_config.num_attention_heads})")
+    return student_config
+
+
+def get_layer_mapping(num_student_layers: int, num_teacher_layers: int) -> List[Tuple[int, int]]:
+    """
+    :return: the (student, teacher) pairs of matched hidden states, as indices into `hidden_states`
+             (0 is the embeddings, the student layers are matched to evenly spaced teacher layers, the last to the last)
+    """
+    return [(0, 0)] + [(j, j * num_teacher_layers // num_student_layers) for j in range(1, num_student_layers + 1)]
+
+
+def init_student_from_teacher(student: nn.Module, teacher: nn.Module) -> List[str]:
+    """
+    If the hidden sizes are the same, copy the teacher weights into the student: the embeddings, the mapped encoder layers
+    and the deductive head (each tensor only if its shape is the same, e.g., not the FFN weights with a smaller intermediate size).
+    Nothing is copied if the hidden sizes differ.
+    :return: the names of the copied student parameters
+    """
+    if student.config.hidden_size != teacher.config.hidden_size:
+        return []
+    layer_mapping = dict(get_layer_mapping(student.config.num_hidden_layers, teacher.config.num_hidden_layers))
+    teacher_state = teacher.state_dict()
+    student_state = student.state_dict()
+    copied = []
+    for name, tensor in student_state.items():
+        teacher_name = name
+        if ".encoder.layer." in name:
+            prefix, rest = name.split(".encoder.layer.", 1)
+            layer_idx, rest = rest.split(".", 1)
+            ## encoder.layer.{j} is the output of hidden_states[j + 1]
+            teacher_name = f"{prefix}.encoder.layer.{layer_mapping[int(layer_idx) + 1] - 1}.{rest}"
+        if teacher_name in teacher_state and teacher_state[teacher_name].size() == tensor.size():
+            student_state[name] = teacher_state[teacher_name].clone()
+            copied.append(name)
+    student.load_state_dict(student_state)
+    return copied
+
+
+def logits_distillation_loss(student_logits: List[torch.Tensor], teacher_logits: List[torch.Tensor], label_height_mask: torch.Tensor,
+                             temperature: float = 1.0) -> torch.Tensor:
+    """
+    KL divergence from the teacher to the student distribution over all (pair, label, stop) of each height.
+    :param student_logits, teacher_logits: the teacher-forced `all_logits`, (batch_size, num_combinations, num_labels, 2) per height, -inf for invalid pairs
+    :param label_height_mask: (batch_size, height) the heights of the gold steps
+    """
+    loss = 0
+    for i, (student_height_logits, teacher_height_logits) in enumerate(zip(student_logits, teacher_logits)):
+        batch_size = student_height_logits.size(0)
+        student_log_probs = (student_height_logits.view(batch_size, -1).float() / temperature).log_softmax(dim=-1)
+        teacher_log_probs = (teacher_height_logits.view(batch_size, -1).float() / temperature).log_softmax(dim=-1)
+        ## the invalid pairs (-inf in both) do not contribute
+        valid = torch.isfinite(teacher_log_probs) & torch.isfinite(student_log_probs)
+        student_log_probs = student_log_probs.masked_fill(~valid, 0)
+        teacher_log_probs = teacher_log_probs.masked_fill(~valid, 0)
+        kl = (teacher_log_probs.exp() * (teacher_log_probs - student_log_probs)).masked_fill(~valid, 0).sum(dim=-1)  ## batch_size
+        loss = loss + (kl * label_height_mask[:, i]).sum() * temperature ** 2
+    return loss
+
+
+def hidden_distillation_loss(student_hidden_states: Tuple[torch.Tensor], teacher_hidden_states: Tuple[torch.Tensor], attention_mask: torch.Tensor,
+                             hidden_projection: nn.Module = None) -> torch.Tensor:
+    """
+    Mean squared error between the mapped student and teacher hidden states (`get_layer_mapping`) over the non-padded tokens.
+    :param hidden_projection: the projection of the student hidden states into the teacher hidden size, if they differ
+    """
+    token_mask = attention_mask.unsqueeze(-1).float()  ## batch_size, sent_len, 1
+    num_tokens = token_mask.sum()
+    loss = 0
+    for student_idx, teacher_idx in get_layer_mapping(len(student_hidden_states) - 1, len(teacher_hidden_states) - 1):
+        student_hidden = student_hidden_states[student_idx]
+        if hidden_projection is not None:
+            student_hidden = hidden_projection(student_hidden)
+        squared_error = (student_hidden.float() - teacher_hidden_states[teacher_idx].float()) ** 2
+        loss = loss + (squared_error * token_mask).sum() / (num_tokens * squared_error.size(-1))
+    return loss
@@ -0,0 +1,55 @@
+"""
+Calibration of the early exit inside the encoder (`adaptive_exit_forward`).
+An instance exits at an exit layer when the first-step margin of the exit head reaches the threshold of the exit.
+The threshold of each exit is the lowest margin such that the exiting instances agree with the first step of the
+last layer on at least `target_agreement` of a held-out set.
+"""
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from typing import List
+from src.model.universal_model import get_first_step_margin
+from src.utils import get_autocast
+
+
+def select_exit_threshold(margins: torch.Tensor, agreements: torch.Tensor, target_agreement: float) -> float:
+    """
+    :param margins: (num_instances) the first-step margins of the exit head
+    :param agreements: (num_instances) whether the first step of the exit head is the first step of the last layer
+    :return: the lowest margin at which the instances with a larger or equal margin agree on at least `target_agreement`,
+             inf (never exit) if there is none
+    """
+    sorted_margins, order = margins.sort(descending=True)
+    cumulative_agreement = agreements[order].float().cumsum(dim=0) / torch.arange(1, margins.size(0) + 1, device=margins.device)
+    ## the instances tied with the threshold also exit
+    valid = (cumulative_agreement >= target_agreement) & torch.cat([sorted_margins[1:] < sorted_margins[:-1], sorted_margins.new_ones(1, dtype=torch.bool)])
+    if not valid.any():
+        return float("inf")
+    return sorted_margins[valid.nonzero()[-1, 0]].item()
+
+
+def calibrate_exit_thresholds(model: nn.Module, dataloader: DataLoader, dev: torch.device, precision: str = "fp32",
+                              target_agreement: float = 0.99) -> List[float]:
+    """
+    :return: the threshold of each exit of `model.exit_layers`
+    """
+    model.eval()
+    encoder = model.base_model
+    margins = [[] for _ in model.exit_layers]
+    agreements = [[] for _ in model.exit_layers]
+    with torch.no_grad():
+        for feature in tqdm(dataloader, desc="--exit calibration", total=len(dataloader)):
+            with get_autocast(precision, dev):
+                variable_indexs_start, variable_indexs_end = feature.variable_indexs_start.to(dev), feature.variable_indexs_end.to(dev)
+                num_variables = feature.num_variables.to(dev)
+                outputs = encoder(feature.input_ids.to(dev), attention_mask=feature.attention_mask.to(dev), token_type_ids=feature.token_type_ids.to(dev),
+                                  output_hidden_states=True, return_dict=True)
+                _, last_best = get_first_step_margin(model, outputs.last_hidden_state, variable_indexs_start, variable_indexs_end, num_variables)
+                for k, (exit_layer, exit_adapter) in enumerate(zip(model.exit_layers, model.exit_adapters)):
+                    margin, best = get_first_step_margin(model, exit_adapter(outputs.hidden_states[exit_layer]), variable_indexs_start,
+                                                         variable_indexs_end, num_variables)
+                    margins[k].append(margin.float().cpu())
+                    agreements[k].append((best == last_best).cpu())
+    return [select_exit_threshold(torch.cat(margins[k]), torch.cat(agreements[k]), target_agreement) for k in range(len(model.exit_layers))]
@@ -0,0 +1,95 @@
+"""
+Encoder output cache for training the deductive head with a frozen encoder.
+The variable states (the encoder output at `variable_indexs_start` plus the one at `variable_indexs_end`, without the constants)
+of every instance of a dataset are computed once and stored in a memory-mapped fp16 array (num_instances, max_num_variable, hidden_size)
+on disk, then the training only runs the deductive head on the cached states (`var_hidden_states` of the model forward).
+"""
+
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+from src.utils import get_autocast
+
+
+def freeze_encoder(model: nn.Module):
+    for param in model.base_model.parameters():
+        param.requires_grad = False
+
+
+def get_dataset_fingerprint(dataset: Dataset) -> str:
+    """
+    A hash of the token and variable indices of the instances, to detect a cache built for other data.
+    """
+    md5 = hashlib.md5()
+    for feature in dataset:
+        md5.update(np.asarray(feature.input_ids, dtype=np.int64).tobytes())
+        md5.update(np.asarray(feature.variable_indexs_start + feature.variable_indexs_end, dtype=np.int64).tobytes())
+    return md5.hexdigest()
+
+
+class EncoderOutputCache:
+
+    def __init__(self, cache_file: str):
+        with open(cache_file + ".json", "r", encoding="utf-8") as meta_file:
+            self.meta = json.load(meta_file)
+        self.states = np.memmap(cache_file, dtype=np.float16, mode="r",
+                                shape=(self.meta["num_instances"], self.meta["max_num_variable"], self.meta["hidden_size"]))
+
+    def get(self, instance_ids: torch.Tensor, num_vars: int) -> torch.Tensor:
+        """
+        :param instance_ids: (batch_size) the `instance_id` of the features
+        :param num_vars: the (padded) number of variables of the batch
+        :return: var_hidden_states: (batch_size, num_vars, hidden_size) in fp32
+        """
+        return torch.from_numpy(self.states[instance_ids.numpy(), :num_vars].astype(np.float32))
+
+
+def build_encoder_cache(model: nn.Module, dataset: Dataset, cache_file: str, dev: torch.device, batch_size: int = 32,
+                        precision: str = "fp32", encoder_name: str = "") -> EncoderOutputCache:
+    """
+    Run the encoder over the dataset (in order, without dropout) and write the variable states of each instance to `cache_file`.
+    Unlike `deductive_forward` (where the end states are added if any start differs from its end in the batch), the end states
+    are added per instance.
+    """
+    os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+    max_num_variable = max(feature.num_variables for feature in dataset)
+    hidden_size = model.config.hidden_size
+    states = np.memmap(cache_file, dtype=np.float16, mode="w+", shape=(len(dataset), max_num_variable, hidden_size))
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=0, collate_fn=dataset.collate_function)
+    model.eval()
+    with torch.no_grad():
+        for feature in tqdm(dataloader, desc="--encoder cache", total=len(dataloader)):
+            with get_autocast(precision, dev):
+                last_hidden_state = model.base_model(feature.input_ids.to(dev), attention_mask=feature.attention_mask.to(dev),
+                                                     token_type_ids=feature.token_type_ids.to(dev), return_dict=True).last_hidden_state
+            batch_size, num_vars = feature.variable_indexs_start.size()
+            variable_indexs_start, variable_indexs_end = feature.variable_indexs_start.to(dev), feature.variable_indexs_end.to(dev)
+            var_start_hidden_states = torch.gather(last_hidden_state, 1, variable_indexs_start.unsqueeze(-1).expand(batch_size, num_vars, hidden_size))
+            var_end_hidden_states = torch.gather(last_hidden_state, 1, variable_indexs_end.unsqueeze(-1).expand(batch_size, num_vars, hidden_size))
+            use_end = (variable_indexs_start != variable_indexs_end).any(dim=1).view(batch_size, 1, 1).to(var_end_hidden_states.dtype)
+            var_hidden_states = var_start_hidden_states + use_end * var_end_hidden_states
+            states[feature.instance_id.numpy(), :num_vars] = var_hidden_states.float().cpu().numpy().astype(np.float16)
+    states.flush()
+    meta = {"num_instances": len(dataset), "max_num_variable": max_num_variable, "hidden_size": hidden_size,
+            "encoder_name": encoder_name, "fingerprint": get_dataset_fingerprint(dataset)}
+    with open(cache_file + ".json", "w", encoding="utf-8") as meta_file:
+        json.dump(meta, meta_file)
+    return EncoderOutputCache(cache_file)
+
+
+def load_or_build_encoder_cache(model: nn.Module, dataset: Dataset, cache_file: str, dev: torch.device, batch_size: int = 32,
+                                precision: str = "fp32", encoder_name: str = "") -> EncoderOutputCache:
+    """
+    Reuse the cache in `cache_file` if it was built for the same encoder and data, otherwise build it.
+    """
+    if os.path.exists(cache_file) and os.path.exists(cache_file + ".json"):
+        cache = EncoderOutputCache(cache_file)
+        if (cache.meta["encoder_name"] == encoder_name and cache.meta["hidden_size"] == model.config.hidden_size
+                and cache.meta["num_instances"] == len(dataset) and cache.meta["fingerprint"] == get_dataset_fingerprint(dataset)):
+            return cache
+    return build_encoder_cache(model, dataset, cache_file, dev, batch_size=batch_size, precision=precision, encoder_name=encoder_name)
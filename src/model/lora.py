@@ -0,0 +1,103 @@
+"""
+Low-rank adapters (LoRA) for parameter-efficient fine-tuning of the encoder.
+The `nn.Linear` layers of the encoder (attention query/key/value/output and FFN) are wrapped with a trainable low-rank update
+W + (alpha / rank) * B @ A, the base encoder is frozen and the deductive head stays fully trainable.
+The checkpoint only has the adapters and the deductive head, and the adapters are merged into the base weights when loaded,
+so inference has no overhead.
+"""
+
+import math
+import os
+import torch
+import torch.nn as nn
+from typing import Dict, List
+
+LORA_CHECKPOINT_NAME = "lora_model.bin"
+
+
+class LoRALinear(nn.Module):
+
+    def __init__(self, base: nn.Linear, rank: int, alpha: float = 16.0, dropout: float = 0.0):
+        super().__init__()
+        self.base = base
+        self.rank = rank
+        self.scaling = alpha / rank
+        self.lora_A = nn.Parameter(torch.empty(rank, base.in_features, device=base.weight.device, dtype=base.weight.dtype))
+        ## B = 0: the wrapped layer starts as the base layer
+        self.lora_B = nn.Parameter(torch.zeros(base.out_features, rank, device=base.weight.device, dtype=base.weight.dtype))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.lora_dropout = nn.Dropout(dropout)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.base(x) + (self.lora_dropout(x) @ self.lora_A.t() @ self.lora_B.t()) * self.scaling
+
+    def merge(self) -> nn.Linear:
+        """
+        :return: the base layer with the low-rank update added to its weight
+        """
+        with torch.no_grad():
+            self.base.weight += (self.lora_B @ self.lora_A) * self.scaling
+        return self.base
+
+
+def inject_lora(model: nn.Module, rank: int, alpha: float = 16.0, dropout: float = 0.0) -> List[str]:
+    """
+    Wrap every `nn.Linear` of the encoder layers with `LoRALinear` and freeze the encoder (embeddings and pooler included).
+    :return: the names of the wrapped layers
+    """
+    encoder = model.base_model
+    for param in encoder.parameters():
+        param.requires_grad = False
+    wrapped = []
+    for name, module in list(encoder.encoder.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, nn.Linear):
+                setattr(module, child_name, LoRALinear(child, rank, alpha=alpha, dropout=dropout))
+                wrapped.append(f"{name}.{child_name}" if name else child_name)
+    model.lora_config = {"rank": rank, "alpha": alpha, "dropout": dropout}
+    return wrapped
+
+
+def merge_lora(model: nn.Module) -> nn.Module:
+    """
+    Replace every `LoRALinear` with its merged base layer (in place).
+    """
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, LoRALinear):
+                setattr(module, child_name, child.merge())
+    return model
+
+
+def lora_state_dict(model: nn.Module) -> Dict[str, torch.Tensor]:
+    """
+    The adapters and the parameters outside the encoder (deductive head).
+    """
+    encoder_prefix = model.base_model_prefix + "."
+    return {name: tensor for name, tensor in model.state_dict().items() if "lora_" in name or not name.startswith(encoder_prefix)}
+
+
+def save_lora_model(model: nn.Module, folder: str):
+    os.makedirs(folder, exist_ok=True)
+    torch.save({"lora_config": model.lora_config, "state_dict": lora_state_dict(model)}, os.path.join(folder, LORA_CHECKPOINT_NAME))
+
+
+def has_lora_model(folder: str) -> bool:
+    return os.path.exists(os.path.join(folder, LORA_CHECKPOINT_NAME))
+
+
+def load_lora_model(model: nn.Module, folder: str) -> nn.Module:
+    """
+    Load the adapters and the deductive head saved by `save_lora_model` into the base pretrained model, and merge the adapters.
+    """
+    checkpoint = torch.load(os.path.join(folder, LORA_CHECKPOINT_NAME), map_location="cpu")
+    inject_lora(model, **checkpoint["lora_config"])
+    incompatible = model.load_state_dict(checkpoint["state_dict"], strict=False)
+    encoder_prefix = model.base_model_prefix + "."
+    missing = [name for name in incompatible.missing_keys if not name.startswith(encoder_prefix) or "lora_" in name]
+    if len(missing) > 0 or len(incompatible.unexpected_keys) > 0:
+        raise RuntimeError(f"Mismatched LoRA checkpoint in {folder}: missing {missing}, unexpected {incompatible.unexpected_keys}")
+    merge_lora(model)
+    for param in model.parameters():
+        param.requires_grad = True
+    return model
@@ -0,0 +1,98 @@
+"""
+Post-training low-rank compression of the operator layers and the stopper transformation.
+The weight W (out x in) of the first `nn.Linear` of each operator layer (`linears`) and of `stopper_transformation` is replaced by
+its truncated SVD U_r S_r V_r^T, as two linear layers: in -> rank (S_r^1/2 V_r^T) and rank -> out (U_r S_r^1/2, with the bias).
+These layers are applied to every pair at every height, so they cost (in + out) * rank instead of in * out per pair.
+"""
+
+import json
+import os
+import torch
+import torch.nn as nn
+from typing import Dict, List
+
+
+def get_low_rank_checkpoint_name(rank: int) -> str:
+    return f"low_rank_model.r{rank}.bin"
+
+
+class LowRankLinear(nn.Module):
+
+    def __init__(self, in_features: int, out_features: int, rank: int):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.rank = rank
+        self.down = nn.Linear(in_features, rank, bias=False)
+        self.up = nn.Linear(rank, out_features)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.up(self.down(x))
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear, rank: int) -> "LowRankLinear":
+        """
+        The best rank-`rank` approximation (in Frobenius norm) of the linear layer.
+        """
+        weight = linear.weight.detach().float()
+        U, S, Vh = torch.linalg.svd(weight, full_matrices=False)
+        sqrt_S = S[:rank].sqrt()
+        low_rank = cls(linear.in_features, linear.out_features, rank).to(linear.weight.device)
+        with torch.no_grad():
+            low_rank.down.weight.copy_(sqrt_S.unsqueeze(1) * Vh[:rank])
+            low_rank.up.weight.copy_(U[:, :rank] * sqrt_S.unsqueeze(0))
+            low_rank.up.bias.copy_(linear.bias.detach())
+        return low_rank.to(linear.weight.dtype)
+
+
+def compress_model(model: nn.Module, rank: int) -> List[str]:
+    """
+    Replace (in place) the first linear layer of every operator layer and of `stopper_transformation` with its rank-`rank` SVD.
+    The fused operator layers are converted back to the per-label layers first, and the factorized projection
+    (which splits the full weights) is turned off.
+    :return: the names of the compressed layers
+    """
+    if model.fused_operators:
+        model.linears = model.linears.to_per_label()
+        model.fused_operators = False
+    model.factorized_projection = False
+    model._constant_pair_cache = None
+    compressed = []
+    for name, layer in [(f"linears.{i}", operator) for i, operator in enumerate(model.linears)] + [("stopper_transformation", model.stopper_transformation)]:
+        linear = layer[0]
+        if isinstance(linear, nn.Linear) and rank < min(linear.in_features, linear.out_features):
+            layer[0] = LowRankLinear.from_linear(linear, rank)
+            compressed.append(f"{name}.0")
+    return compressed
+
+
+def save_low_rank_model(model: nn.Module, folder: str, rank: int, settings: Dict):
+    """
+    :param settings: what the checkpoint was built from (e.g., the fingerprint of the full weights and the fine-tuning settings),
+                     saved alongside to detect a stale checkpoint
+    """
+    os.makedirs(folder, exist_ok=True)
+    checkpoint_file = os.path.join(folder, get_low_rank_checkpoint_name(rank))
+    torch.save(model.state_dict(), checkpoint_file)
+    with open(checkpoint_file + ".json", "w", encoding="utf-8") as meta_file:
+        json.dump(settings, meta_file)
+
+
+def has_low_rank_model(folder: str, rank: int, settings: Dict) -> bool:
+    """
+    Whether the folder has a low-rank checkpoint of this rank built with the same settings.
+    """
+    checkpoint_file = os.path.join(folder, get_low_rank_checkpoint_name(rank))
+    if not os.path.exists(checkpoint_file) or not os.path.exists(checkpoint_file + ".json"):
+        return False
+    with open(checkpoint_file + ".json", "r", encoding="utf-8") as meta_file:
+        return json.load(meta_file) == settings
+
+
+def load_low_rank_model(model: nn.Module, folder: str, rank: int) -> nn.Module:
+    """
+    Compress the (full) model with the same rank and load the checkpoint saved by `save_low_rank_model`.
+    """
+    compress_model(model, rank)
+    model.load_state_dict(torch.load(os.path.join(folder, get_low_rank_checkpoint_name(rank)), map_location="cpu"))
+    return model
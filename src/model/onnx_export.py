@@ -0,0 +1,128 @@
+"""
+ONNX export of the `UniversalModel` family for onnxruntime inference.
+The model is exported as three graphs, with dynamic batch size, sequence length and number of variables:
+    encoder.onnx: token inputs -> initial variable states (constants first)
+    score.onnx:   variable states, pairs, number of valid variables -> best (pair, label, stop) and its label representation
+    update.onnx:  variable states, best label representation -> variable states of the next height
+and `OnnxDeductiveRunner` runs the height loop over them with numpy only.
+"""
+
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+from typing import Dict
+from src.model.static_inference import encode_variables, score_height
+from src.model.universal_model import update_var_hidden_states
+
+
+class VariableEncoderGraph(nn.Module):
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids, variable_indexs_start, variable_indexs_end):
+        return encode_variables(self.model, self.model.base_model, input_ids, attention_mask, token_type_ids, variable_indexs_start, variable_indexs_end)
+
+
+class HeightScoreGraph(nn.Module):
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, var_hidden_states, combination, num_variables):
+        return score_height(self.model, var_hidden_states, combination, num_variables)
+
+
+class VariableUpdateGraph(nn.Module):
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, var_hidden_states, best_mi_label_rep):
+        return update_var_hidden_states(self.model, var_hidden_states, best_mi_label_rep)
+
+
+def export_onnx(model: nn.Module, output_folder: str, opset_version: int = 18):
+    """
+    Export the three graphs of the model into `output_folder`.
+    """
+    model.eval()
+    os.makedirs(output_folder, exist_ok=True)
+    device = next(model.parameters()).device
+    hidden_size = model.config.hidden_size
+    batch_size, sent_len, num_vars = 2, 8, 3
+    input_ids = torch.randint(1, model.config.vocab_size, (batch_size, sent_len), device=device)
+    variable_indexs_start = torch.tensor([[1, 3, 5]] * batch_size, dtype=torch.long, device=device)
+    var_hidden_states = torch.randn(batch_size, num_vars, hidden_size, device=device)
+    combination = torch.combinations(torch.arange(num_vars, device=device), r=2, with_replacement=True)
+    ## the example inputs must be distinct tensors, the exporter merges aliased inputs
+    batch, seq, vars = torch.export.Dim("batch"), torch.export.Dim("seq"), torch.export.Dim("vars")
+    ## (graph, example inputs, input names, output names, dynamic shapes of the inputs)
+    graphs = {
+        "encoder": (VariableEncoderGraph(model), (input_ids, torch.ones_like(input_ids), torch.zeros_like(input_ids), variable_indexs_start, variable_indexs_start + 1),
+                    ["input_ids", "attention_mask", "token_type_ids", "variable_indexs_start", "variable_indexs_end"], ["var_hidden_states"],
+                    ({0: batch, 1: seq}, {0: batch, 1: seq}, {0: batch, 1: seq}, {0: batch, 1: vars}, {0: batch, 1: vars})),
+        "score": (HeightScoreGraph(model), (var_hidden_states, combination, torch.full((batch_size,), num_vars, dtype=torch.long, device=device)),
+                  ["var_hidden_states", "combination", "num_variables"], ["best_comb", "best_label", "best_stop", "best_label_rep"],
+                  ({0: batch, 1: vars}, {0: torch.export.Dim("pairs")}, {0: batch})),
+        "update": (VariableUpdateGraph(model), (var_hidden_states, torch.randn(batch_size, hidden_size, device=device)),
+                   ["var_hidden_states", "best_label_rep"], ["updated_var_hidden_states"],
+                   ({0: batch, 1: vars}, {0: batch})),
+    }
+    with torch.no_grad():
+        for name, (graph, args, input_names, output_names, dynamic_shapes) in graphs.items():
+            torch.onnx.export(graph, args, os.path.join(output_folder, f"{name}.onnx"), input_names=input_names, output_names=output_names,
+                              dynamic_shapes=dynamic_shapes, opset_version=opset_version, dynamo=True)
+
+
+class OnnxDeductiveRunner:
+    """
+    The deductive inference loop over the exported graphs (onnxruntime, CPU by default).
+    """
+
+    def __init__(self, onnx_folder: str, max_height: int, providers=("CPUExecutionProvider",)):
+        import onnxruntime
+        self.max_height = max_height
+        self.sessions = {name: onnxruntime.InferenceSession(os.path.join(onnx_folder, f"{name}.onnx"), providers=list(providers))
+                         for name in ["encoder", "score", "update"]}
+        self._combinations: Dict[int, np.ndarray] = {}
+
+    def get_combination(self, num_vars: int) -> np.ndarray:
+        """
+        Same order as `torch.combinations(..., r=2, with_replacement=True)`.
+        """
+        if num_vars not in self._combinations:
+            self._combinations[num_vars] = np.stack(np.triu_indices(num_vars), axis=-1).astype(np.int64)
+        return self._combinations[num_vars]
+
+    def predict(self, input_ids: np.ndarray, attention_mask: np.ndarray, token_type_ids: np.ndarray,
+                variable_indexs_start: np.ndarray, variable_indexs_end: np.ndarray, num_variables: np.ndarray) -> np.ndarray:
+        """
+        :return: predictions: (batch_size, height, 4) (left_var_index, right_var_index, label_index, stop_id),
+                 the loop stops once every instance has predicted the stop label
+        """
+        var_hidden_states = self.sessions["encoder"].run(None, {"input_ids": input_ids.astype(np.int64), "attention_mask": attention_mask.astype(np.int64),
+                                                                "token_type_ids": token_type_ids.astype(np.int64),
+                                                                "variable_indexs_start": variable_indexs_start.astype(np.int64),
+                                                                "variable_indexs_end": variable_indexs_end.astype(np.int64)})[0]
+        ## the constants are prepended by the encoder graph
+        num_variables = num_variables.astype(np.int64) + (var_hidden_states.shape[1] - variable_indexs_start.shape[1])
+        stopped = np.zeros(input_ids.shape[0], dtype=bool)
+        predictions = []
+        best_label_rep = None
+        for i in range(self.max_height):
+            if i > 0:
+                var_hidden_states = self.sessions["update"].run(None, {"var_hidden_states": var_hidden_states, "best_label_rep": best_label_rep})[0]
+            combination = self.get_combination(var_hidden_states.shape[1])
+            best_comb, best_label, best_stop, best_label_rep = self.sessions["score"].run(None, {"var_hidden_states": var_hidden_states,
+                                                                                                 "combination": combination,
+                                                                                                 "num_variables": num_variables + i})
+            predictions.append(np.concatenate([combination[best_comb], best_label[:, None], best_stop[:, None]], axis=-1))
+            stopped |= best_stop == 1
+            if stopped.all():
+                break
+        return np.stack(predictions, axis=1)
@@ -0,0 +1,127 @@
+import logging
+import re
+import torch
+import torch.nn as nn
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+class FusedOperatorProjection(nn.Module):
+    """
+    All the per-label operator layers `Sequential(Linear(3H, H), ReLU, LayerNorm(H), Dropout)` in one module.
+    The linear layers of all labels are evaluated with a single matmul, and the LayerNorm is applied per label group.
+    The parameter layout is convertible to/from the per-label `nn.ModuleList` with the functions below.
+    """
+
+    def __init__(self, num_labels: int, in_features: int, hidden_size: int, layer_norm_eps: float, dropout_prob: float, initializer_range: float):
+        super().__init__()
+        self.num_labels = num_labels
+        self.hidden_size = hidden_size
+        self.layer_norm_eps = layer_norm_eps
+        ## created with `torch.randn` (as `const_rep`), the `_init_weights` of the pretrained models does not know this module
+        self.weight = nn.Parameter(torch.randn(num_labels * hidden_size, in_features) * initializer_range)
+        self.bias = nn.Parameter(torch.zeros(num_labels * hidden_size))
+        self.norm_weight = nn.Parameter(torch.ones(num_labels, hidden_size))
+        self.norm_bias = nn.Parameter(torch.zeros(num_labels, hidden_size))
+        self.dropout = nn.Dropout(dropout_prob)
+
+    def normalize(self, projected: torch.Tensor) -> torch.Tensor:
+        """
+        ReLU, grouped LayerNorm and dropout on the projected representation.
+        :param projected: (..., num_labels * hidden_size)
+        :return: (..., num_labels, hidden_size)
+        """
+        projected = projected.view(*projected.size()[:-1], self.num_labels, self.hidden_size)
+        normalized = nn.functional.layer_norm(torch.relu(projected), (self.hidden_size,), eps=self.layer_norm_eps)
+        return self.dropout(normalized * self.norm_weight + self.norm_bias)
+
+    def forward(self, pair_hidden_states: torch.Tensor) -> torch.Tensor:
+        """
+        :param pair_hidden_states: (..., 3 * hidden_size)
+        :return: (..., num_labels, hidden_size)
+        """
+        return self.normalize(nn.functional.linear(pair_hidden_states, self.weight, self.bias))
+
+    def forward_factorized(self, var_hidden_states: torch.Tensor, combination: torch.Tensor) -> torch.Tensor:
+        """
+        Same as `forward` on [a, b, a*b], but the a and b parts are projected once per variable.
+        :param var_hidden_states: (batch_size, num_variables, hidden_size)
+        :param combination: (num_combinations, 2)
+        :return: (batch_size, num_combinations, num_labels, hidden_size)
+        """
+        left_weight, right_weight, product_weight = self.weight.split(self.hidden_size, dim=1)
+        left_proj = nn.functional.linear(var_hidden_states, left_weight)  ## batch_size, num_variables, num_labels * hidden_size
+        right_proj = nn.functional.linear(var_hidden_states, right_weight)
+        product_hidden_states = var_hidden_states[:, combination[:, 0]] * var_hidden_states[:, combination[:, 1]]
+        projected = left_proj[:, combination[:, 0]] + right_proj[:, combination[:, 1]] + nn.functional.linear(product_hidden_states, product_weight, self.bias)
+        return self.normalize(projected)
+
+    def to_per_label(self) -> nn.ModuleList:
+        """
+        The equivalent per-label `nn.ModuleList` of `Sequential(Linear(3H, H), ReLU, LayerNorm(H), Dropout)`.
+        """
+        linears = nn.ModuleList()
+        for _ in range(self.num_labels):
+            linears.append(nn.Sequential(
+                nn.Linear(self.weight.size(1), self.hidden_size),
+                nn.ReLU(),
+                nn.LayerNorm(self.hidden_size, eps=self.layer_norm_eps),
+                nn.Dropout(self.dropout.p)
+            ))
+        state_dict = operator_state_dict_to_per_label({f"linears.{key}": value for key, value in self.state_dict().items()})
+        linears.load_state_dict({key[len("linears."):]: value for key, value in state_dict.items()})
+        ## the new layers are in training mode (dropout) otherwise
+        return linears.to(self.weight.device).train(self.training)
+
+
+def operator_state_dict_to_fused(state_dict: Dict[str, torch.Tensor], prefix: str = "") -> Dict[str, torch.Tensor]:
+    """
+    Convert (in place) the per-label `linears.{i}.0` (Linear) / `linears.{i}.2` (LayerNorm) parameters
+    into the `FusedOperatorProjection` layout. Nothing is done if the state dict is already fused.
+    """
+    pattern = re.compile(re.escape(prefix) + r"linears\.(\d+)\.0\.weight$")
+    label_idxs = sorted(int(pattern.match(key).group(1)) for key in state_dict if pattern.match(key))
+    if not label_idxs:
+        return state_dict
+    state_dict[f"{prefix}linears.weight"] = torch.cat([state_dict.pop(f"{prefix}linears.{i}.0.weight") for i in label_idxs], dim=0)
+    state_dict[f"{prefix}linears.bias"] = torch.cat([state_dict.pop(f"{prefix}linears.{i}.0.bias") for i in label_idxs], dim=0)
+    state_dict[f"{prefix}linears.norm_weight"] = torch.stack([state_dict.pop(f"{prefix}linears.{i}.2.weight") for i in label_idxs], dim=0)
+    state_dict[f"{prefix}linears.norm_bias"] = torch.stack([state_dict.pop(f"{prefix}linears.{i}.2.bias") for i in label_idxs], dim=0)
+    return state_dict
+
+
+def operator_state_dict_to_per_label(state_dict: Dict[str, torch.Tensor], prefix: str = "") -> Dict[str, torch.Tensor]:
+    """
+    Convert (in place) the `FusedOperatorProjection` parameters back into the per-label `linears.{i}.0` / `linears.{i}.2` layout.
+    Nothing is done if the state dict is already per label.
+    """
+    if f"{prefix}linears.weight" not in state_dict:
+        return state_dict
+    norm_weight = state_dict.pop(f"{prefix}linears.norm_weight")
+    norm_bias = state_dict.pop(f"{prefix}linears.norm_bias")
+    num_labels = norm_weight.size(0)
+    weights = state_dict.pop(f"{prefix}linears.weight").chunk(num_labels, dim=0)
+    biases = state_dict.pop(f"{prefix}linears.bias").chunk(num_labels, dim=0)
+    for i in range(num_labels):
+        state_dict[f"{prefix}linears.{i}.0.weight"] = weights[i].clone()
+        state_dict[f"{prefix}linears.{i}.0.bias"] = biases[i].clone()
+        state_dict[f"{prefix}linears.{i}.2.weight"] = norm_weight[i].clone()
+        state_dict[f"{prefix}linears.{i}.2.bias"] = norm_bias[i].clone()
+    return state_dict
+
+
+def convert_operator_layout_hook(fused_operators: bool, state_dict, prefix, *args):
+    """
+    `load_state_dict` pre-hook of the model, so checkpoints saved with either operator layout load into both.
+    `from_pretrained` compares the checkpoint keys with the model keys before this conversion, so it still reports the operator
+    keys of a checkpoint with the other layout as missing and unexpected.
+    """
+    other_layout_key = f"{prefix}linears.0.0.weight" if fused_operators else f"{prefix}linears.weight"
+    if other_layout_key in state_dict:
+        logger.warning(f"Converting the operator layers of the checkpoint to the {'fused' if fused_operators else 'per-label'} layout "
+                       f"(the `linears.` keys of the other layout may be reported as missing/unexpected)")
+    if fused_operators:
+        operator_state_dict_to_fused(state_dict, prefix)
+    else:
+        operator_state_dict_to_per_label(state_dict, prefix)
@@ -0,0 +1,86 @@
+"""
+Indexing of the (left, right) variable pairs (left <= right) scored at each height.
+The pairs are enumerated in the order of `torch.combinations(torch.arange(num_vars), r=2, with_replacement=True)`,
+i.e., (0, 0), (0, 1), ..., (0, n-1), (1, 1), ..., (n-1, n-1).
+At height i there are `max_num_variable + i` variables, so the tables below are cached by that number
+(the same table serves every (num_vars, height) with the same total).
+"""
+
+import torch
+from typing import Dict, Tuple
+
+
+_combination_cache: Dict[Tuple[int, torch.device], torch.Tensor] = {}
+_combination_mask_cache: Dict[Tuple[int, torch.device], torch.Tensor] = {}
+_constant_pair_split_cache: Dict[Tuple[int, int, torch.device], Tuple[torch.Tensor, torch.Tensor]] = {}
+
+
+def get_num_combinations(num_vars: int) -> int:
+    return num_vars * (num_vars + 1) // 2
+
+
+def get_combination(num_vars: int, device: torch.device) -> torch.Tensor:
+    """
+    :return: combination: (num_combinations, 2)
+    """
+    key = (num_vars, torch.device(device))
+    if key not in _combination_cache:
+        num_var_range = torch.arange(0, num_vars, device=device)
+        _combination_cache[key] = torch.combinations(num_var_range, r=2, with_replacement=True)
+    return _combination_cache[key]
+
+
+def get_combination_mask_table(num_vars: int, device: torch.device) -> torch.Tensor:
+    """
+    :return: mask_table: (num_vars + 1, num_combinations), row k is the mask of the pairs valid with k variables
+    """
+    key = (num_vars, torch.device(device))
+    if key not in _combination_mask_cache:
+        combination = get_combination(num_vars, device)
+        num_valid = torch.arange(0, num_vars + 1, device=device).unsqueeze(1)  ## num_vars + 1, 1
+        _combination_mask_cache[key] = combination[:, 1].unsqueeze(0) < num_valid  ## right >= left, so only right needs checking
+    return _combination_mask_cache[key]
+
+
+def get_batched_combination_mask(batched_num_variables: torch.Tensor, num_vars: int) -> torch.Tensor:
+    """
+    Same as `get_combination_mask` in the model, by a lookup into the cached mask table.
+    :param batched_num_variables: (batch_size), the number of valid variables of each instance
+    :param num_vars: the (padded) number of variables
+    :return: batched_comb_mask: (batch_size, num_combinations)
+    """
+    mask_table = get_combination_mask_table(num_vars, batched_num_variables.device)
+    return mask_table[batched_num_variables]
+
+
+def get_constant_pair_split(num_vars: int, constant_num: int, device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Split the pairs at height 0 (the constants are the first `constant_num` variables) into the constant-constant pairs,
+    which are exactly `get_combination(constant_num)`, and the pairs involving at least one quantity.
+    :return: var_positions: (num_var_combinations), the flat indices of the pairs involving a quantity
+             order: (num_combinations), the permutation mapping [constant pairs; quantity pairs] back to the flat order
+    """
+    key = (num_vars, constant_num, torch.device(device))
+    if key not in _constant_pair_split_cache:
+        is_constant_pair = get_combination(num_vars, device)[:, 1] < constant_num
+        const_positions = is_constant_pair.nonzero().squeeze(-1)
+        var_positions = (~is_constant_pair).nonzero().squeeze(-1)
+        order = torch.argsort(torch.cat([const_positions, var_positions]))
+        _constant_pair_split_cache[key] = (var_positions, order)
+    return _constant_pair_split_cache[key]
+
+
+def pair_to_index(left: torch.Tensor, right: torch.Tensor, num_vars: int) -> torch.Tensor:
+    """
+    Closed-form flat index of the pair (left, right) with left <= right, no search and no host sync.
+    The pairs before row `left` are sum_{k < left} (num_vars - k) = left * num_vars - left * (left - 1) / 2.
+    """
+    return left * num_vars - left * (left - 1) // 2 + (right - left)
+
+
+def index_to_pair(index: torch.Tensor, num_vars: int) -> torch.Tensor:
+    """
+    :param index: (...) flat pair indices
+    :return: pairs: (..., 2) the (left, right) variable indices
+    """
+    return get_combination(num_vars, index.device)[index]
@@ -0,0 +1,37 @@
+"""
+Measurement of the first stage of the top-k pair pruning (`pair_top_k`): the rank of the gold pair under the
+first-stage scores at each height, along the gold steps (teacher forcing), from which the gold-pair recall@k follows.
+"""
+
+import torch
+import torch.nn as nn
+from src.model.pair_index import get_combination, get_batched_combination_mask, pair_to_index
+from src.model.static_inference import encode_variables
+from src.model.universal_model import get_first_stage_pair_scores, get_gold_label_rep, update_var_hidden_states
+
+
+@torch.no_grad()
+def gold_pair_ranks(model: nn.Module, input_ids: torch.Tensor, attention_mask: torch.Tensor, token_type_ids: torch.Tensor,
+                    variable_indexs_start: torch.Tensor, variable_indexs_end: torch.Tensor, num_variables: torch.Tensor,
+                    labels: torch.Tensor, label_height_mask: torch.Tensor) -> torch.Tensor:
+    """
+    :return: ranks: (batch_size, height) the number of pairs with a higher first-stage score than the gold pair
+             (the gold pair is kept by the top-k pruning if rank < k), -1 for the heights without gold step
+    """
+    model.eval()
+    var_hidden_states = encode_variables(model, model.base_model, input_ids, attention_mask, token_type_ids, variable_indexs_start, variable_indexs_end)
+    num_variables = num_variables + model.constant_num
+    max_num_variable = var_hidden_states.size(1)
+    b_idxs = torch.arange(input_ids.size(0), device=input_ids.device)
+    ranks = []
+    for i in range(labels.size(1)):
+        if i > 0:
+            gold_label_rep = get_gold_label_rep(model, var_hidden_states, labels[:, i - 1, :])
+            var_hidden_states = update_var_hidden_states(model, var_hidden_states, gold_label_rep)
+        combination = get_combination(max_num_variable + i, device=input_ids.device)
+        batched_combination_mask = get_batched_combination_mask(num_variables + i, max_num_variable + i)
+        _, pair_scores = get_first_stage_pair_scores(model, var_hidden_states, combination, batched_combination_mask)
+        gold_scores = pair_scores[b_idxs, pair_to_index(labels[:, i, 0], labels[:, i, 1], max_num_variable + i)]
+        rank = (pair_scores > gold_scores.unsqueeze(1)).sum(dim=-1)
+        ranks.append(torch.where(label_height_mask[:, i] > 0, rank, torch.full_like(rank, -1)))
+    return torch.stack(ranks, dim=1)
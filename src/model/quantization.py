@@ -0,0 +1,61 @@
+"""
+Post-training dynamic int8 quantization of the model for CPU inference.
+The `nn.Linear` layers of the encoder and of the deductive head (`linears`, `stopper_transformation`, `variable_scorer`,
+`label_rep2label`, `stopper`) and the `GRUCell` variable update are quantized, the activations stay in fp32.
+"""
+
+import json
+import os
+import torch
+import torch.nn as nn
+
+QUANTIZED_CHECKPOINT_NAME = "quantized_model.bin"
+## the fingerprint of the float weights the checkpoint was quantized from (`get_weights_fingerprint`)
+QUANTIZED_META_NAME = "quantized_model.json"
+
+
+def quantize_model(model: nn.Module) -> nn.Module:
+    """
+    Quantize the model in place (on CPU).
+    The fused operator layers are converted back to the per-label layers first, and the factorized projection
+    (which splits the float weights) is turned off, so that every operator layer is an `nn.Linear`.
+    """
+    model.cpu()
+    model.eval()
+    if model.fused_operators:
+        model.linears = model.linears.to_per_label()
+        model.fused_operators = False
+    model.factorized_projection = False
+    model._constant_pair_cache = None
+    ## the quantized layers are created in training mode
+    return torch.quantization.quantize_dynamic(model, {nn.Linear, nn.GRUCell}, dtype=torch.qint8, inplace=True).eval()
+
+
+def save_quantized_model(model: nn.Module, folder: str, fingerprint: str):
+    """
+    :param fingerprint: the fingerprint of the float weights before quantization
+    """
+    os.makedirs(folder, exist_ok=True)
+    torch.save(model.state_dict(), os.path.join(folder, QUANTIZED_CHECKPOINT_NAME))
+    with open(os.path.join(folder, QUANTIZED_META_NAME), "w", encoding="utf-8") as meta_file:
+        json.dump({"fingerprint": fingerprint}, meta_file)
+
+
+def has_quantized_model(folder: str, fingerprint: str) -> bool:
+    """
+    Whether the folder has a quantized checkpoint of the float weights with this fingerprint.
+    """
+    if not os.path.exists(os.path.join(folder, QUANTIZED_CHECKPOINT_NAME)) or not os.path.exists(os.path.join(folder, QUANTIZED_META_NAME)):
+        return False
+    with open(os.path.join(folder, QUANTIZED_META_NAME), "r", encoding="utf-8") as meta_file:
+        return json.load(meta_file)["fingerprint"] == fingerprint
+
+
+def load_quantized_model(model: nn.Module, folder: str) -> nn.Module:
+    """
+    Quantize the (float) model with the same settings and load the quantized checkpoint saved by `save_quantized_model`.
+    """
+    quantize_model(model)
+    ## the packed int8 weights are not plain tensors
+    model.load_state_dict(torch.load(os.path.join(folder, QUANTIZED_CHECKPOINT_NAME), map_location="cpu", weights_only=False))
+    return model
@@ -0,0 +1,197 @@
+"""
+Static-shape inference for `torch.compile`.
+The inputs are padded to shape buckets (batch size, sequence length, number of quantities) and a fixed number of heights
+is unrolled without any host sync, so each bucket is compiled once and reused.
+Padded quantities come after the valid ones, so the variable indices of the predictions are unchanged.
+The full attention update (`var_update_mode` attn without `star_attention`) is not masked per variable, so the padded quantities
+would change the updated states: with it, the number of quantities is not padded (one compiled graph per size instead).
+"""
+
+import bisect
+import torch
+import torch.nn as nn
+from typing import List, Tuple
+from src.model.pair_index import get_combination, index_to_pair
+from src.model.universal_model import score_pairs, update_var_hidden_states
+
+
+def encode_variables(cls, encoder: nn.Module, input_ids: torch.Tensor, attention_mask: torch.Tensor, token_type_ids: torch.Tensor,
+                     variable_indexs_start: torch.Tensor, variable_indexs_end: torch.Tensor) -> torch.Tensor:
+    """
+    The initial variable states of `deductive_forward` (constants first), without host sync.
+    :return: var_hidden_states: (batch_size, constant_num + num_variables, hidden_size)
+    """
+    last_hidden_state = encoder(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids, return_dict=True).last_hidden_state
+    batch_size, sent_len, hidden_size = last_hidden_state.size()
+    _, max_num_variable = variable_indexs_start.size()
+    var_start_hidden_states = torch.gather(last_hidden_state, 1, variable_indexs_start.unsqueeze(-1).expand(batch_size, max_num_variable, hidden_size))
+    var_end_hidden_states = torch.gather(last_hidden_state, 1, variable_indexs_end.unsqueeze(-1).expand(batch_size, max_num_variable, hidden_size))
+    ## the `var_sum != 0` check of `deductive_forward` as a tensor (end >= start, so the sum is 0 iff all are equal)
+    use_end = (variable_indexs_start != variable_indexs_end).any().to(var_end_hidden_states.dtype)
+    var_hidden_states = var_start_hidden_states + use_end * var_end_hidden_states
+    if cls.constant_num > 0:
+        constant_hidden_states = cls.const_rep.unsqueeze(0).expand(batch_size, cls.constant_num, hidden_size)
+        var_hidden_states = torch.cat([constant_hidden_states, var_hidden_states], dim=1)
+    return var_hidden_states
+
+
+def score_height(cls, var_hidden_states: torch.Tensor, combination: torch.Tensor, num_variables: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+    """
+    Score the pairs of one height and select the best (pair, label, stop), without host sync.
+    :param var_hidden_states: (batch_size, num_vars, hidden_size)
+    :param combination: (num_combinations, 2) all the pairs of num_vars variables
+    :param num_variables: (batch_size) the number of valid variables (constants and intermediates included)
+    :return: best_comb, best_label, best_stop: (batch_size), best_label_rep: (batch_size, hidden_size)
+    """
+    b_idxs = torch.arange(var_hidden_states.size(0), device=var_hidden_states.device)
+    batched_combination_mask = combination[:, 1].unsqueeze(0) < num_variables.unsqueeze(1)  ## batch_size, num_combinations
+    mi_combined_logits, mi_label_rep = score_pairs(cls, var_hidden_states, combination, batched_combination_mask)
+    best_temp_logits, best_stop_label = mi_combined_logits.max(dim=-1)  ## batch_size, num_combinations, num_labels
+    best_temp_score, best_temp_label = best_temp_logits.max(dim=-1)  ## batch_size, num_combinations
+    best_mi_score, best_comb = best_temp_score.max(dim=-1)  ## batch_size
+    best_label = best_temp_label[b_idxs, best_comb]
+    return best_comb, best_label, best_stop_label[b_idxs, best_comb, best_label], mi_label_rep[b_idxs, best_comb, best_label]
+
+
+def static_deductive_head(cls, var_hidden_states: torch.Tensor, num_variables: torch.Tensor, best_mi_label_rep: torch.Tensor,
+                          start_height: int, end_height: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    The heights [start_height, end_height) of the inference of `deductive_forward`, with no data-dependent control flow,
+    continued from the state after `start_height` heights.
+    :param var_hidden_states: (batch_size, num_vars + start_height, hidden_size) the variable states before the update of start_height
+    :param num_variables: (batch_size) the number of valid variables at height 0 (constants included)
+    :param best_mi_label_rep: (batch_size, hidden_size) the representation selected at start_height - 1 (not used at height 0)
+    :return: predictions: (batch_size, end_height - start_height, 4) (left_var_index, right_var_index, label_index, stop_id) at each height,
+             and the var_hidden_states and best_mi_label_rep to continue from end_height
+    """
+    max_num_variable = var_hidden_states.size(1) - start_height
+    predictions = []
+    for i in range(start_height, end_height):
+        if i > 0:
+            var_hidden_states = update_var_hidden_states(cls, var_hidden_states, best_mi_label_rep)
+        combination = get_combination(max_num_variable + i, device=var_hidden_states.device)
+        best_comb, best_label, best_stop, best_mi_label_rep = score_height(cls, var_hidden_states, combination, num_variables + i)
+        best_pair = index_to_pair(best_comb, max_num_variable + i)  ## batch_size, 2
+        predictions.append(torch.cat([best_pair, best_label.unsqueeze(-1), best_stop.unsqueeze(-1)], dim=-1))
+    return torch.stack(predictions, dim=1), var_hidden_states, best_mi_label_rep
+
+
+def static_deductive_inference(cls, encoder: nn.Module,
+                               input_ids: torch.Tensor, attention_mask: torch.Tensor, token_type_ids: torch.Tensor,
+                               variable_indexs_start: torch.Tensor, variable_indexs_end: torch.Tensor, num_variables: torch.Tensor,
+                               height: int) -> torch.Tensor:
+    """
+    The inference of `deductive_forward` for `height` steps, with no data-dependent control flow.
+    :return: predictions: (batch_size, height, 4) (left_var_index, right_var_index, label_index, stop_id) at each height
+    """
+    var_hidden_states = encode_variables(cls, encoder, input_ids, attention_mask, token_type_ids, variable_indexs_start, variable_indexs_end)
+    return static_deductive_head(cls, var_hidden_states, num_variables + cls.constant_num, None, 0, height)[0]
+
+
+def get_bucket(buckets: List[int], size: int) -> int:
+    """
+    The smallest bucket that fits `size`, or `size` itself beyond the largest bucket.
+    """
+    idx = bisect.bisect_left(buckets, size)
+    return buckets[idx] if idx < len(buckets) else size
+
+
+class StaticShapeInference:
+    """
+    Runs the static inference (compiled) on inputs padded to the shape buckets: the encoder (`encode_variables`) once per batch,
+    then the deductive head (`static_deductive_head`) by height buckets: the heights up to the smallest bucket are decoded first,
+    and the decoding only continues (from the state of the previous bucket) up to the next bucket if some instance has not
+    predicted the stop label yet (one host sync per height bucket instead of one per height).
+    """
+
+    def __init__(self, model: nn.Module, batch_size: int, seq_len_buckets: List[int], num_variable_buckets: List[int],
+                 height_buckets: List[int] = None, compile: bool = True):
+        self.model = model
+        self.batch_size = batch_size
+        self.seq_len_buckets = sorted(seq_len_buckets)
+        self.num_variable_buckets = sorted(num_variable_buckets)
+        self.pad_num_variables = not (model.var_update_mode == 1 and not model.star_attention)
+        self.height_buckets = sorted(set([h for h in (height_buckets or []) if h < model.max_height] + [model.max_height]))
+        self.pad_token_id = model.config.pad_token_id if model.config.pad_token_id is not None else 0
+        self.encode_fn = encode_variables
+        self.head_fn = static_deductive_head
+        if compile:
+            ## one encoder graph per (sequence length, number of variables) bucket and one head graph per (number of variables, height bucket),
+            ## they should all stay in the compile cache
+            num_buckets = len(self.seq_len_buckets) * len(self.num_variable_buckets) + len(self.num_variable_buckets) * len(self.height_buckets)
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, num_buckets)
+            if hasattr(torch._dynamo.config, "accumulated_cache_size_limit"):
+                torch._dynamo.config.accumulated_cache_size_limit = max(torch._dynamo.config.accumulated_cache_size_limit, num_buckets)
+            self.encode_fn = torch.compile(encode_variables, dynamic=False)
+            self.head_fn = torch.compile(static_deductive_head, dynamic=False)
+
+    def pad_inputs(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, token_type_ids: torch.Tensor,
+                   variable_indexs_start: torch.Tensor, variable_indexs_end: torch.Tensor, num_variables: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        batch_size, sent_len = input_ids.size()
+        _, num_vars = variable_indexs_start.size()
+        padded_batch_size = max(self.batch_size, batch_size)
+        padded_sent_len = get_bucket(self.seq_len_buckets, sent_len)
+        padded_num_vars = get_bucket(self.num_variable_buckets, num_vars) if self.pad_num_variables else num_vars
+
+        def pad(tensor: torch.Tensor, length: int, value: int) -> torch.Tensor:
+            padded = tensor.new_full((padded_batch_size, length), value)
+            padded[:batch_size, :tensor.size(1)] = tensor
+            if padded_batch_size > batch_size:
+                ## the padded instances copy the first instance, so that they are valid problems (thrown away)
+                padded[batch_size:, :tensor.size(1)] = tensor[:1]
+            return padded
+
+        padded_num_variables = torch.cat([num_variables, num_variables[:1].expand(padded_batch_size - batch_size)])
+        return (pad(input_ids, padded_sent_len, self.pad_token_id), pad(attention_mask, padded_sent_len, 0), pad(token_type_ids, padded_sent_len, 0),
+                pad(variable_indexs_start, padded_num_vars, 0), pad(variable_indexs_end, padded_num_vars, 0), padded_num_variables)
+
+    @torch.no_grad()
+    def predict(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, token_type_ids: torch.Tensor,
+                variable_indexs_start: torch.Tensor, variable_indexs_end: torch.Tensor, num_variables: torch.Tensor) -> torch.Tensor:
+        """
+        :return: predictions: (batch_size, height, 4), the steps after the first stop label (if any) are not meaningful
+        """
+        batch_size = input_ids.size(0)
+        *encoder_inputs, padded_num_variables = self.pad_inputs(input_ids, attention_mask, token_type_ids, variable_indexs_start,
+                                                                variable_indexs_end, num_variables)
+        var_hidden_states = self.encode_fn(self.model, self.model.base_model, *encoder_inputs)
+        padded_num_variables = padded_num_variables + self.model.constant_num
+        best_mi_label_rep = None
+        predictions = []
+        start_height = 0
+        for height in self.height_buckets:
+            bucket_predictions, var_hidden_states, best_mi_label_rep = self.head_fn(self.model, var_hidden_states, padded_num_variables,
+                                                                                     best_mi_label_rep, start_height, height)
+            predictions.append(bucket_predictions[:batch_size])
+            start_height = height
+            if height == self.height_buckets[-1] or bool((torch.cat(predictions, dim=1)[:, :, 3] == 1).any(dim=1).all()):
+                return torch.cat(predictions, dim=1)
+
+    def warmup(self):
+        """
+        Compile the encoder for every (sequence length, number of variables) bucket and the head for every (number of variables, height) bucket
+        once with dummy inputs.
+        """
+        device = next(self.model.parameters()).device
+        for seq_len in self.seq_len_buckets:
+            for num_vars in self.num_variable_buckets:
+                input_ids = torch.full((self.batch_size, seq_len), self.pad_token_id, dtype=torch.long, device=device)
+                attention_mask = torch.ones((self.batch_size, seq_len), dtype=torch.long, device=device)
+                token_type_ids = torch.zeros((self.batch_size, seq_len), dtype=torch.long, device=device)
+                variable_indexs_start = torch.zeros((self.batch_size, num_vars), dtype=torch.long, device=device)
+                variable_indexs_end = torch.zeros((self.batch_size, num_vars), dtype=torch.long, device=device)
+                num_variables = torch.full((self.batch_size,), num_vars, dtype=torch.long, device=device)
+                with torch.no_grad():
+                    var_hidden_states = self.encode_fn(self.model, self.model.base_model, input_ids, attention_mask, token_type_ids,
+                                                       variable_indexs_start, variable_indexs_end)
+                    ## the head graphs only depend on the number of variables
+                    if seq_len != self.seq_len_buckets[0]:
+                        continue
+                    ## fill the pair tables (`pair_index`) eagerly, otherwise the graphs would guard on them being empty and be compiled again
+                    static_deductive_head(self.model, var_hidden_states, num_variables + self.model.constant_num, None, 0, self.height_buckets[-1])
+                    best_mi_label_rep = None
+                    start_height = 0
+                    for height in self.height_buckets:
+                        _, var_hidden_states, best_mi_label_rep = self.head_fn(self.model, var_hidden_states, num_variables + self.model.constant_num,
+                                                                               best_mi_label_rep, start_height, height)
+                        start_height = height
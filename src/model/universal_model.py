@@ -1,5 +1,7 @@
 from transformers.models.bert.modeling_bert import BertModel, BertPreTrainedModel, BertConfig
 from transformers import RobertaModel, RobertaConfig, RobertaPreTrainedModel
+import math
+import logging
 import torch.nn as nn
 import torch
 import torch.utils.checkpoint
@@ -7,7 +9,12 @@ from transformers.modeling_outputs import (
     ModelOutput,
 )
 from dataclasses import dataclass
-from typing import Optional, List
+from typing import Optional, List, Tuple
+from functools import partial
+from src.model.operator_projection import FusedOperatorProjection, convert_operator_layout_hook
+from src.model.pair_index import get_combination, get_batched_combination_mask, get_constant_pair_split, pair_to_index, index_to_pair
+
+logger = logging.getLogger(__name__)
 
 @dataclass
 class UniversalOutput(ModelOutput):
@@ -19,10 +26,23 @@ class UniversalOutput(ModelOutput):
             Classification (or regression if config.num_labels==1) loss.
         logits (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, config.num_labels)`):
             Classification (or regression if config.num_labels==1) scores (before SoftMax).
+        predictions (:obj:`torch.LongTensor` of shape :obj:`(batch_size, height, 4)`, `optional`, returned in inference):
+            The best (left_var_index, right_var_index, label_index, stop_id) at each decoded height,
+            the steps after the first stop label are not meaningful.
+        top_scores (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, height, num_top_scores)`, `optional`, returned in inference with `num_top_scores > 0`):
+            The best (pair, label, stop) scores at each decoded height, in decreasing order.
+        exit_layers (:obj:`torch.LongTensor` of shape :obj:`(batch_size,)`, `optional`, returned in inference with early exit in the encoder):
+            The encoder layer each instance is decoded from.
+        hidden_states (:obj:`tuple(torch.FloatTensor)`, `optional`, returned when ``output_hidden_states=True``):
+            The encoder hidden states (embeddings first).
     """
 
     loss: Optional[torch.FloatTensor] = None
     all_logits: List[torch.FloatTensor] = None
+    predictions: Optional[torch.LongTensor] = None
+    top_scores: Optional[torch.FloatTensor] = None
+    exit_layers: Optional[torch.LongTensor] = None
+    hidden_states: Optional[Tuple[torch.FloatTensor]] = None
 
 def get_combination_mask(batched_num_variables: torch.Tensor, combination: torch.Tensor):
     """
@@ -40,6 +60,400 @@ def get_combination_mask(batched_num_variables: torch.Tensor, combination: torch
     return batched_comb_mask[:,:, 0] * batched_comb_mask[:,:, 1]
 
 
+def get_pair_hidden_states(var_hidden_states: torch.Tensor, combination: torch.Tensor):
+    """
+    :param var_hidden_states: (batch_size, num_variables, hidden_size)
+    :param combination: (num_combinations, 2)
+    :return: pair_hidden_states: (batch_size, num_combinations, 3 * hidden_size), i.e., [a, b, a*b]
+    """
+    left_hidden_states = var_hidden_states[:, combination[:, 0]]  ## batch_size, num_combinations, hidden_size
+    right_hidden_states = var_hidden_states[:, combination[:, 1]]
+    return torch.cat([left_hidden_states, right_hidden_states, left_hidden_states * right_hidden_states], dim=-1)
+
+
+def get_pair_label_rep(cls, var_hidden_states: torch.Tensor, combination: torch.Tensor):
+    """
+    Apply every operator layer to the pair representation [a, b, a*b] of each combination.
+    With `cls.factorized_projection`, the weight of the first linear layer is split as
+    W[a; b; a*b] = W_a a + W_b b + W_ab (a*b), so the a and b parts are projected once per variable
+    and only the a*b part is computed per pair. The parameters are the same in both modes.
+    With `cls.fused_operators`, all the operator layers are evaluated by a single `FusedOperatorProjection`.
+    :param var_hidden_states: (batch_size, num_variables, hidden_size)
+    :param combination: (num_combinations, 2)
+    :return: label_rep: (batch_size, num_combinations, num_labels, hidden_size)
+    """
+    if cls.fused_operators:
+        if cls.factorized_projection:
+            return cls.linears.forward_factorized(var_hidden_states, combination)
+        return cls.linears(get_pair_hidden_states(var_hidden_states, combination))
+    hidden_size = var_hidden_states.size(-1)
+    if cls.factorized_projection:
+        left_hidden_states = var_hidden_states[:, combination[:, 0]]  ## batch_size, num_combinations, hidden_size
+        right_hidden_states = var_hidden_states[:, combination[:, 1]]
+        product_hidden_states = left_hidden_states * right_hidden_states
+        label_reps = []
+        for layer in cls.linears:
+            linear = layer[0]
+            left_weight, right_weight, product_weight = linear.weight.split(hidden_size, dim=1)
+            left_proj = nn.functional.linear(var_hidden_states, left_weight)  ## batch_size, num_variables, hidden_size
+            right_proj = nn.functional.linear(var_hidden_states, right_weight)
+            pair_proj = left_proj[:, combination[:, 0]] + right_proj[:, combination[:, 1]] + nn.functional.linear(product_hidden_states, product_weight, linear.bias)
+            label_reps.append(layer[1:](pair_proj))
+        return torch.stack(label_reps, dim=2)
+    pair_hidden_states = get_pair_hidden_states(var_hidden_states, combination)
+    return torch.stack([layer(pair_hidden_states) for layer in cls.linears], dim=2)
+
+
+def score_pairs(cls, var_hidden_states: torch.Tensor, combination: torch.Tensor, batched_combination_mask: torch.Tensor,
+                var_scores: Optional[torch.Tensor] = None):
+    """
+    Score every (pair, label, stop) of the given combinations.
+    :param var_hidden_states: (batch_size, num_variables, hidden_size)
+    :param combination: (num_combinations, 2)
+    :param batched_combination_mask: (batch_size, num_combinations)
+    :param var_scores: (batch_size, num_variables) the `variable_scorer` scores, computed here if not given
+    :return: combined_logits: (batch_size, num_combinations, num_labels, 2), label_rep: (batch_size, num_combinations, num_labels, hidden_size)
+    """
+    batch_size = var_hidden_states.size(0)
+    num_combinations, _ = combination.size()
+    ## batch_size, num_combinations/num_m0, num_labels, hidden_size
+    label_rep = get_pair_label_rep(cls, var_hidden_states, combination)
+    ## batch_size, num_combinations/num_m0, num_labels, 2
+    ## the scores are summed in fp32 (also under bf16/fp16 autocast), where adding the -inf of the masked pairs is safe
+    logits = cls.label_rep2label(label_rep).float().expand(batch_size, num_combinations, cls.num_labels, 2)
+    logits = logits + batched_combination_mask.unsqueeze(-1).unsqueeze(-1).expand(batch_size, num_combinations, cls.num_labels, 2).float().log()
+    ## batch_size, num_combinations/num_m0, num_labels, 2
+    stopper_logits = cls.stopper(cls.stopper_transformation(label_rep)).float()
+
+    if var_scores is None:
+        var_scores = cls.variable_scorer(var_hidden_states).squeeze(-1)  ## batch_size x max_num_variable
+    expanded_var_scores = var_scores[:, combination].float().sum(dim=-1)  ## batch_size x num_combinations
+    expanded_var_scores = expanded_var_scores.unsqueeze(-1).unsqueeze(-1).expand(batch_size, num_combinations, cls.num_labels, 2)
+
+    combined_logits = logits + stopper_logits + expanded_var_scores
+    return combined_logits, label_rep
+
+
+def score_pairs_chunked(cls, var_hidden_states: torch.Tensor, combination: torch.Tensor, batched_combination_mask: torch.Tensor, chunk_size: int):
+    """
+    Same scores and best (pair, label, stop) as `score_pairs` followed by the max reductions, but the pairs are scored
+    `chunk_size` at a time with a running best, and only the label representation of the best pair is kept.
+    The peak memory of the label representations is (batch_size, chunk_size, num_labels, hidden_size).
+    :return: combined_logits: (batch_size, num_combinations, num_labels, 2),
+             best_score, best_comb, best_label, best_stop: (batch_size), best_label_rep: (batch_size, hidden_size)
+    """
+    batch_size = var_hidden_states.size(0)
+    b_idxs = torch.arange(batch_size, device=var_hidden_states.device)
+    var_scores = cls.variable_scorer(var_hidden_states).squeeze(-1)  ## batch_size x max_num_variable
+    all_combined_logits = []
+    best = None
+    for start in range(0, combination.size(0), chunk_size):
+        end = start + chunk_size
+        combined_logits, label_rep = score_pairs(cls, var_hidden_states, combination[start:end], batched_combination_mask[:, start:end], var_scores=var_scores)
+        all_combined_logits.append(combined_logits)
+        best_temp_logits, best_stop_label = combined_logits.max(dim=-1)  ## batch_size, chunk_size, num_labels
+        best_temp_score, best_temp_label = best_temp_logits.max(dim=-1)  ## batch_size, chunk_size
+        chunk_score, chunk_comb = best_temp_score.max(dim=-1)  ## batch_size
+        chunk_label = best_temp_label[b_idxs, chunk_comb]
+        chunk_best = (chunk_score, chunk_comb + start, chunk_label, best_stop_label[b_idxs, chunk_comb, chunk_label],
+                      label_rep[b_idxs, chunk_comb, chunk_label])
+        if best is None:
+            best = chunk_best
+        else:
+            ## strictly better only, so that ties keep the first pair as the argmax over all pairs does
+            better = chunk_score > best[0]
+            best = tuple(torch.where(better.view(-1, *([1] * (new.dim() - 1))), new, old) for new, old in zip(chunk_best, best))
+    return (torch.cat(all_combined_logits, dim=1),) + best
+
+
+def get_first_stage_pair_scores(cls, var_hidden_states: torch.Tensor, combination: torch.Tensor, batched_combination_mask: torch.Tensor):
+    """
+    The cheap first stage of the top-k pair pruning: the sum of the `variable_scorer` scores of the two variables
+    (the same term as in `score_pairs`), without the operator layers and the stopper.
+    :return: var_scores: (batch_size, num_variables), pair_scores: (batch_size, num_combinations), -inf for the invalid pairs
+    """
+    var_scores = cls.variable_scorer(var_hidden_states).squeeze(-1)  ## batch_size x max_num_variable
+    pair_scores = var_scores[:, combination].float().sum(dim=-1).masked_fill(~batched_combination_mask.bool(), float("-inf"))
+    return var_scores, pair_scores
+
+
+def score_pair_subset(cls, var_hidden_states: torch.Tensor, var_scores: torch.Tensor, combination: torch.Tensor,
+                      subset_comb: torch.Tensor, subset_mask: torch.Tensor):
+    """
+    `score_pairs` on a different subset of the combinations for each instance.
+    The pairs are scored as a 2k-variable problem [left_1, ..., left_k, right_1, ..., right_k] with the combinations (j, k + j).
+    :param var_scores: (batch_size, num_variables) the `variable_scorer` scores
+    :param subset_comb: (batch_size, k) the flat combination indices of the subset
+    :param subset_mask: (batch_size, k) whether each pair of the subset is valid
+    :return: combined_logits: (batch_size, k, num_labels, 2), label_rep: (batch_size, k, num_labels, hidden_size)
+    """
+    b_idxs = torch.arange(var_hidden_states.size(0), device=var_hidden_states.device).unsqueeze(1)
+    k = subset_comb.size(1)
+    subset_pairs = combination[subset_comb]  ## batch_size, k, 2
+    pair_var_idxs = torch.cat([subset_pairs[:, :, 0], subset_pairs[:, :, 1]], dim=1)  ## batch_size, 2k
+    k_range = torch.arange(k, device=var_hidden_states.device)
+    pair_combination = torch.stack([k_range, k_range + k], dim=1)
+    return score_pairs(cls, var_hidden_states[b_idxs, pair_var_idxs], pair_combination, subset_mask, var_scores=var_scores[b_idxs, pair_var_idxs])
+
+
+def scatter_pair_subset(combined_logits: torch.Tensor, subset_comb: torch.Tensor, num_combinations: int):
+    """
+    :return: (batch_size, num_combinations, num_labels, 2) the logits of the subset, -inf for the other pairs
+    """
+    b_idxs = torch.arange(combined_logits.size(0), device=combined_logits.device).unsqueeze(1)
+    full_combined_logits = combined_logits.new_full((combined_logits.size(0), num_combinations) + combined_logits.size()[2:], float("-inf"))
+    full_combined_logits[b_idxs, subset_comb] = combined_logits
+    return full_combined_logits
+
+
+def score_top_k_pairs(cls, var_hidden_states: torch.Tensor, combination: torch.Tensor, batched_combination_mask: torch.Tensor, k: int):
+    """
+    Keep the top-k pairs of each instance by `get_first_stage_pair_scores` and only score those with `score_pairs`.
+    The pairs outside the top-k get -inf, so the result is approximate when the best pair is pruned.
+    :return: combined_logits: (batch_size, num_combinations, num_labels, 2),
+             best_score, best_comb, best_label, best_stop: (batch_size), best_label_rep: (batch_size, hidden_size)
+    """
+    b_idxs = torch.arange(var_hidden_states.size(0), device=var_hidden_states.device)
+    var_scores, pair_scores = get_first_stage_pair_scores(cls, var_hidden_states, combination, batched_combination_mask)
+    top_pair_scores, top_comb = pair_scores.topk(min(k, combination.size(0)), dim=-1)  ## batch_size, k
+    ## fewer than k valid pairs: the invalid ones are kept masked
+    combined_logits, label_rep = score_pair_subset(cls, var_hidden_states, var_scores, combination, top_comb, top_pair_scores > float("-inf"))
+    best_temp_logits, best_stop_label = combined_logits.max(dim=-1)  ## batch_size, k, num_labels
+    best_temp_score, best_temp_label = best_temp_logits.max(dim=-1)  ## batch_size, k
+    best_score, best_top = best_temp_score.max(dim=-1)  ## batch_size
+    best_label = best_temp_label[b_idxs, best_top]
+    return (scatter_pair_subset(combined_logits, top_comb, combination.size(0)), best_score, top_comb[b_idxs, best_top], best_label,
+            best_stop_label[b_idxs, best_top, best_label], label_rep[b_idxs, best_top, best_label])
+
+
+def score_sampled_pairs(cls, var_hidden_states: torch.Tensor, combination: torch.Tensor, batched_combination_mask: torch.Tensor,
+                        gold_comb: torch.Tensor, num_negatives: int, negative_source: str):
+    """
+    Score only the gold pair and sampled negative pairs (training objective with sampled negatives).
+    The negatives are the valid pairs (gold excluded) with the top first-stage scores (`scorer`) or uniformly random ones (`random`).
+    :param gold_comb: (batch_size) the flat index of the gold pair
+    :return: combined_logits: (batch_size, num_combinations, num_labels, 2), -inf out of the sampled pairs,
+             gold_label_rep: (batch_size, num_labels, hidden_size) the label representations of the gold pair
+    """
+    batch_size = var_hidden_states.size(0)
+    var_scores, pair_scores = get_first_stage_pair_scores(cls, var_hidden_states, combination, batched_combination_mask)
+    if negative_source == "random":
+        sample_scores = torch.rand_like(pair_scores).masked_fill(~batched_combination_mask.bool(), float("-inf"))
+    else:
+        sample_scores = pair_scores.detach()
+    sample_scores = sample_scores.scatter(1, gold_comb.unsqueeze(1), float("-inf"))
+    negative_scores, negative_comb = sample_scores.topk(min(num_negatives, combination.size(0) - 1), dim=-1)  ## batch_size, num_negatives
+    ## the gold pair first
+    subset_comb = torch.cat([gold_comb.unsqueeze(1), negative_comb], dim=1)
+    subset_mask = torch.cat([torch.ones((batch_size, 1), dtype=torch.bool, device=var_hidden_states.device), negative_scores > float("-inf")], dim=1)
+    combined_logits, label_rep = score_pair_subset(cls, var_hidden_states, var_scores, combination, subset_comb, subset_mask)
+    full_combined_logits = scatter_pair_subset(combined_logits[:, 1:], negative_comb, combination.size(0))
+    ## the masked negatives may point to the gold pair (-inf), so the gold logits are written last
+    full_combined_logits[torch.arange(batch_size, device=var_hidden_states.device), gold_comb] = combined_logits[:, 0]
+    return full_combined_logits, label_rep[:, 0]
+
+
+def get_constant_pair_scores(cls):
+    """
+    Scores of the constant-constant pairs at height 0, which do not depend on the instance.
+    In evaluation (no training mode and no grad), they are cached until the head parameters change.
+    :return: combined_logits: (1, num_constant_combinations, num_labels, 2), label_rep: (1, num_constant_combinations, num_labels, hidden_size)
+    """
+    use_cache = not cls.training and not torch.is_grad_enabled()
+    if use_cache:
+        ## in-place updates (optimizer steps, `load_state_dict`) bump the version, `.to()`/`.half()` change the storage
+        params = [cls.const_rep] + [p for module in [cls.linears, cls.label_rep2label, cls.stopper_transformation, cls.stopper, cls.variable_scorer]
+                                    for p in module.parameters()]
+        key = tuple((p.data_ptr(), p._version) for p in params) + (torch.is_autocast_enabled(cls.const_rep.device.type),)
+        if cls._constant_pair_cache is not None and cls._constant_pair_cache[0] == key:
+            return cls._constant_pair_cache[1]
+    combination = get_combination(cls.constant_num, device=cls.const_rep.device)
+    combination_mask = torch.ones(1, combination.size(0), dtype=torch.bool, device=cls.const_rep.device)
+    scores = score_pairs(cls, cls.const_rep.unsqueeze(0), combination, combination_mask)
+    if use_cache:
+        cls._constant_pair_cache = (key, scores)
+    return scores
+
+
+def score_pairs_with_constant_cache(cls, var_hidden_states: torch.Tensor, combination: torch.Tensor, batched_combination_mask: torch.Tensor):
+    """
+    Same as `score_pairs` at height 0 (constants first), but the constant-constant pairs are scored once
+    for the whole batch and only the pairs involving a quantity are scored per instance.
+    """
+    batch_size, num_vars, _ = var_hidden_states.size()
+    var_positions, order = get_constant_pair_split(num_vars, cls.constant_num, device=var_hidden_states.device)
+    const_combined_logits, const_label_rep = get_constant_pair_scores(cls)
+    var_combined_logits, var_label_rep = score_pairs(cls, var_hidden_states, combination[var_positions], batched_combination_mask[:, var_positions])
+    num_const_combinations = const_combined_logits.size(1)
+    combined_logits = torch.cat([const_combined_logits.expand(batch_size, num_const_combinations, -1, -1), var_combined_logits], dim=1)[:, order]
+    label_rep = torch.cat([const_label_rep.expand(batch_size, num_const_combinations, -1, -1), var_label_rep], dim=1)[:, order]
+    return combined_logits, label_rep
+
+
+def star_attention_update(attention: nn.MultiheadAttention, var_hidden_states: torch.Tensor, mi_state: torch.Tensor):
+    """
+    The multi-head attention over [m_i; variables] where each variable only attends to the new intermediate m_i and itself,
+    i.e., `attention(temp_states, temp_states, temp_states, attn_mask=star_mask)` with the boolean mask blocking every other entry.
+    With two keys per query, the softmax is over (num_variables, 2) scores, linear in the number of variables.
+    The output of m_i itself (attending to everything) is not computed as it is discarded by the update.
+    :param attention: the `nn.MultiheadAttention` (batch_first, no extra key/value bias) of the model
+    :param var_hidden_states: (batch_size, num_variables, hidden_size)
+    :param mi_state: (batch_size, hidden_size)
+    :return: (batch_size, num_variables, hidden_size), the updated variable states
+    """
+    batch_size, num_variables, hidden_size = var_hidden_states.size()
+    num_heads = attention.num_heads
+    head_dim = hidden_size // num_heads
+    query_weight, key_weight, value_weight = attention.in_proj_weight.chunk(3, dim=0)
+    query_bias, key_bias, value_bias = attention.in_proj_bias.chunk(3, dim=0)
+    ## batch_size, num_variables, num_heads, head_dim
+    var_query = nn.functional.linear(var_hidden_states, query_weight, query_bias).view(batch_size, num_variables, num_heads, head_dim)
+    var_key = nn.functional.linear(var_hidden_states, key_weight, key_bias).view(batch_size, num_variables, num_heads, head_dim)
+    var_value = nn.functional.linear(var_hidden_states, value_weight, value_bias).view(batch_size, num_variables, num_heads, head_dim)
+    ## batch_size, 1, num_heads, head_dim
+    mi_key = nn.functional.linear(mi_state, key_weight, key_bias).view(batch_size, 1, num_heads, head_dim)
+    mi_value = nn.functional.linear(mi_state, value_weight, value_bias).view(batch_size, 1, num_heads, head_dim)
+    ## batch_size, num_variables, num_heads, 2 (attention to m_i, attention to itself)
+    scores = torch.stack([(var_query * mi_key).sum(-1), (var_query * var_key).sum(-1)], dim=-1) / math.sqrt(head_dim)
+    attn_weights = nn.functional.dropout(torch.softmax(scores, dim=-1), p=attention.dropout, training=attention.training)
+    attended = attn_weights[..., 0:1] * mi_value + attn_weights[..., 1:2] * var_value
+    return attention.out_proj(attended.reshape(batch_size, num_variables, hidden_size))
+
+
+def update_var_hidden_states(cls, var_hidden_states: torch.Tensor, best_mi_label_rep: torch.Tensor):
+    """
+    Update the variable states with the newly selected intermediate and prepend it as the new variable m_i.
+    :param var_hidden_states: (batch_size, num_variables, hidden_size)
+    :param best_mi_label_rep: (batch_size, hidden_size)
+    :return: (batch_size, num_variables + 1, hidden_size)
+    """
+    batch_size, num_variables, hidden_size = var_hidden_states.size()
+    if cls.var_update_mode == 0:
+        ## update hidden_state (gated hidden state)
+        init_h = best_mi_label_rep.unsqueeze(1).expand(batch_size, num_variables, hidden_size).contiguous().view(-1, hidden_size)
+        gru_inputs = var_hidden_states.view(-1, hidden_size)
+        var_hidden_states = cls.variable_gru(gru_inputs, init_h).view(batch_size, num_variables, hidden_size)
+    elif cls.var_update_mode == 1 and cls.star_attention:
+        var_hidden_states = star_attention_update(cls.variable_gru, var_hidden_states, best_mi_label_rep)
+    elif cls.var_update_mode == 1:
+        temp_states = torch.cat([best_mi_label_rep.unsqueeze(1), var_hidden_states], dim=1)  ## batch_size x (num_var + i) x hidden_size
+        temp_mask = torch.eye(num_variables + 1, device=var_hidden_states.device)
+        temp_mask[:, 0] = 1
+        temp_mask[0, :] = 1
+        updated_all_states, _ = cls.variable_gru(temp_states, temp_states, temp_states, attn_mask=1 - temp_mask)
+        var_hidden_states = updated_all_states[:, 1:, :]
+    return torch.cat([best_mi_label_rep.unsqueeze(1), var_hidden_states], dim=1)
+
+
+def get_gold_label_rep(cls, var_hidden_states: torch.Tensor, gold_labels: torch.Tensor):
+    """
+    Label representation of the gold pair under the gold label only (teacher forcing).
+    :param var_hidden_states: (batch_size, num_variables, hidden_size)
+    :param gold_labels: (batch_size, 4) (left_var_index, right_var_index, label_index, stop_id)
+    :return: (batch_size, hidden_size)
+    """
+    b_idxs = torch.arange(var_hidden_states.size(0), device=var_hidden_states.device)
+    ## the gold pair of each instance as a 2-variable problem with the single combination (0, 1)
+    pair_states = torch.stack([var_hidden_states[b_idxs, gold_labels[:, 0]], var_hidden_states[b_idxs, gold_labels[:, 1]]], dim=1)
+    pair_combination = torch.tensor([[0, 1]], device=var_hidden_states.device)
+    label_rep = get_pair_label_rep(cls, pair_states, pair_combination)  ## batch_size, 1, num_labels, hidden_size
+    return label_rep[b_idxs, 0, gold_labels[:, 2]]
+
+
+def height_parallel_forward(cls, var_hidden_states: torch.Tensor, num_variables: torch.Tensor, labels: torch.Tensor, label_height_mask: torch.Tensor):
+    """
+    Teacher-forced training loss with the pair scoring of all heights in one batched pass.
+    Under teacher forcing the state of the next height only depends on the gold step, so a cheap sequential pass
+    computes the variable states of every height from the gold pairs, and the (height, instance) entries with a gold step
+    are then scored together, padded to the number of variables of the last height.
+    :param var_hidden_states: (batch_size, max_num_variable, hidden_size), constants included
+    :param num_variables: (batch_size), constants included
+    """
+    batch_size, max_num_variable, hidden_size = var_hidden_states.size()
+    _, max_height, _ = labels.size()
+    ## sequential state pass, gold pairs only
+    height_var_hidden_states = [var_hidden_states]
+    for i in range(max_height - 1):
+        gold_label_rep = get_gold_label_rep(cls, height_var_hidden_states[-1], labels[:, i, :])
+        height_var_hidden_states.append(update_var_hidden_states(cls, height_var_hidden_states[-1], gold_label_rep))
+
+    ## batched scoring pass over the (height, instance) entries with a gold step
+    num_vars = max_num_variable + max_height - 1
+    padded_var_hidden_states = torch.stack([nn.functional.pad(states, (0, 0, 0, num_vars - states.size(1))) for states in height_var_hidden_states], dim=0)
+    height_num_variables = num_variables.unsqueeze(0) + torch.arange(max_height, device=num_variables.device).unsqueeze(1)  ## max_height x batch_size
+    valid = label_height_mask.transpose(0, 1).reshape(-1).nonzero().squeeze(-1)  ## indices into the flattened max_height x batch_size
+    combination = get_combination(num_vars, device=var_hidden_states.device)
+    batched_combination_mask = get_batched_combination_mask(height_num_variables.view(-1)[valid], num_vars)
+    combined_logits, _ = score_pairs(cls, padded_var_hidden_states.view(max_height * batch_size, num_vars, hidden_size)[valid], combination, batched_combination_mask)
+
+    num_valid = valid.size(0)
+    best_score, _ = combined_logits.view(num_valid, -1).max(dim=-1)
+    gold_labels = labels.transpose(0, 1).reshape(max_height * batch_size, 4)[valid]
+    gold_index = pair_to_index(gold_labels[:, 0], gold_labels[:, 1], num_vars)
+    gold_score = combined_logits[torch.arange(num_valid, device=valid.device), gold_index, gold_labels[:, 2], gold_labels[:, 3]]
+    loss = (best_score - gold_score).sum()
+
+    ## logits of each height over its own combinations, as in the sequential loop
+    full_combined_logits = combined_logits.new_full((max_height * batch_size,) + combined_logits.size()[1:], float("-inf"))
+    full_combined_logits[valid] = combined_logits
+    full_combined_logits = full_combined_logits.view(max_height, batch_size, *combined_logits.size()[1:])
+    all_logits = []
+    for i in range(max_height):
+        height_combination = get_combination(max_num_variable + i, device=var_hidden_states.device)
+        all_logits.append(full_combined_logits[i][:, pair_to_index(height_combination[:, 0], height_combination[:, 1], num_vars)])
+    return UniversalOutput(loss=loss, all_logits=all_logits)
+
+
+def teacher_forced_height_step(cls, var_hidden_states: torch.Tensor, combination: torch.Tensor, batched_combination_mask: torch.Tensor,
+                               gold_comb: torch.Tensor, gold_label: torch.Tensor, use_constant_cache: bool):
+    """
+    The pair scoring of one height in training, returning only what the rest of the loop needs,
+    so that it can be checkpointed without keeping the (batch_size, num_combinations, num_labels, hidden_size) activations.
+    :param gold_comb: (batch_size) the flat index of the gold pair
+    :param gold_label: (batch_size)
+    :return: combined_logits: (batch_size, num_combinations, num_labels, 2), gold_label_rep: (batch_size, hidden_size)
+    """
+    if use_constant_cache:
+        combined_logits, label_rep = score_pairs_with_constant_cache(cls, var_hidden_states, combination, batched_combination_mask)
+    else:
+        combined_logits, label_rep = score_pairs(cls, var_hidden_states, combination, batched_combination_mask)
+    b_idxs = torch.arange(var_hidden_states.size(0), device=var_hidden_states.device)
+    return combined_logits, label_rep[b_idxs, gold_comb, gold_label]
+
+
+def select_label_rep(label_rep_chunks: List[torch.Tensor], b_idxs: torch.Tensor, comb: torch.Tensor, label: torch.Tensor):
+    """
+    Gather the label representation of one (combination, label) per instance, where the combinations are split
+    into consecutive chunks (the incremental scoring keeps the label representations of every height).
+    :param label_rep_chunks: list of (batch_size, num_chunk_combinations, num_labels, hidden_size)
+    :param comb: (batch_size) flat combination indices over the concatenated chunks
+    :param label: (batch_size)
+    :return: (batch_size, hidden_size)
+    """
+    if len(label_rep_chunks) == 1:
+        return label_rep_chunks[0][b_idxs, comb, label]
+    selected = None
+    offset = 0
+    for label_rep in label_rep_chunks:
+        num_chunk_combinations = label_rep.size(1)
+        chunk_selected = label_rep[b_idxs, (comb - offset).clamp(0, num_chunk_combinations - 1), label]
+        in_chunk = ((comb >= offset) & (comb < offset + num_chunk_combinations)).unsqueeze(-1)
+        selected = chunk_selected if selected is None else torch.where(in_chunk, chunk_selected, selected)
+        offset += num_chunk_combinations
+    return selected
+
+
+def keep_active_rows(keep: torch.Tensor, active_rows: Optional[torch.Tensor], *batched_tensors: torch.Tensor):
+    """
+    Select the rows `keep` of the per-instance tensors of the loop.
+    :param keep: (num_kept) indices into the current rows
+    :param active_rows: (current_batch_size) indices of the current rows in the original batch, None if no row was dropped yet
+    :return: the updated active rows, followed by the selected tensors
+    """
+    active_rows = keep if active_rows is None else active_rows[keep]
+    return (active_rows,) + tuple(tensor[keep] for tensor in batched_tensors)
+
+
 def deductive_forward(cls,
         encoder,
         input_ids=None, ## batch_size  x max_seq_length
@@ -58,7 +472,10 @@ def deductive_forward(cls,
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
-        is_eval=False):
+        is_eval=False,
+        return_all_logits=True, ## the logits of all (pair, label, stop) of each height, the inference predictions do not need them
+        num_top_scores=0,
+        var_hidden_states: torch.Tensor = None): ## batch_size x num_variable x hidden_size, precomputed variable states (e.g., the encoder output cache), the encoder is skipped
     r"""
     labels (:obj:`torch.LongTensor` of shape :obj:`(batch_size,)`, `optional`):
         Labels for computing the sequence classification/regression loss. Indices should be in :obj:`[0, ...,
@@ -66,6 +483,17 @@ def deductive_forward(cls,
         If :obj:`config.num_labels > 1` a classification loss is computed (Cross-Entropy).
     """
     return_dict = return_dict if return_dict is not None else cls.config.use_return_dict
+    if var_hidden_states is not None:
+        ## the cached states are the start (+ end) states: gathered at their own positions, with no end states added
+        batch_size, max_num_variable, _ = var_hidden_states.size()
+        variable_positions = torch.arange(max_num_variable, device=var_hidden_states.device).unsqueeze(0).expand(batch_size, max_num_variable)
+        return deductive_head(cls, var_hidden_states, variable_positions, variable_positions, num_variables, variable_index_mask,
+                              labels, label_height_mask, is_eval, return_all_logits, num_top_scores)
+    if cls.exit_thresholds is not None and (labels is None or is_eval):
+        return adaptive_exit_forward(cls, encoder, input_ids, attention_mask, token_type_ids, position_ids, variable_indexs_start, variable_indexs_end,
+                                     num_variables, variable_index_mask, num_top_scores)
+    ## in training, the intermediate layers of the exit heads are kept for their auxiliary losses
+    train_exits = len(cls.exit_layers) > 0 and labels is not None and not is_eval
     outputs = encoder(  # batch_size, sent_len, hidden_size,
         input_ids,
         attention_mask=attention_mask,
@@ -74,28 +502,55 @@ def deductive_forward(cls,
         head_mask=head_mask,
         inputs_embeds=inputs_embeds,
         output_attentions=output_attentions,
-        output_hidden_states=output_hidden_states,
+        output_hidden_states=output_hidden_states or train_exits,
         return_dict=return_dict,
     )
-    batch_size, sent_len, hidden_size = outputs.last_hidden_state.size()
-    if labels is not None and not is_eval:
-        # is_train
-        _, max_height, _ = labels.size()
-    else:
-        max_height = cls.max_height
+    result = deductive_head(cls, outputs.last_hidden_state, variable_indexs_start, variable_indexs_end, num_variables, variable_index_mask,
+                            labels, label_height_mask, is_eval, return_all_logits, num_top_scores)
+    if train_exits:
+        for exit_layer, exit_adapter in zip(cls.exit_layers, cls.exit_adapters):
+            result.loss = result.loss + deductive_head(cls, exit_adapter(outputs.hidden_states[exit_layer]), variable_indexs_start, variable_indexs_end,
+                                                       num_variables, variable_index_mask, labels, label_height_mask, is_eval).loss
+    if output_hidden_states:
+        result.hidden_states = outputs.hidden_states
+    return result
 
-    _, max_num_variable = variable_indexs_start.size()
 
+def get_initial_var_hidden_states(cls, last_hidden_state: torch.Tensor, variable_indexs_start: torch.Tensor, variable_indexs_end: torch.Tensor):
+    """
+    :return: var_hidden_states: (batch_size, constant_num + num_variables, hidden_size) the constants first
+    """
+    batch_size, sent_len, hidden_size = last_hidden_state.size()
+    _, max_num_variable = variable_indexs_start.size()
     var_sum = (variable_indexs_start - variable_indexs_end).sum()  ## if add <NUM>, we can just choose one as hidden_states
-    var_start_hidden_states = torch.gather(outputs.last_hidden_state, 1, variable_indexs_start.unsqueeze(-1).expand(batch_size, max_num_variable, hidden_size))
+    var_start_hidden_states = torch.gather(last_hidden_state, 1, variable_indexs_start.unsqueeze(-1).expand(batch_size, max_num_variable, hidden_size))
     if var_sum != 0:
-        var_end_hidden_states = torch.gather(outputs.last_hidden_state, 1, variable_indexs_end.unsqueeze(-1).expand(batch_size, max_num_variable, hidden_size))
+        var_end_hidden_states = torch.gather(last_hidden_state, 1, variable_indexs_end.unsqueeze(-1).expand(batch_size, max_num_variable, hidden_size))
         var_hidden_states = var_start_hidden_states + var_end_hidden_states
     else:
         var_hidden_states = var_start_hidden_states
     if cls.constant_num > 0:
         constant_hidden_states = cls.const_rep.unsqueeze(0).expand(batch_size, cls.constant_num, hidden_size)
         var_hidden_states = torch.cat([constant_hidden_states, var_hidden_states], dim=1)
+    return var_hidden_states
+
+
+def deductive_head(cls, last_hidden_state: torch.Tensor, variable_indexs_start: torch.Tensor, variable_indexs_end: torch.Tensor,
+                   num_variables: torch.Tensor, variable_index_mask: torch.Tensor, labels=None, label_height_mask=None, is_eval=False,
+                   return_all_logits=True, num_top_scores=0):
+    """
+    The deductive steps of `deductive_forward` on the encoder output.
+    """
+    batch_size, sent_len, hidden_size = last_hidden_state.size()
+    if labels is not None and not is_eval:
+        # is_train
+        _, max_height, _ = labels.size()
+    else:
+        max_height = cls.max_height
+
+    _, max_num_variable = variable_indexs_start.size()
+    var_hidden_states = get_initial_var_hidden_states(cls, last_hidden_state, variable_indexs_start, variable_indexs_end)
+    if cls.constant_num > 0:
         num_variables = num_variables + cls.constant_num
         max_num_variable = max_num_variable + cls.constant_num
         const_idx_mask = torch.ones((batch_size, cls.constant_num), device=variable_indexs_start.device)
@@ -104,152 +559,258 @@ def deductive_forward(cls,
         # updated_all_states, _ = self.multihead_attention(var_hidden_states, var_hidden_states, var_hidden_states,key_padding_mask=variable_index_mask)
         # var_hidden_states = torch.cat([updated_all_states[:, :2, :], var_hidden_states[:, 2:, :]], dim=1)
 
+    ## in training, only the gold pair and sampled negative pairs are scored (except in the periodic full-scoring epochs)
+    sampled_training = cls.sampled_negatives > 0 and cls.sampled_objective_enabled and labels is not None and not is_eval
+    if labels is not None and not is_eval and cls.height_parallel and not sampled_training:
+        return height_parallel_forward(cls, var_hidden_states, num_variables, labels, label_height_mask)
+
     best_mi_label_rep = None
     loss = 0
     all_logits = []
-    best_mi_scores = None
+    predictions = []
+    top_scores = []
+    b_idxs = torch.arange(batch_size, device=variable_indexs_start.device)
+    active_rows = None  ## the instances still decoded when finished instances are dropped (`cls.eval_early_exit`, `cls.train_compaction`)
+    ## in inference, only the top-k pairs of the first-stage scores are scored
+    pruned_scoring = cls.pair_top_k > 0 and (labels is None or is_eval)
+    ## in inference, the pairs are scored in chunks and only the best label representation is kept
+    chunked_scoring = cls.pair_chunk_size > 0 and (labels is None or is_eval) and not pruned_scoring
+    ## only the pairs with the new intermediate are scored at each height (inference without variable update)
+    incremental_scoring = cls.incremental_scoring and cls.var_update_mode == -1 and (labels is None or is_eval) and not chunked_scoring and not pruned_scoring
+    ## the scoring functions above directly return the best (pair, label, stop) and its label representation
+    direct_best = chunked_scoring or pruned_scoring
+    ## in training, the pair scoring of each height is recomputed in backward
+    checkpoint_heights = cls.activation_checkpointing and labels is not None and not is_eval and torch.is_grad_enabled() and not sampled_training
+    gold_heights = None
+    if labels is not None and not is_eval and cls.train_compaction:
+        ## a single host sync for the whole loop: the number of gold steps of each instance
+        gold_heights = label_height_mask.sum(dim=-1).tolist()
+        active_row_list = list(range(batch_size))
 
     for i in range(max_height):
-        linear_modules = cls.linears
-        if i == 0:
-            ## max_num_variable = 4. -> [0,1,2,3]
-            num_var_range = torch.arange(0, max_num_variable, device=variable_indexs_start.device)
-            ## 6x2 matrix
-            combination = torch.combinations(num_var_range, r=2, with_replacement=True)  ##number_of_combinations x 2
-            num_combinations, _ = combination.size()  # number_of_combinations x 2
-            # batch_size x num_combinations. 2*6
-            batched_combination_mask = get_combination_mask(batched_num_variables=num_variables, combination=combination)  # batch_size, num_combinations
-
-            var_comb_hidden_states = torch.gather(var_hidden_states, 1,
-                                                  combination.view(-1).unsqueeze(0).unsqueeze(-1).expand(batch_size, num_combinations * 2, hidden_size))
-            # m0_hidden_states = var_comb_hidden_states.unsqueeze(-2).view(batch_size, num_combinations, 2, hidden_size * 3).sum(dim=-2)
-            expanded_var_comb_hidden_states = var_comb_hidden_states.unsqueeze(-2).view(batch_size, num_combinations, 2, hidden_size)
-            m0_hidden_states = torch.cat([expanded_var_comb_hidden_states[:, :, 0, :], expanded_var_comb_hidden_states[:, :, 1, :],
-                                          expanded_var_comb_hidden_states[:, :, 0, :] * expanded_var_comb_hidden_states[:, :, 1, :]], dim=-1)
-            # batch_size, num_combinations/num_m0, hidden_size: 2,6,768
-
-            ## batch_size, num_combinations/num_m0, num_labels, hidden_size
-            m0_label_rep = torch.stack([layer(m0_hidden_states) for layer in linear_modules], dim=2)
-            ## batch_size, num_combinations/num_m0, num_labels
-            m0_logits = cls.label_rep2label(m0_label_rep).expand(batch_size, num_combinations, cls.num_labels, 2)
-            m0_logits = m0_logits + batched_combination_mask.unsqueeze(-1).unsqueeze(-1).expand(batch_size, num_combinations, cls.num_labels, 2).float().log()
-            ## batch_size, num_combinations/num_m0, num_labels, 2
-            m0_stopper_logits = cls.stopper(cls.stopper_transformation(m0_label_rep))
-
-            var_scores = cls.variable_scorer(var_hidden_states).squeeze(-1)  ## batch_size x max_num_variable
-            expanded_var_scores = torch.gather(var_scores, 1, combination.unsqueeze(0).expand(batch_size, num_combinations, 2).view(batch_size, -1)).unsqueeze(
-                -1).view(batch_size, num_combinations, 2)
-            expanded_var_scores = expanded_var_scores.sum(dim=-1).unsqueeze(-1).unsqueeze(-1).expand(batch_size, num_combinations, cls.num_labels, 2)
-
-            ## batch_size, num_combinations/num_m0, num_labels, 2
-            m0_combined_logits = m0_logits + m0_stopper_logits + expanded_var_scores
-
-            all_logits.append(m0_combined_logits)
-            best_temp_logits, best_stop_label = m0_combined_logits.max(dim=-1)  ## batch_size, num_combinations/num_m0, num_labels
-            best_temp_score, best_temp_label = best_temp_logits.max(dim=-1)  ## batch_size, num_combinations
-            best_m0_score, best_comb = best_temp_score.max(dim=-1)  ## batch_size
-            best_label = torch.gather(best_temp_label, 1, best_comb.unsqueeze(-1)).squeeze(-1)  ## batch_size
-
-            b_idxs = [k for k in range(batch_size)]
-            # best_m0_label_rep = m0_label_rep[b_idxs, best_comb, best_label] # batch_size x hidden_size
-            # best_mi_label_rep = best_m0_label_rep
-            ## NOTE: add loosss
-            if labels is not None and not is_eval:
-                m0_gold_labels = labels[:, i, :]  ## batch_size x 4 (left_var_index, right_var_index, label_index, stop_id)
-                m0_gold_comb = m0_gold_labels[:, :2].unsqueeze(1).expand(batch_size, num_combinations, 2)
-                batched_comb = combination.unsqueeze(0).expand(batch_size, num_combinations, 2)
-                judge = m0_gold_comb == batched_comb
-                judge = judge[:, :, 0] * judge[:, :, 1]  # batch_size, num_combinations
-                judge = judge.nonzero()[:, 1]  # batch_size
-
-                m0_gold_scores = m0_combined_logits[b_idxs, judge, m0_gold_labels[:, 2], m0_gold_labels[:, 3]]  ## batch_size
-                loss = loss + (best_m0_score - m0_gold_scores).sum()
-
-                best_mi_label_rep = m0_label_rep[b_idxs, judge, m0_gold_labels[:, 2]]  ## teacher-forcing.
-                best_mi_scores = m0_logits[b_idxs, judge, m0_gold_labels[:, 2]][:, 0]  # batch_size
-            else:
-                best_m0_label_rep = m0_label_rep[b_idxs, best_comb, best_label]  # batch_size x hidden_size
-                best_mi_label_rep = best_m0_label_rep
-                best_mi_scores = m0_logits[b_idxs, best_comb, best_label][:, 0]  # batch_size
+        if gold_heights is not None and i > 0:
+            ## the instances without gold step at this height only contribute zero (masked) loss
+            keep_list = [k for k, row in enumerate(active_row_list) if gold_heights[row] > i]
+            if len(keep_list) < len(active_row_list):
+                keep = torch.tensor(keep_list, dtype=torch.long, device=variable_indexs_start.device)
+                active_row_list = [active_row_list[k] for k in keep_list]
+                active_rows, var_hidden_states, num_variables, best_mi_label_rep = keep_active_rows(keep, active_rows, var_hidden_states,
+                                                                                                  num_variables, best_mi_label_rep)
+                b_idxs = b_idxs[:len(keep_list)]
+        if i > 0:
+            var_hidden_states = update_var_hidden_states(cls, var_hidden_states, best_mi_label_rep) ## batch_size x (num_var + i) x hidden_size
+        ## max_num_variable = 4. -> 10x2 matrix [[0,0], [0,1], ..., [3,3]]
+        combination = get_combination(max_num_variable + i, device=variable_indexs_start.device)  ##number_of_combinations x 2
+        # batch_size x num_combinations. 2*6
+        batched_combination_mask = get_batched_combination_mask(num_variables + i, max_num_variable + i)
+        if labels is not None and not is_eval:
+            mi_gold_labels = labels[:, i, :] if active_rows is None else labels[active_rows, i, :]  ## batch_size x 4 (left_var_index, right_var_index, label_index, stop_id)
+            judge = pair_to_index(mi_gold_labels[:, 0], mi_gold_labels[:, 1], max_num_variable + i)  # batch_size
+        if sampled_training:
+            mi_combined_logits, gold_label_reps = score_sampled_pairs(cls, var_hidden_states, combination, batched_combination_mask, judge,
+                                                                      cls.sampled_negatives, cls.negative_source)
+            gold_label_rep = gold_label_reps[b_idxs, mi_gold_labels[:, 2]]
+        elif checkpoint_heights:
+            use_constant_cache = i == 0 and cls.constant_num > 0 and cls.constant_pair_cache
+            mi_combined_logits, gold_label_rep = torch.utils.checkpoint.checkpoint(teacher_forced_height_step, cls, var_hidden_states, combination,
+                                                                                   batched_combination_mask, judge, mi_gold_labels[:, 2],
+                                                                                   use_constant_cache, use_reentrant=False)
+        elif pruned_scoring:
+            mi_combined_logits, best_mi_score, best_comb, best_label, best_stop, best_mi_label_rep = score_top_k_pairs(cls, var_hidden_states, combination,
+                                                                                                                     batched_combination_mask, cls.pair_top_k)
+        elif chunked_scoring:
+            mi_combined_logits, best_mi_score, best_comb, best_label, best_stop, best_mi_label_rep = score_pairs_chunked(cls, var_hidden_states, combination,
+                                                                                                                       batched_combination_mask, cls.pair_chunk_size)
+        elif incremental_scoring and i > 0:
+            ## the variable states never change, so apart from the pairs (0, r) with the new intermediate m_i (prepended at index 0),
+            ## the pairs are the pairs of the previous height shifted by one, in the same order and with the same scores
+            num_new_combinations = max_num_variable + i
+            new_combined_logits, new_label_rep = score_pairs(cls, var_hidden_states, combination[:num_new_combinations], batched_combination_mask[:, :num_new_combinations])
+            mi_combined_logits = torch.cat([new_combined_logits, mi_combined_logits], dim=1)
+            label_rep_chunks = [new_label_rep] + label_rep_chunks
         else:
-            if cls.var_update_mode == 0:
-                ## update hidden_state (gated hidden state)
-                init_h = best_mi_label_rep.unsqueeze(1).expand(batch_size, max_num_variable + i - 1, hidden_size).contiguous().view(-1, hidden_size)
-                gru_inputs = var_hidden_states.view(-1, hidden_size)
-                var_hidden_states = cls.variable_gru(gru_inputs, init_h).view(batch_size, max_num_variable + i - 1, hidden_size)
-            elif cls.var_update_mode == 1:
-                temp_states = torch.cat([best_mi_label_rep.unsqueeze(1), var_hidden_states], dim=1)  ## batch_size x (num_var + i) x hidden_size
-                temp_mask = torch.eye(max_num_variable + i, device=variable_indexs_start.device)
-                temp_mask[:, 0] = 1
-                temp_mask[0, :] = 1
-                updated_all_states, _ = cls.variable_gru(temp_states, temp_states, temp_states, attn_mask=1 - temp_mask)
-                var_hidden_states = updated_all_states[:, 1:, :]
-
-            num_var_range = torch.arange(0, max_num_variable + i, device=variable_indexs_start.device)
-            ## 6x2 matrix
-            combination = torch.combinations(num_var_range, r=2, with_replacement=True)  ##number_of_combinations x 2
-            num_combinations, _ = combination.size()  # number_of_combinations x 2
-            batched_combination_mask = get_combination_mask(batched_num_variables=num_variables + i, combination=combination)
-
-            var_hidden_states = torch.cat([best_mi_label_rep.unsqueeze(1), var_hidden_states], dim=1)  ## batch_size x (num_var + i) x hidden_size
-            var_comb_hidden_states = torch.gather(var_hidden_states, 1,
-                                                  combination.view(-1).unsqueeze(0).unsqueeze(-1).expand(batch_size, num_combinations * 2, hidden_size))
-            expanded_var_comb_hidden_states = var_comb_hidden_states.unsqueeze(-2).view(batch_size, num_combinations, 2, hidden_size)
-            mi_hidden_states = torch.cat([expanded_var_comb_hidden_states[:, :, 0, :], expanded_var_comb_hidden_states[:, :, 1, :],
-                                          expanded_var_comb_hidden_states[:, :, 0, :] * expanded_var_comb_hidden_states[:, :, 1, :]], dim=-1)
-            mi_label_rep = torch.stack([layer(mi_hidden_states) for layer in linear_modules], dim=2)
-            mi_logits = cls.label_rep2label(mi_label_rep).expand(batch_size, num_combinations, cls.num_labels, 2)
-            mi_logits = mi_logits + batched_combination_mask.unsqueeze(-1).unsqueeze(-1).expand(batch_size, num_combinations, cls.num_labels,
-                                                                                                2).float().log()
-
-            mi_stopper_logits = cls.stopper(cls.stopper_transformation(mi_label_rep))
-            var_scores = cls.variable_scorer(var_hidden_states).squeeze(-1)  ## batch_size x max_num_variable
-            expanded_var_scores = torch.gather(var_scores, 1,
-                                               combination.unsqueeze(0).expand(batch_size, num_combinations, 2).view(batch_size, -1)).unsqueeze(-1).view(
-                batch_size, num_combinations, 2)
-            expanded_var_scores = expanded_var_scores.sum(dim=-1).unsqueeze(-1).unsqueeze(-1).expand(batch_size, num_combinations, cls.num_labels, 2)
-
-            mi_combined_logits = mi_logits + mi_stopper_logits + expanded_var_scores
+            if i == 0 and cls.constant_num > 0 and cls.constant_pair_cache:
+                ## the constant-constant pairs are the same for all instances at height 0
+                mi_combined_logits, mi_label_rep = score_pairs_with_constant_cache(cls, var_hidden_states, combination, batched_combination_mask)
+            else:
+                ## batch_size, num_combinations/num_m0, num_labels, 2
+                mi_combined_logits, mi_label_rep = score_pairs(cls, var_hidden_states, combination, batched_combination_mask)
+            label_rep_chunks = [mi_label_rep]
+        if return_all_logits and active_rows is not None:
+            ## keep the logits of the whole batch, the finished instances have no valid pair anymore
+            full_combined_logits = mi_combined_logits.new_full((batch_size,) + mi_combined_logits.size()[1:], float("-inf"))
+            full_combined_logits[active_rows] = mi_combined_logits
+            all_logits.append(full_combined_logits)
+        elif return_all_logits:
             all_logits.append(mi_combined_logits)
+        if not direct_best:
             best_temp_logits, best_stop_label = mi_combined_logits.max(dim=-1)  ## batch_size, num_combinations/num_m0, num_labels
             best_temp_score, best_temp_label = best_temp_logits.max(dim=-1)  ## batch_size, num_combinations
             best_mi_score, best_comb = best_temp_score.max(dim=-1)  ## batch_size
             best_label = torch.gather(best_temp_label, 1, best_comb.unsqueeze(-1)).squeeze(-1)  ## batch_size
 
-            ## NOTE: add loosss
-            if labels is not None and not is_eval:
-                mi_gold_labels = labels[:, i, :]  ## batch_size x 4 (left_var_index, right_var_index, label_index, stop_id)
-                mi_gold_comb = mi_gold_labels[:, :2].unsqueeze(1).expand(batch_size, num_combinations, 2)
-                batched_comb = combination.unsqueeze(0).expand(batch_size, num_combinations, 2)
-                judge = mi_gold_comb == batched_comb
-                judge = judge[:, :, 0] * judge[:, :, 1]  # batch_size, num_combinations
-                judge = judge.nonzero()[:, 1]  # batch_size
-
-                mi_gold_scores = mi_combined_logits[b_idxs, judge, mi_gold_labels[:, 2], mi_gold_labels[:, 3]]  ## batch_size
-                height_mask = label_height_mask[:, i]  ## batch_size
-                current_loss = (best_mi_score - mi_gold_scores) * height_mask  ## avoid compute loss for unnecessary height
-                loss = loss + current_loss.sum()
-                best_mi_label_rep = mi_label_rep[b_idxs, judge, mi_gold_labels[:, 2]]  ## teacher-forcing.
-                best_mi_scores = mi_logits[b_idxs, judge, mi_gold_labels[:, 2]][:, 0]  # batch_size
+        ## NOTE: add loosss
+        if labels is not None and not is_eval:
+            mi_gold_scores = mi_combined_logits[b_idxs, judge, mi_gold_labels[:, 2], mi_gold_labels[:, 3]]  ## batch_size
+            height_mask = label_height_mask[:, i] if active_rows is None else label_height_mask[active_rows, i]  ## batch_size
+            current_loss = (best_mi_score - mi_gold_scores) * height_mask  ## avoid compute loss for unnecessary height
+            loss = loss + current_loss.sum()
+            if checkpoint_heights or sampled_training:
+                best_mi_label_rep = gold_label_rep  ## teacher-forcing.
             else:
-                best_mi_label_rep = mi_label_rep[b_idxs, best_comb, best_label]  # batch_size x hidden_size
-                best_mi_scores = mi_logits[b_idxs, best_comb, best_label][:, 0]
+                best_mi_label_rep = select_label_rep(label_rep_chunks, b_idxs, judge, mi_gold_labels[:, 2])  ## teacher-forcing.
+        else:
+            if not direct_best:
+                best_mi_label_rep = select_label_rep(label_rep_chunks, b_idxs, best_comb, best_label)  # batch_size x hidden_size
+                best_stop = best_stop_label[b_idxs, best_comb, best_label]  ## batch_size
+            ## batch_size x 4 (left_var_index, right_var_index, label_index, stop_id), zeros for the finished instances
+            mi_predictions = torch.cat([index_to_pair(best_comb, max_num_variable + i), best_label.unsqueeze(-1), best_stop.unsqueeze(-1)], dim=-1)
+            predictions.append(mi_predictions if active_rows is None else mi_predictions.new_zeros((batch_size, 4)).index_copy(0, active_rows, mi_predictions))
+            if num_top_scores > 0:
+                mi_top_scores = mi_combined_logits.view(b_idxs.size(0), -1)
+                ## fewer candidates than num_top_scores (first heights of small problems) are padded with -inf
+                mi_top_scores = mi_top_scores.topk(min(num_top_scores, mi_top_scores.size(1)), dim=-1).values
+                mi_top_scores = torch.nn.functional.pad(mi_top_scores, (0, num_top_scores - mi_top_scores.size(1)), value=float("-inf"))
+                top_scores.append(mi_top_scores if active_rows is None else
+                                  mi_top_scores.new_full((batch_size, num_top_scores), float("-inf")).index_copy(0, active_rows, mi_top_scores))
+            if cls.eval_early_exit:
+                ## the steps after the first stop label are thrown away by the decoder, so finished instances are dropped
+                still_active = best_stop == 0  ## batch_size
+                num_active = int(still_active.sum())
+                if num_active == 0:
+                    break
+                if num_active < b_idxs.size(0):
+                    keep = still_active.nonzero().squeeze(-1)
+                    active_rows, var_hidden_states, num_variables, best_mi_label_rep = keep_active_rows(keep, active_rows, var_hidden_states,
+                                                                                                      num_variables, best_mi_label_rep)
+                    b_idxs = b_idxs[:num_active]
+                    if incremental_scoring:
+                        mi_combined_logits = mi_combined_logits[keep]
+                        label_rep_chunks = [label_rep[keep] for label_rep in label_rep_chunks]
 
-    return UniversalOutput(loss=loss, all_logits=all_logits)
+    return UniversalOutput(loss=loss, all_logits=all_logits if return_all_logits else None,
+                           predictions=torch.stack(predictions, dim=1) if len(predictions) > 0 else None,
+                           top_scores=torch.stack(top_scores, dim=1) if len(top_scores) > 0 else None)
+
+
+def get_first_step_margin(cls, last_hidden_state: torch.Tensor, variable_indexs_start: torch.Tensor, variable_indexs_end: torch.Tensor,
+                          num_variables: torch.Tensor):
+    """
+    The confidence of the first deductive step on the encoder output.
+    :return: margin: (batch_size) the score difference of the two best (pair, label, stop) at height 0,
+             best: (batch_size) the flat index of the best (pair, label, stop)
+    """
+    var_hidden_states = get_initial_var_hidden_states(cls, last_hidden_state, variable_indexs_start, variable_indexs_end)
+    combination = get_combination(var_hidden_states.size(1), device=var_hidden_states.device)
+    batched_combination_mask = get_batched_combination_mask(num_variables + cls.constant_num, var_hidden_states.size(1))
+    combined_logits, _ = score_pairs(cls, var_hidden_states, combination, batched_combination_mask)
+    top_scores, top_candidates = combined_logits.view(combined_logits.size(0), -1).topk(2, dim=-1)
+    return top_scores[:, 0] - top_scores[:, 1], top_candidates[:, 0]
+
+
+def adaptive_exit_forward(cls, encoder, input_ids: torch.Tensor, attention_mask: torch.Tensor, token_type_ids: torch.Tensor, position_ids,
+                          variable_indexs_start: torch.Tensor, variable_indexs_end: torch.Tensor, num_variables: torch.Tensor,
+                          variable_index_mask: torch.Tensor, num_top_scores: int = 0):
+    """
+    Inference with early exit inside the encoder: the encoder layers are run one at a time, and at each exit layer the instances
+    whose first-step margin (`get_first_step_margin` with the exit head) reaches the threshold of the exit are decoded from that layer
+    and dropped from the batch. The other instances go through the next layers, up to the last one.
+    :return: predictions, top_scores as `deductive_forward` (no all_logits),
+             exit_layers: (batch_size) the encoder layer each instance is decoded from
+    """
+    batch_size = input_ids.size(0)
+    layers = encoder.encoder.layer
+    exits = {exit_layer: (exit_adapter, threshold) for exit_layer, exit_adapter, threshold in zip(cls.exit_layers, cls.exit_adapters, cls.exit_thresholds)}
+    hidden_states = encoder.embeddings(input_ids=input_ids, position_ids=position_ids, token_type_ids=token_type_ids)
+    extended_attention_mask = encoder.get_extended_attention_mask(attention_mask, input_ids.size())
+    active_rows = torch.arange(batch_size, device=input_ids.device)
+    exit_layers = torch.full((batch_size,), len(layers), dtype=torch.long, device=input_ids.device)
+    decoded = []  ## (rows, output) of each group of instances decoded from the same layer
+    for layer_idx, layer in enumerate(layers, 1):
+        hidden_states = layer(hidden_states, attention_mask=extended_attention_mask)[0]
+        if layer_idx == len(layers):
+            exiting = torch.ones_like(active_rows, dtype=torch.bool)
+            exit_hidden_states = hidden_states
+        elif layer_idx in exits:
+            exit_adapter, threshold = exits[layer_idx]
+            exit_hidden_states = exit_adapter(hidden_states)
+            margin, _ = get_first_step_margin(cls, exit_hidden_states, variable_indexs_start[active_rows], variable_indexs_end[active_rows],
+                                              num_variables[active_rows])
+            exiting = margin >= threshold
+        else:
+            continue
+        num_exiting = int(exiting.sum())
+        if num_exiting > 0:
+            rows = active_rows[exiting]
+            decoded.append((rows, deductive_head(cls, exit_hidden_states[exiting], variable_indexs_start[rows], variable_indexs_end[rows],
+                                                 num_variables[rows], variable_index_mask[rows], is_eval=True, return_all_logits=False,
+                                                 num_top_scores=num_top_scores)))
+            exit_layers[rows] = layer_idx
+        if num_exiting == active_rows.size(0):
+            break
+        hidden_states, extended_attention_mask, active_rows = hidden_states[~exiting], extended_attention_mask[~exiting], active_rows[~exiting]
+    ## the groups may decode different numbers of heights, the missing steps are zeros (as the finished instances of `eval_early_exit`)
+    num_heights = max(output.predictions.size(1) for _, output in decoded)
+    predictions = torch.zeros((batch_size, num_heights, 4), dtype=torch.long, device=input_ids.device)
+    top_scores = torch.full((batch_size, num_heights, num_top_scores), float("-inf"), device=input_ids.device) if num_top_scores > 0 else None
+    for rows, output in decoded:
+        predictions[rows, :output.predictions.size(1)] = output.predictions
+        if top_scores is not None:
+            top_scores[rows, :output.top_scores.size(1)] = output.top_scores
+    return UniversalOutput(predictions=predictions, top_scores=top_scores, exit_layers=exit_layers)
+
+
+def check_star_attention_hook(star_attention: bool, trained_star_attention: bool, state_dict, prefix, *args):
+    """
+    `load_state_dict` pre-hook of the attn variable update: the star attention update computes something else than the full
+    attention update with the same parameters, so the outputs change if a trained update is loaded with the other one.
+    """
+    if f"{prefix}variable_gru.in_proj_weight" in state_dict and star_attention != trained_star_attention:
+        logger.warning(f"The attention variable update of the checkpoint was trained {'with' if trained_star_attention else 'without'} "
+                       f"star attention but is loaded {'with' if star_attention else 'without'} it, the outputs differ from the trained model")
 
 
-def initialize_param(cls, config, constant_num, height, var_update_mode):
+def initialize_param(cls, config, constant_num, height, var_update_mode, factorized_projection: bool = False, fused_operators: bool = False,
+                     constant_pair_cache: bool = False, eval_early_exit: bool = False, train_compaction: bool = False,
+                     height_parallel: bool = False, incremental_scoring: bool = False, star_attention: bool = False, pair_chunk_size: int = 0,
+                     activation_checkpointing: bool = False, pair_top_k: int = 0, sampled_negatives: int = 0,
+                     negative_source: str = "scorer", exit_layers: List[int] = None):
 
     cls.label_rep2label = nn.Linear(config.hidden_size, 1)  # 0 or 1
     cls.max_height = height  ## 3 operation
-    cls.linears = nn.ModuleList()
-    for i in range(cls.num_labels):
-        cls.linears.append(nn.Sequential(
-            nn.Linear(3 * config.hidden_size, config.hidden_size),
-            nn.ReLU(),
-            nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps),
-            nn.Dropout(config.hidden_dropout_prob)
-        ))
+    cls.eval_early_exit = eval_early_exit
+    cls.train_compaction = train_compaction
+    cls.height_parallel = height_parallel
+    cls.incremental_scoring = incremental_scoring
+    cls.star_attention = star_attention
+    ## saved with the config of the checkpoint (absent: trained without star attention), not named `star_attention`
+    ## because `from_pretrained` would then set the config attribute instead of passing the argument to the model
+    trained_star_attention = getattr(config, "trained_star_attention", False)
+    config.trained_star_attention = star_attention
+    cls.pair_chunk_size = pair_chunk_size
+    cls.activation_checkpointing = activation_checkpointing
+    cls.pair_top_k = pair_top_k
+    cls.sampled_negatives = sampled_negatives
+    cls.negative_source = negative_source
+    cls.exit_layers = exit_layers or []
+    cls.sampled_objective_enabled = True  ## turned off by the training loop for the periodic full-scoring epochs
+    cls.factorized_projection = factorized_projection
+    cls.fused_operators = fused_operators
+    if fused_operators:
+        cls.linears = FusedOperatorProjection(num_labels=cls.num_labels, in_features=3 * config.hidden_size, hidden_size=config.hidden_size,
+                                              layer_norm_eps=config.layer_norm_eps, dropout_prob=config.hidden_dropout_prob,
+                                              initializer_range=config.initializer_range)
+    else:
+        cls.linears = nn.ModuleList()
+        for i in range(cls.num_labels):
+            cls.linears.append(nn.Sequential(
+                nn.Linear(3 * config.hidden_size, config.hidden_size),
+                nn.ReLU(),
+                nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps),
+                nn.Dropout(config.hidden_dropout_prob)
+            ))
+    ## checkpoints of both operator layouts can be loaded
+    cls._register_load_state_dict_pre_hook(partial(convert_operator_layout_hook, fused_operators))
 
     cls.stopper_transformation = nn.Sequential(
         nn.Linear(config.hidden_size, config.hidden_size),
@@ -259,6 +820,12 @@ def initialize_param(cls, config, constant_num, height, var_update_mode):
     )
 
     cls.stopper = nn.Linear(config.hidden_size, 2)  ## whether we need to stop or not.
+    ## the exit heads project an intermediate encoder layer into the last-layer space, the deductive head is shared
+    cls.exit_adapters = nn.ModuleList([nn.Sequential(
+        nn.Linear(config.hidden_size, config.hidden_size),
+        nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
+    ) for _ in cls.exit_layers])
+    cls.exit_thresholds = None  ## the step-0 margin threshold of each exit in inference (`calibrate_exit_thresholds`), no early exit if None
     cls.variable_gru = None
     if var_update_mode == 'gru':
         cls.var_update_mode = 0
@@ -271,11 +838,14 @@ def initialize_param(cls, config, constant_num, height, var_update_mode):
         cls.variable_gru = nn.GRUCell(config.hidden_size, config.hidden_size)
     elif var_update_mode == 'attn':
         cls.variable_gru = nn.MultiheadAttention(embed_dim=config.hidden_size, num_heads=6, batch_first=True)
+        cls._register_load_state_dict_pre_hook(partial(check_star_attention_hook, star_attention, trained_star_attention))
     else:
         print("[WARNING] no rationalizer????????")
         cls.variable_gru = None
     cls.constant_num = constant_num
     cls.constant_emb = None
+    cls.constant_pair_cache = constant_pair_cache
+    cls._constant_pair_cache = None
     if cls.constant_num > 0:
         cls.const_rep = nn.Parameter(torch.randn(cls.constant_num, config.hidden_size))
         # self.multihead_attention = nn.MultiheadAttention(embed_dim=config.hidden_size, num_heads=6, batch_first=True)
@@ -289,19 +859,50 @@ def initialize_param(cls, config, constant_num, height, var_update_mode):
     )
 
     cls.init_weights()
+    if activation_checkpointing:
+        ## the encoder layers are recomputed in backward (only active in training mode)
+        cls.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
 
 class UniversalModel(BertPreTrainedModel):
 
     def __init__(self, config: BertConfig,
                  height: int = 4,
                  constant_num: int = 0,
-                 var_update_mode: str= 'gru'):
+                 var_update_mode: str= 'gru',
+                 factorized_projection: bool = False,
+                 fused_operators: bool = False,
+                 constant_pair_cache: bool = False,
+                 eval_early_exit: bool = False,
+                 train_compaction: bool = False,
+                 height_parallel: bool = False,
+                 incremental_scoring: bool = False,
+                 star_attention: bool = False,
+                 pair_chunk_size: int = 0,
+                 activation_checkpointing: bool = False,
+                 pair_top_k: int = 0,
+                 sampled_negatives: int = 0,
+                 negative_source: str = "scorer",
+                 exit_layers: List[int] = None):
         """
         Constructor for model function
         :param config:
         :param diff_param_for_height: whether we want to use different layers/parameters for different height
         :param height: the maximum number of height we want to use
         :param constant_num: the number of constant we consider
+        :param factorized_projection: project the two variables of a pair once per variable instead of once per pair
+        :param fused_operators: evaluate all the operator layers with one fused projection
+        :param constant_pair_cache: score the constant-constant pairs once per batch (cached in evaluation)
+        :param eval_early_exit: in evaluation, stop decoding the instances that predicted the stop label
+        :param train_compaction: in training, only process the instances that still have a gold step at each height
+        :param height_parallel: in training, score the pairs of all heights in one batched pass
+        :param incremental_scoring: in inference without variable update, only score the pairs with the new intermediate
+        :param star_attention: with var_update_mode attn, update each variable by attending to itself and the new intermediate only, in linear time
+        :param pair_chunk_size: in inference, score the pairs in chunks of this size with a running best (0: all pairs at once)
+        :param activation_checkpointing: in training, recompute the encoder layers and the pair scoring of each height in backward instead of keeping their activations
+        :param pair_top_k: in inference, only the top-k pairs of the first-stage (variable_scorer) scores get the operator and stopper scoring (0: all pairs)
+        :param sampled_negatives: in training, score only the gold pair and this number of sampled negative pairs at each height (0: all pairs)
+        :param negative_source: how the negative pairs are sampled: scorer (top first-stage scores) or random
+        :param exit_layers: the encoder layers (1-based) with an exit head (a projection into the last-layer space before the shared deductive head), trained with an auxiliary loss each
         """
         super().__init__(config)
         self.num_labels = config.num_labels ## should be 6
@@ -313,7 +914,21 @@ class UniversalModel(BertPreTrainedModel):
                          config=config,
                          constant_num=constant_num,
                          height=height,
-                         var_update_mode=var_update_mode)
+                         var_update_mode=var_update_mode,
+                         factorized_projection=factorized_projection,
+                         fused_operators=fused_operators,
+                         constant_pair_cache=constant_pair_cache,
+                         eval_early_exit=eval_early_exit,
+                         train_compaction=train_compaction,
+                         height_parallel=height_parallel,
+                         incremental_scoring=incremental_scoring,
+                         star_attention=star_attention,
+                         pair_chunk_size=pair_chunk_size,
+                         activation_checkpointing=activation_checkpointing,
+                         pair_top_k=pair_top_k,
+                         sampled_negatives=sampled_negatives,
+                         negative_source=negative_source,
+                         exit_layers=exit_layers)
 
 
     def forward(self,
@@ -333,7 +948,10 @@ class UniversalModel(BertPreTrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
-        is_eval=False
+        is_eval=False,
+        return_all_logits=True,
+        num_top_scores=0,
+        var_hidden_states: torch.Tensor = None
     ):
         return deductive_forward(
             self,
@@ -353,7 +971,10 @@ class UniversalModel(BertPreTrainedModel):
             output_attentions,
             output_hidden_states,
             return_dict,
-            is_eval
+            is_eval,
+            return_all_logits,
+            num_top_scores,
+            var_hidden_states
         )
 
 
@@ -362,7 +983,21 @@ class UniversalModel_Roberta(RobertaPreTrainedModel):
     def __init__(self, config: RobertaConfig,
                  height: int = 4,
                  constant_num: int = 0,
-                 var_update_mode: str= 'gru'):
+                 var_update_mode: str= 'gru',
+                 factorized_projection: bool = False,
+                 fused_operators: bool = False,
+                 constant_pair_cache: bool = False,
+                 eval_early_exit: bool = False,
+                 train_compaction: bool = False,
+                 height_parallel: bool = False,
+                 incremental_scoring: bool = False,
+                 star_attention: bool = False,
+                 pair_chunk_size: int = 0,
+                 activation_checkpointing: bool = False,
+                 pair_top_k: int = 0,
+                 sampled_negatives: int = 0,
+                 negative_source: str = "scorer",
+                 exit_layers: List[int] = None):
         super().__init__(config)
         self.num_labels = config.num_labels  ## should be 6
         assert self.num_labels == 6 or self.num_labels == 8
@@ -373,7 +1008,21 @@ class UniversalModel_Roberta(RobertaPreTrainedModel):
                          config=config,
                          constant_num=constant_num,
                          height=height,
-                         var_update_mode=var_update_mode)
+                         var_update_mode=var_update_mode,
+                         factorized_projection=factorized_projection,
+                         fused_operators=fused_operators,
+                         constant_pair_cache=constant_pair_cache,
+                         eval_early_exit=eval_early_exit,
+                         train_compaction=train_compaction,
+                         height_parallel=height_parallel,
+                         incremental_scoring=incremental_scoring,
+                         star_attention=star_attention,
+                         pair_chunk_size=pair_chunk_size,
+                         activation_checkpointing=activation_checkpointing,
+                         pair_top_k=pair_top_k,
+                         sampled_negatives=sampled_negatives,
+                         negative_source=negative_source,
+                         exit_layers=exit_layers)
 
 
     def forward(self,
@@ -393,7 +1042,10 @@ class UniversalModel_Roberta(RobertaPreTrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
-        is_eval=False
+        is_eval=False,
+        return_all_logits=True,
+        num_top_scores=0,
+        var_hidden_states: torch.Tensor = None
     ):
         return deductive_forward(
             self,
@@ -413,7 +1065,10 @@ class UniversalModel_Roberta(RobertaPreTrainedModel):
             output_attentions,
             output_hidden_states,
             return_dict,
-            is_eval
+            is_eval,
+            return_all_logits,
+            num_top_scores,
+            var_hidden_states
         )
 
 
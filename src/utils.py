@@ -1,3 +1,4 @@
+import hashlib
 import json
 from src.config import  Config
 import torch.nn as nn
@@ -17,17 +18,37 @@ def read_data(file:str):
 	return data
 
 
+def get_autocast(precision: str, device: torch.device):
+	"""
+	The autocast context of the precision ("fp32", "bf16" or "fp16") on the device type, e.g., bf16 autocast on CPU.
+	"""
+	dtype = torch.bfloat16 if precision == "bf16" else torch.float16
+	return torch.autocast(device_type=device.type, dtype=dtype, enabled=precision != "fp32")
+
+
+def get_weights_fingerprint(model: nn.Module) -> str:
+	"""
+	A hash of the parameters and buffers of the model, e.g., to detect a derived checkpoint (quantized, compressed) of older weights.
+	"""
+	md5 = hashlib.md5()
+	for name, tensor in sorted(model.state_dict().items()):
+		md5.update(name.encode("utf-8"))
+		md5.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+	return md5.hexdigest()
+
+
 def get_optimizers(config: Config, model: nn.Module, num_training_steps: int, weight_decay:float = 0.01,
 				   warmup_step: int = -1, eps:float = 1e-8) -> Tuple[torch.optim.Optimizer, torch.optim.lr_scheduler.LambdaLR]:
 	# no_decay = ["b ias", "LayerNorm.weight", 'LayerNorm.bias']
 	no_decay = ["bias", "LayerNorm.weight"]
+	## the frozen parameters (e.g., the encoder with LoRA adapters) have no optimizer state
 	optimizer_grouped_parameters = [
 		{
-			"params": [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)],
+			"params": [p for n, p in model.named_parameters() if p.requires_grad and not any(nd in n for nd in no_decay)],
 			"weight_decay": weight_decay,
 		},
 		{
-			"params": [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)],
+			"params": [p for n, p in model.named_parameters() if p.requires_grad and any(nd in n for nd in no_decay)],
 			"weight_decay": 0.0,
 		},
 	]
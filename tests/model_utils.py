@@ -0,0 +1,63 @@
+import torch
+from typing import Dict, List
+from transformers import BertConfig
+from src.model.universal_model import UniversalModel
+
+
+def make_config(num_labels: int = 6, hidden_size: int = 48, num_hidden_layers: int = 2) -> BertConfig:
+    return BertConfig(hidden_size=hidden_size, num_hidden_layers=num_hidden_layers, num_attention_heads=4, intermediate_size=64,
+                      vocab_size=100, num_labels=num_labels)
+
+
+def make_model(var_update_mode: str = "gru", constant_num: int = 0, seed: int = 0, **kwargs) -> UniversalModel:
+    """
+    A small randomly initialized model in eval mode.
+    """
+    torch.manual_seed(seed)
+    return UniversalModel(make_config(**{key: kwargs.pop(key) for key in ["num_labels", "hidden_size", "num_hidden_layers"] if key in kwargs}),
+                          height=4, constant_num=constant_num, var_update_mode=var_update_mode, **kwargs).eval()
+
+
+def make_inputs(batch_size: int = 6, sent_len: int = 12, max_num_variable: int = 3, constant_num: int = 0, seed: int = 1,
+                with_labels: bool = False) -> Dict[str, torch.Tensor]:
+    """
+    Random problems with 1 to `max_num_variable` quantities (and a random gold derivation of 1 to 3 steps if `with_labels`).
+    """
+    generator = torch.Generator().manual_seed(seed)
+    num_variables = torch.randint(1, max_num_variable + 1, (batch_size,), generator=generator)
+    num_vars = int(num_variables.max())
+    variable_indexs_start = torch.zeros(batch_size, num_vars, dtype=torch.long)
+    variable_index_mask = torch.zeros(batch_size, num_vars)
+    for b in range(batch_size):
+        variable_indexs_start[b, :num_variables[b]] = 1 + 2 * torch.arange(int(num_variables[b]))
+        variable_index_mask[b, :num_variables[b]] = 1
+    attention_mask = torch.ones(batch_size, sent_len, dtype=torch.long)
+    attention_mask[0, sent_len - 3:] = 0
+    inputs = dict(input_ids=torch.randint(1, 100, (batch_size, sent_len), generator=generator), attention_mask=attention_mask,
+                  token_type_ids=torch.zeros(batch_size, sent_len, dtype=torch.long), variable_indexs_start=variable_indexs_start,
+                  variable_indexs_end=variable_indexs_start.clone(), num_variables=num_variables, variable_index_mask=variable_index_mask)
+    if with_labels:
+        heights = torch.randint(1, 4, (batch_size,), generator=generator)
+        labels = torch.zeros(batch_size, int(heights.max()), 4, dtype=torch.long)
+        label_height_mask = torch.zeros(batch_size, int(heights.max()), dtype=torch.long)
+        for b in range(batch_size):
+            for i in range(int(heights[b])):
+                n = int(num_variables[b]) + constant_num + i
+                left = int(torch.randint(0, n, (1,), generator=generator))
+                right = int(torch.randint(left, n, (1,), generator=generator))
+                labels[b, i] = torch.tensor([left, right, int(torch.randint(0, 6, (1,), generator=generator)), int(i == heights[b] - 1)])
+                label_height_mask[b, i] = 1
+        inputs.update(labels=labels, label_height_mask=label_height_mask)
+    return inputs
+
+
+def decoded_steps(predictions: torch.Tensor) -> List[List[List[int]]]:
+    """
+    :param predictions: (batch_size, height, 4)
+    :return: the steps of each instance up to (and including) the first stop label
+    """
+    decoded = []
+    for steps in predictions.tolist():
+        num_steps = next((i + 1 for i, step in enumerate(steps) if step[3] == 1), len(steps))
+        decoded.append(steps[:num_steps])
+    return decoded
@@ -0,0 +1,33 @@
+import torch
+import pytest
+from src.model.beam_search import beam_search
+from tests.model_utils import make_model, make_inputs, decoded_steps
+
+
+def run_beam_search(model, inputs, beam_size):
+    with torch.no_grad():
+        return beam_search(model, model.base_model, inputs["input_ids"], inputs["attention_mask"], inputs["token_type_ids"],
+                           inputs["variable_indexs_start"], inputs["variable_indexs_end"], inputs["num_variables"], beam_size=beam_size)
+
+
+@pytest.mark.parametrize("var_update_mode", ["gru", "attn", "none"])
+@pytest.mark.parametrize("constant_num", [0, 2])
+def test_beam_size_1_is_greedy(var_update_mode, constant_num):
+    model = make_model(var_update_mode, constant_num)
+    for seed in range(3):
+        inputs = make_inputs(batch_size=8, max_num_variable=4, seed=seed)
+        with torch.no_grad():
+            greedy = model(**inputs, is_eval=True, return_dict=True).predictions
+        nbest = run_beam_search(model, inputs, beam_size=1)
+        assert [derivations[0][1] for derivations in nbest] == decoded_steps(greedy)
+
+
+def test_larger_beam_scores_at_least_greedy():
+    model = make_model("gru", 2)
+    inputs = make_inputs(batch_size=8, max_num_variable=4)
+    greedy = run_beam_search(model, inputs, beam_size=1)
+    nbest = run_beam_search(model, inputs, beam_size=4)
+    for greedy_derivations, derivations in zip(greedy, nbest):
+        assert len(derivations) <= 4
+        assert [score for score, _ in derivations] == sorted([score for score, _ in derivations], reverse=True)
+        assert derivations[0][0] >= greedy_derivations[0][0] - 1e-5
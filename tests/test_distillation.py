@@ -0,0 +1,61 @@
+import torch
+import pytest
+from src.model.distillation import build_student_config, init_student_from_teacher, logits_distillation_loss, hidden_distillation_loss
+from src.model.universal_model import UniversalModel
+from tests.model_utils import make_config, make_model, make_inputs
+
+
+def make_student(teacher: UniversalModel, **sizes) -> UniversalModel:
+    torch.manual_seed(1)
+    return UniversalModel(build_student_config(teacher.config, **sizes), height=4, constant_num=teacher.constant_num, var_update_mode="gru").eval()
+
+
+def test_student_layers_are_copied_from_the_mapped_teacher_layers():
+    teacher = make_model("gru", constant_num=2, num_hidden_layers=4)
+    student = make_student(teacher, num_hidden_layers=2)
+    copied = init_student_from_teacher(student, teacher)
+    assert set(copied) == set(student.state_dict())
+    ## hidden_states[1] and [2] of the student are matched to hidden_states[2] and [4] of the teacher
+    for student_layer, teacher_layer in [(0, 1), (1, 3)]:
+        assert torch.equal(student.bert.encoder.layer[student_layer].output.dense.weight, teacher.bert.encoder.layer[teacher_layer].output.dense.weight)
+    assert torch.equal(student.bert.embeddings.word_embeddings.weight, teacher.bert.embeddings.word_embeddings.weight)
+    assert torch.equal(student.variable_scorer[0].weight, teacher.variable_scorer[0].weight)
+    assert torch.equal(student.const_rep, teacher.const_rep)
+
+
+def test_smaller_intermediate_size_keeps_the_student_ffn():
+    teacher = make_model("gru", num_hidden_layers=4)
+    student = make_student(teacher, num_hidden_layers=2, intermediate_size=32)
+    ffn_weight = student.bert.encoder.layer[0].intermediate.dense.weight.clone()
+    copied = init_student_from_teacher(student, teacher)
+    assert "bert.encoder.layer.0.intermediate.dense.weight" not in copied
+    assert "bert.encoder.layer.0.attention.self.query.weight" in copied
+    assert torch.equal(student.bert.encoder.layer[0].intermediate.dense.weight, ffn_weight)
+
+
+def test_nothing_is_copied_with_another_hidden_size():
+    teacher = make_model("gru", num_hidden_layers=4)
+    student = make_student(teacher, num_hidden_layers=2, hidden_size=32)
+    student_state = {name: tensor.clone() for name, tensor in student.state_dict().items()}
+    assert init_student_from_teacher(student, teacher) == []
+    assert all(torch.equal(tensor, student_state[name]) for name, tensor in student.state_dict().items())
+
+
+def test_build_student_config_checks_the_attention_heads():
+    with pytest.raises(ValueError):
+        build_student_config(make_config(), num_hidden_layers=1, hidden_size=30)
+
+
+def test_distillation_losses_are_zero_for_the_teacher_outputs():
+    teacher = make_model("gru", num_hidden_layers=4)
+    student = make_student(teacher, num_hidden_layers=2)
+    inputs = make_inputs(batch_size=4, with_labels=True)
+    with torch.no_grad():
+        teacher_output = teacher(**inputs, return_dict=True, output_hidden_states=True)
+        student_output = student(**inputs, return_dict=True, output_hidden_states=True)
+    label_height_mask = inputs["label_height_mask"]
+    assert logits_distillation_loss(teacher_output.all_logits, teacher_output.all_logits, label_height_mask).item() == pytest.approx(0, abs=1e-6)
+    assert logits_distillation_loss(student_output.all_logits, teacher_output.all_logits, label_height_mask).item() > 0
+    ## a 4-layer "student" matched layer by layer to the teacher
+    assert hidden_distillation_loss(teacher_output.hidden_states, teacher_output.hidden_states, inputs["attention_mask"]).item() == 0
+    assert hidden_distillation_loss(student_output.hidden_states, teacher_output.hidden_states, inputs["attention_mask"]).item() > 0
@@ -0,0 +1,78 @@
+import torch
+from types import SimpleNamespace
+from torch.utils.data import DataLoader
+from src.data.universal_dataset import UniFeature, UniversalDataset
+from src.model import encoder_cache
+from src.model.encoder_cache import build_encoder_cache, load_or_build_encoder_cache
+from tests.model_utils import make_model
+
+
+def make_dataset(num_instances: int = 10, seed: int = 0, different_ends: bool = True) -> UniversalDataset:
+    """
+    A dataset of random problems (1 to 3 quantities, 1 to 2 gold steps), without a data file or tokenizer.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    dataset = UniversalDataset.__new__(UniversalDataset)
+    dataset.tokenizer = SimpleNamespace(pad_token_id=0)
+    dataset._features = []
+    for instance_id in range(num_instances):
+        sent_len = int(torch.randint(8, 14, (1,), generator=generator))
+        num_variables = int(torch.randint(1, 4, (1,), generator=generator))
+        var_starts = [1 + 2 * k for k in range(num_variables)]
+        labels = [[0, num_variables - 1, int(torch.randint(0, 6, (1,), generator=generator)), 0], [0, 1, 0, 1]]
+        dataset._features.append(UniFeature(input_ids=torch.randint(1, 100, (sent_len,), generator=generator).tolist(), attention_mask=[1] * sent_len,
+                                            token_type_ids=[0] * sent_len, variable_indexs_start=var_starts,
+                                            variable_indexs_end=[start + int(different_ends) for start in var_starts], num_variables=num_variables,
+                                            variable_index_mask=[1] * num_variables, labels=labels, label_height_mask=[1, 1], instance_id=instance_id))
+    return dataset
+
+
+def test_cached_loss_matches_the_encoder_loss(tmp_path):
+    model = make_model("gru", constant_num=2)
+    dataset = make_dataset()
+    cache = build_encoder_cache(model, dataset, str(tmp_path / "train.cache"), torch.device("cpu"), batch_size=4)
+    for feature in DataLoader(dataset, batch_size=4, shuffle=True, collate_fn=dataset.collate_function):
+        inputs = dict(variable_indexs_start=feature.variable_indexs_start, variable_indexs_end=feature.variable_indexs_end,
+                      num_variables=feature.num_variables, variable_index_mask=feature.variable_index_mask, labels=feature.labels,
+                      label_height_mask=feature.label_height_mask, return_dict=True)
+        with torch.no_grad():
+            loss = model(input_ids=feature.input_ids, attention_mask=feature.attention_mask, token_type_ids=feature.token_type_ids, **inputs).loss
+            cached_loss = model(var_hidden_states=cache.get(feature.instance_id, feature.variable_indexs_start.size(1)), **inputs).loss
+        ## the cache is in fp16
+        assert torch.allclose(cached_loss, loss, rtol=1e-2, atol=1e-2)
+
+
+def test_end_states_are_added_per_instance(tmp_path):
+    model = make_model("gru")
+    dataset = make_dataset(different_ends=False)
+    ## a single instance with different start and end positions
+    dataset._features[0] = dataset._features[0]._replace(variable_indexs_end=[start + 1 for start in dataset._features[0].variable_indexs_start])
+    cache = build_encoder_cache(model, dataset, str(tmp_path / "train.cache"), torch.device("cpu"), batch_size=len(dataset))
+    for instance_id in [0, 1]:
+        feature = dataset[instance_id]
+        with torch.no_grad():
+            last_hidden_state = model.base_model(torch.tensor([feature.input_ids]), return_dict=True).last_hidden_state[0]
+        expected = last_hidden_state[feature.variable_indexs_start]
+        if instance_id == 0:
+            expected = expected + last_hidden_state[feature.variable_indexs_end]
+        cached = cache.get(torch.tensor([instance_id]), feature.num_variables)[0]
+        assert torch.allclose(cached, expected, rtol=1e-2, atol=1e-2)
+
+
+def test_cache_is_reused_only_for_the_same_encoder_and_data(tmp_path, monkeypatch):
+    model = make_model("gru")
+    cache_file = str(tmp_path / "train.cache")
+    num_builds = []
+
+    def counted_build(*args, **kwargs):
+        num_builds.append(1)
+        return build_encoder_cache(*args, **kwargs)
+
+    monkeypatch.setattr(encoder_cache, "build_encoder_cache", counted_build)
+    load_or_build_encoder_cache(model, make_dataset(), cache_file, torch.device("cpu"), encoder_name="bert")
+    load_or_build_encoder_cache(model, make_dataset(), cache_file, torch.device("cpu"), encoder_name="bert")
+    assert len(num_builds) == 1
+    load_or_build_encoder_cache(model, make_dataset(seed=1), cache_file, torch.device("cpu"), encoder_name="bert")
+    assert len(num_builds) == 2
+    load_or_build_encoder_cache(model, make_dataset(seed=1), cache_file, torch.device("cpu"), encoder_name="roberta")
+    assert len(num_builds) == 3
@@ -0,0 +1,46 @@
+import torch
+from src.model.early_exit import select_exit_threshold
+from src.model.universal_model import deductive_head, get_first_step_margin
+from tests.model_utils import make_model, make_inputs, decoded_steps
+
+
+def test_select_exit_threshold():
+    margins = torch.tensor([3.0, 2.0, 1.0, 0.0])
+    agreements = torch.tensor([True, True, False, True])
+    assert select_exit_threshold(margins, agreements, target_agreement=1.0) == 2.0
+    assert select_exit_threshold(margins, agreements, target_agreement=0.75) == 0.0
+    ## the instances tied with the threshold also exit
+    assert select_exit_threshold(torch.tensor([2.0, 1.0, 1.0]), torch.tensor([True, True, False]), target_agreement=1.0) == 2.0
+    assert select_exit_threshold(margins, torch.zeros(4, dtype=torch.bool), target_agreement=0.5) == float("inf")
+
+
+def test_instances_are_decoded_from_their_exit_layer():
+    model = make_model("gru", constant_num=2, exit_layers=[1])
+    inputs = make_inputs(batch_size=8, max_num_variable=4)
+    with torch.no_grad():
+        outputs = model.base_model(inputs["input_ids"], attention_mask=inputs["attention_mask"], token_type_ids=inputs["token_type_ids"],
+                                   output_hidden_states=True, return_dict=True)
+        last_predictions = model(**inputs, is_eval=True, return_dict=True).predictions
+        exit_hidden_states = model.exit_adapters[0](outputs.hidden_states[1])
+        exit_predictions = deductive_head(model, exit_hidden_states, inputs["variable_indexs_start"], inputs["variable_indexs_end"],
+                                          inputs["num_variables"], inputs["variable_index_mask"], is_eval=True).predictions
+        margin, _ = get_first_step_margin(model, exit_hidden_states, inputs["variable_indexs_start"], inputs["variable_indexs_end"],
+                                          inputs["num_variables"])
+
+    ## no instance exits early: the same as without early exit
+    model.exit_thresholds = [float("inf")]
+    with torch.no_grad():
+        output = model(**inputs, is_eval=True, return_dict=True)
+    assert output.exit_layers.tolist() == [2] * 8
+    assert decoded_steps(output.predictions) == decoded_steps(last_predictions)
+
+    ## half of the instances exit at the first layer, the rest of the batch goes through the last layer
+    model.exit_thresholds = [margin.median().item()]
+    with torch.no_grad():
+        output = model(**inputs, is_eval=True, return_dict=True)
+    exits = (margin >= model.exit_thresholds[0]).tolist()
+    assert output.exit_layers.tolist() == [1 if exit else 2 for exit in exits]
+    assert 0 < sum(exits) < len(exits)
+    expected = [exit_steps if exit else last_steps for exit, exit_steps, last_steps in
+                zip(exits, decoded_steps(exit_predictions), decoded_steps(last_predictions))]
+    assert decoded_steps(output.predictions) == expected
@@ -0,0 +1,17 @@
+import torch
+import pytest
+from tests.model_utils import make_model, make_inputs, decoded_steps
+
+
+@pytest.mark.parametrize("var_update_mode", ["gru", "attn", "none"])
+@pytest.mark.parametrize("constant_num", [0, 2])
+@pytest.mark.parametrize("incremental_scoring", [False, True])
+def test_early_exit_predictions_match_full_decoding(var_update_mode, constant_num, incremental_scoring):
+    inputs = make_inputs(batch_size=8, max_num_variable=4)
+    predictions = {}
+    for eval_early_exit in [False, True]:
+        model = make_model(var_update_mode, constant_num, eval_early_exit=eval_early_exit, incremental_scoring=incremental_scoring)
+        with torch.no_grad():
+            predictions[eval_early_exit] = model(**inputs, is_eval=True, return_dict=True).predictions
+    ## the finished instances are dropped from the batch, so only the steps up to the first stop label are compared
+    assert decoded_steps(predictions[True]) == decoded_steps(predictions[False])
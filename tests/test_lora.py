@@ -0,0 +1,70 @@
+import os
+import torch
+import pytest
+from src.model.lora import LoRALinear, inject_lora, merge_lora, lora_state_dict, save_lora_model, load_lora_model, LORA_CHECKPOINT_NAME
+from tests.model_utils import make_model, make_inputs
+
+
+def first_height_logits(model, inputs) -> torch.Tensor:
+    with torch.no_grad():
+        return model(**inputs, is_eval=True, return_dict=True).all_logits[0]
+
+
+def make_adapted_model():
+    """
+    A model with LoRA adapters as after fine-tuning: non-zero updates and a changed deductive head.
+    """
+    model = make_model("gru", constant_num=2)
+    wrapped = inject_lora(model, rank=4)
+    torch.manual_seed(2)
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, LoRALinear):
+                module.lora_B.normal_(std=0.1)
+        model.variable_scorer[0].weight.add_(0.1)
+    return model, wrapped
+
+
+def test_inject_lora_starts_from_the_base_model_and_freezes_the_encoder():
+    inputs = make_inputs(batch_size=8, max_num_variable=4)
+    model = make_model("gru", constant_num=2)
+    base_logits = first_height_logits(model, inputs)
+    wrapped = inject_lora(model, rank=4)
+    assert len(wrapped) > 0
+    assert torch.allclose(first_height_logits(model, inputs), base_logits)
+    trainable = [name for name, param in model.named_parameters() if param.requires_grad]
+    assert all("lora_" in name or not name.startswith(model.base_model_prefix + ".") for name in trainable)
+    assert any(name.startswith("variable_scorer") for name in trainable)
+
+
+def test_merge_keeps_the_outputs():
+    inputs = make_inputs(batch_size=8, max_num_variable=4)
+    model, _ = make_adapted_model()
+    adapted_logits = first_height_logits(model, inputs)
+    merge_lora(model)
+    assert not any(isinstance(module, LoRALinear) for module in model.modules())
+    assert torch.allclose(first_height_logits(model, inputs), adapted_logits, atol=1e-5)
+
+
+def test_head_only_checkpoint_round_trip(tmp_path):
+    inputs = make_inputs(batch_size=8, max_num_variable=4)
+    model, _ = make_adapted_model()
+    adapted_logits = first_height_logits(model, inputs)
+    save_lora_model(model, str(tmp_path))
+    ## no frozen encoder weights in the checkpoint
+    assert all("lora_" in name or not name.startswith(model.base_model_prefix + ".") for name in lora_state_dict(model))
+
+    ## loaded into the base pretrained model (the encoder weights before fine-tuning)
+    reloaded = load_lora_model(make_model("gru", constant_num=2), str(tmp_path))
+    assert not any(isinstance(module, LoRALinear) for module in reloaded.modules())
+    assert torch.allclose(first_height_logits(reloaded, inputs), adapted_logits, atol=1e-5)
+
+
+def test_mismatched_checkpoint_is_rejected(tmp_path):
+    model, _ = make_adapted_model()
+    save_lora_model(model, str(tmp_path))
+    checkpoint = torch.load(os.path.join(str(tmp_path), LORA_CHECKPOINT_NAME))
+    checkpoint["state_dict"].pop("stopper.weight")
+    torch.save(checkpoint, os.path.join(str(tmp_path), LORA_CHECKPOINT_NAME))
+    with pytest.raises(RuntimeError):
+        load_lora_model(make_model("gru", constant_num=2), str(tmp_path))
@@ -0,0 +1,67 @@
+import torch
+import torch.nn as nn
+import pytest
+from src.model.low_rank import LowRankLinear, compress_model, save_low_rank_model, has_low_rank_model, load_low_rank_model
+from tests.model_utils import make_model, make_inputs
+
+
+def first_height_logits(model, inputs) -> torch.Tensor:
+    with torch.no_grad():
+        return model(**inputs, is_eval=True, return_dict=True).all_logits[0]
+
+
+def test_low_rank_linear_is_the_truncated_svd():
+    torch.manual_seed(0)
+    linear = nn.Linear(12, 8)
+    singular_values = torch.linalg.svdvals(linear.weight.detach())
+    for rank in [2, 5, 8]:
+        low_rank = LowRankLinear.from_linear(linear, rank)
+        weight = low_rank.up.weight @ low_rank.down.weight
+        ## the Frobenius error of the best rank-r approximation is the norm of the dropped singular values
+        assert torch.linalg.norm(weight - linear.weight).item() == pytest.approx(singular_values[rank:].norm().item(), abs=1e-4)
+        assert torch.equal(low_rank.up.bias, linear.bias)
+    x = torch.randn(3, 12)
+    assert torch.allclose(LowRankLinear.from_linear(linear, 8)(x), linear(x), atol=1e-5)
+
+
+def truncate_rank(linear: nn.Linear, rank: int):
+    U, S, Vh = torch.linalg.svd(linear.weight.detach(), full_matrices=False)
+    with torch.no_grad():
+        linear.weight.copy_(U[:, :rank] @ torch.diag(S[:rank]) @ Vh[:rank])
+
+
+@pytest.mark.parametrize("fused_operators", [False, True])
+def test_compress_model_replaces_the_operator_and_stopper_layers(fused_operators):
+    model = make_model("gru", constant_num=2, factorized_projection=True)
+    ## weights of rank 8 are compressed without error
+    for layer in list(model.linears) + [model.stopper_transformation]:
+        truncate_rank(layer[0], 8)
+    inputs = make_inputs(batch_size=8, max_num_variable=4)
+    logits = first_height_logits(model, inputs)
+    if fused_operators:
+        ## the per-label weights are converted into the fused layout when loaded
+        fused_model = make_model("gru", constant_num=2, fused_operators=True, factorized_projection=True)
+        fused_model.load_state_dict(model.state_dict())
+        model = fused_model
+    compressed = compress_model(model, rank=8)
+    assert compressed == [f"linears.{i}.0" for i in range(model.num_labels)] + ["stopper_transformation.0"]
+    assert all(isinstance(operator[0], LowRankLinear) for operator in model.linears)
+    assert not model.fused_operators and not model.factorized_projection
+    assert torch.allclose(first_height_logits(model, inputs), logits, atol=1e-4)
+
+
+def test_low_rank_checkpoint_round_trip(tmp_path):
+    inputs = make_inputs(batch_size=8, max_num_variable=4)
+    settings = {"fingerprint": "full", "finetune_epochs": 0}
+    model = make_model("gru", constant_num=2)
+    compress_model(model, rank=8)
+    ## as after fine-tuning
+    with torch.no_grad():
+        model.linears[0][0].up.bias.add_(0.1)
+    save_low_rank_model(model, str(tmp_path), rank=8, settings=settings)
+    assert has_low_rank_model(str(tmp_path), 8, settings)
+    assert not has_low_rank_model(str(tmp_path), 4, settings)
+    assert not has_low_rank_model(str(tmp_path), 8, {"fingerprint": "other", "finetune_epochs": 0})
+
+    reloaded = load_low_rank_model(make_model("gru", constant_num=2, seed=1), str(tmp_path), rank=8)
+    assert torch.equal(first_height_logits(reloaded, inputs), first_height_logits(model, inputs))
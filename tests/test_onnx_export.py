@@ -0,0 +1,20 @@
+import torch
+import pytest
+from src.model.onnx_export import export_onnx, OnnxDeductiveRunner
+from tests.model_utils import make_model, make_inputs, decoded_steps
+
+pytest.importorskip("onnxruntime")
+
+
+@pytest.mark.parametrize("var_update_mode", ["gru", "attn", "none"])
+def test_onnx_predictions_match_torch(var_update_mode, tmp_path):
+    model = make_model(var_update_mode, constant_num=2)
+    export_onnx(model, str(tmp_path))
+    ## other shapes than the export examples, the batch, sequence and variable dimensions are dynamic
+    inputs = make_inputs(batch_size=5, sent_len=14, max_num_variable=4)
+    with torch.no_grad():
+        expected = model(**inputs, is_eval=True, return_dict=True).predictions
+    runner = OnnxDeductiveRunner(str(tmp_path), max_height=model.max_height)
+    predictions = runner.predict(**{key: inputs[key].numpy() for key in ["input_ids", "attention_mask", "token_type_ids", "variable_indexs_start",
+                                                                          "variable_indexs_end", "num_variables"]})
+    assert decoded_steps(torch.from_numpy(predictions)) == decoded_steps(expected[:, :predictions.shape[1]])
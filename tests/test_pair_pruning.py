@@ -0,0 +1,64 @@
+import torch
+import pytest
+from types import SimpleNamespace
+from src.model.pair_index import get_combination, get_batched_combination_mask, pair_to_index, get_num_combinations
+from src.model.pair_pruning import gold_pair_ranks
+from src.model.static_inference import encode_variables
+from src.model.universal_model import score_top_k_pairs
+from tests.model_utils import make_model, make_inputs, decoded_steps
+from universal_main import report_pair_recall
+
+
+def test_top_k_covering_all_pairs_matches_full_scoring():
+    model = make_model("gru", constant_num=2)
+    inputs = make_inputs(batch_size=8, max_num_variable=4)
+    with torch.no_grad():
+        full = model(**inputs, is_eval=True, return_dict=True).predictions
+        model.pair_top_k = get_num_combinations(4 + 2 + model.max_height)
+        pruned = model(**inputs, is_eval=True, return_dict=True).predictions
+    assert decoded_steps(pruned) == decoded_steps(full)
+
+
+@pytest.mark.parametrize("negative_source", ["scorer", "random"])
+def test_sampled_negatives_covering_all_pairs_match_full_loss(negative_source):
+    inputs = make_inputs(batch_size=8, max_num_variable=4, with_labels=True)
+    model = make_model("gru", negative_source=negative_source)
+    losses = []
+    for sampled_negatives in [0, get_num_combinations(4 + model.max_height)]:
+        model.sampled_negatives = sampled_negatives
+        with torch.no_grad():
+            losses.append(model(**inputs, return_dict=True).loss)
+    assert torch.allclose(losses[0], losses[1], atol=1e-5)
+
+
+@pytest.mark.parametrize("k", [1, 2, 4])
+def test_gold_pair_rank_is_kept_by_top_k(k):
+    """
+    At height 0 (no teacher forcing yet), the gold pair survives the pruning with `k` exactly when its rank is below `k`.
+    """
+    model = make_model("gru")
+    inputs = make_inputs(batch_size=8, max_num_variable=4, with_labels=True)
+    ranks = gold_pair_ranks(model, **{key: inputs[key] for key in ["input_ids", "attention_mask", "token_type_ids", "variable_indexs_start",
+                                                                    "variable_indexs_end", "num_variables", "labels", "label_height_mask"]})
+    with torch.no_grad():
+        var_hidden_states = encode_variables(model, model.base_model, inputs["input_ids"], inputs["attention_mask"], inputs["token_type_ids"],
+                                             inputs["variable_indexs_start"], inputs["variable_indexs_end"])
+        num_vars = var_hidden_states.size(1)
+        combined_logits = score_top_k_pairs(model, var_hidden_states, get_combination(num_vars, device=var_hidden_states.device),
+                                            get_batched_combination_mask(inputs["num_variables"], num_vars), k)[0]
+    gold_comb = pair_to_index(inputs["labels"][:, 0, 0], inputs["labels"][:, 0, 1], num_vars)
+    kept = combined_logits[torch.arange(gold_comb.size(0)), gold_comb].amax(dim=(-2, -1)) > float("-inf")
+    assert kept.tolist() == (ranks[:, 0] < k).tolist()
+
+
+def test_report_pair_recall_counts_kept_gold_steps():
+    model = make_model("gru")
+    batches = [make_inputs(batch_size=4, max_num_variable=4, with_labels=True, seed=seed) for seed in range(3)]
+    ranks = torch.cat([gold_pair_ranks(model, **{key: value for key, value in batch.items() if key != "variable_index_mask"}).flatten()
+                       for batch in batches])
+    ranks = ranks[ranks >= 0]
+    ks = [1, 3, get_num_combinations(4 + model.max_height)]
+    num_kept = report_pair_recall([SimpleNamespace(**batch) for batch in batches], model, torch.device("cpu"), ks=ks)
+    assert [num_kept[k] for k in ks] == [int((ranks < k).sum()) for k in ks]
+    ## every gold pair is kept when all the pairs are
+    assert num_kept[ks[-1]] == ranks.numel()
@@ -0,0 +1,34 @@
+import torch
+import pytest
+from src.utils import get_autocast
+from tests.model_utils import make_model, make_inputs
+
+
+def test_fp32_disables_autocast():
+    with get_autocast("fp32", torch.device("cpu")):
+        assert (torch.randn(2, 3) @ torch.randn(3, 2)).dtype == torch.float32
+    with get_autocast("bf16", torch.device("cpu")):
+        assert (torch.randn(2, 3) @ torch.randn(3, 2)).dtype == torch.bfloat16
+
+
+@pytest.mark.parametrize("var_update_mode", ["gru", "attn", "none"])
+def test_bf16_inference_on_cpu_is_close_to_fp32(var_update_mode):
+    model = make_model(var_update_mode, constant_num=2)
+    inputs = make_inputs(batch_size=8, max_num_variable=4)
+    top_scores = {}
+    for precision in ["fp32", "bf16"]:
+        with torch.no_grad(), get_autocast(precision, torch.device("cpu")):
+            top_scores[precision] = model(**inputs, is_eval=True, return_dict=True, num_top_scores=3).top_scores[:, 0].float()
+    ## the first height does not depend on the previous decisions, so its scores only differ by the bf16 rounding
+    assert torch.allclose(top_scores["bf16"], top_scores["fp32"], atol=0.05 * top_scores["fp32"].abs().max().item())
+
+
+def test_bf16_training_loss_has_gradients():
+    model = make_model("gru", constant_num=2).train()
+    inputs = make_inputs(batch_size=8, max_num_variable=4, constant_num=2, with_labels=True)
+    with get_autocast("bf16", torch.device("cpu")):
+        loss = model(**inputs, return_dict=True).loss
+    loss.backward()
+    assert torch.isfinite(loss)
+    assert all(torch.isfinite(param.grad).all() for param in model.parameters() if param.grad is not None)
+    assert model.variable_scorer[0].weight.grad is not None
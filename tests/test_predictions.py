@@ -0,0 +1,35 @@
+import torch
+import pytest
+from src.model.pair_index import index_to_pair
+from tests.model_utils import make_model, make_inputs
+
+
+def decode_all_logits(all_logits, num_top_scores: int):
+    """
+    The argmax decoding of the logits of each height, as the evaluation did before the forward returned the predictions.
+    """
+    predictions, top_scores = [], []
+    for logits in all_logits:
+        batch_size, num_combinations, num_labels, _ = logits.size()
+        num_vars = int(round(((8 * num_combinations + 1) ** 0.5 - 1) / 2))
+        best_flat = logits.view(batch_size, -1).argmax(dim=-1)
+        best_comb, best_label, best_stop = best_flat // (num_labels * 2), best_flat // 2 % num_labels, best_flat % 2
+        predictions.append(torch.cat([index_to_pair(best_comb, num_vars), best_label.unsqueeze(-1), best_stop.unsqueeze(-1)], dim=-1))
+        top_scores.append(logits.view(batch_size, -1).topk(num_top_scores, dim=-1).values)
+    return torch.stack(predictions, dim=1), torch.stack(top_scores, dim=1)
+
+
+@pytest.mark.parametrize("var_update_mode", ["gru", "attn", "none"])
+@pytest.mark.parametrize("constant_num", [0, 2])
+@pytest.mark.parametrize("kwargs", [{}, {"fused_operators": True, "factorized_projection": True}, {"pair_chunk_size": 5}, {"incremental_scoring": True}])
+def test_predictions_match_decoded_logits(var_update_mode, constant_num, kwargs):
+    model = make_model(var_update_mode, constant_num, **kwargs)
+    inputs = make_inputs(batch_size=8, max_num_variable=4)
+    with torch.no_grad():
+        output = model(**inputs, is_eval=True, return_dict=True, num_top_scores=3)
+        without_logits = model(**inputs, is_eval=True, return_dict=True, return_all_logits=False)
+    predictions, top_scores = decode_all_logits(output.all_logits, num_top_scores=3)
+    assert torch.equal(output.predictions, predictions)
+    assert torch.allclose(output.top_scores, top_scores)
+    assert without_logits.all_logits is None
+    assert torch.equal(without_logits.predictions, output.predictions)
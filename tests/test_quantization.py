@@ -0,0 +1,43 @@
+import torch
+import torch.nn as nn
+import pytest
+from src.model.quantization import quantize_model, save_quantized_model, has_quantized_model, load_quantized_model
+from src.utils import get_weights_fingerprint
+from tests.model_utils import make_model, make_inputs, decoded_steps
+
+
+def first_step_top_scores(model: nn.Module, inputs) -> torch.Tensor:
+    with torch.no_grad():
+        return model(**inputs, is_eval=True, return_dict=True, num_top_scores=3).top_scores[:, 0]
+
+
+@pytest.mark.parametrize("fused_operators", [False, True])
+def test_quantized_model_has_no_float_linear_and_close_scores(fused_operators):
+    model = make_model("gru", constant_num=2, fused_operators=fused_operators)
+    inputs = make_inputs(batch_size=8, max_num_variable=4)
+    float_scores = first_step_top_scores(model, inputs)
+    quantize_model(model)
+    assert not any(type(module) in (nn.Linear, nn.GRUCell) for module in model.modules())
+    assert not any(module.training for module in model.modules())
+    ## the first height does not depend on the previous decisions, so its scores only differ by the int8 error
+    assert torch.allclose(first_step_top_scores(model, inputs), float_scores, atol=0.05 * float_scores.abs().max().item())
+
+
+def test_quantized_checkpoint_round_trip(tmp_path):
+    model = make_model("gru", constant_num=2)
+    inputs = make_inputs(batch_size=8, max_num_variable=4)
+    fingerprint = get_weights_fingerprint(model)
+    quantize_model(model)
+    save_quantized_model(model, str(tmp_path), fingerprint)
+    with torch.no_grad():
+        expected = model(**inputs, is_eval=True, return_dict=True).predictions
+
+    assert has_quantized_model(str(tmp_path), get_weights_fingerprint(make_model("gru", constant_num=2)))
+    ## other float weights are quantized again
+    assert not has_quantized_model(str(tmp_path), get_weights_fingerprint(make_model("gru", constant_num=2, seed=1)))
+
+    ## the loaded int8 weights replace the float weights of the model
+    reloaded = load_quantized_model(make_model("gru", constant_num=2, seed=1), str(tmp_path))
+    with torch.no_grad():
+        predictions = reloaded(**inputs, is_eval=True, return_dict=True).predictions
+    assert torch.equal(predictions, expected)
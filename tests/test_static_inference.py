@@ -0,0 +1,49 @@
+import torch
+import pytest
+from torch._dynamo.utils import counters
+from src.model.static_inference import StaticShapeInference
+from tests.model_utils import make_model, make_inputs, decoded_steps
+
+
+@pytest.mark.parametrize("var_update_mode", ["gru", "attn", "none"])
+@pytest.mark.parametrize("constant_num", [0, 2])
+def test_static_predictions_match_dynamic(var_update_mode, constant_num):
+    model = make_model(var_update_mode, constant_num)
+    inputs = make_inputs()
+    with torch.no_grad():
+        dynamic = model(**inputs, is_eval=True, return_dict=True).predictions
+    inputs.pop("variable_index_mask")
+    ## the buckets are larger than the batch in every dimension
+    runner = StaticShapeInference(model, batch_size=8, seq_len_buckets=[32], num_variable_buckets=[8], height_buckets=[2], compile=False)
+    static = runner.predict(**inputs)
+    assert decoded_steps(static) == decoded_steps(dynamic)
+
+
+def test_encoder_runs_once_across_height_buckets():
+    model = make_model("gru")
+    inputs = make_inputs()
+    with torch.no_grad():
+        dynamic = model(**inputs, is_eval=True, return_dict=True).predictions
+    inputs.pop("variable_index_mask")
+    num_encoder_calls = []
+    model.base_model.register_forward_hook(lambda module, args, output: num_encoder_calls.append(1))
+    ## the small height buckets force the decoding to continue through every bucket
+    runner = StaticShapeInference(model, batch_size=8, seq_len_buckets=[32], num_variable_buckets=[8], height_buckets=[1, 2, 3], compile=False)
+    static = runner.predict(**inputs)
+    assert len(num_encoder_calls) == 1
+    assert decoded_steps(static) == decoded_steps(dynamic[:, :static.size(1)])
+
+
+def test_compiled_predictions_match_dynamic():
+    model = make_model("gru", constant_num=2)
+    inputs = make_inputs()
+    with torch.no_grad():
+        dynamic = model(**inputs, is_eval=True, return_dict=True).predictions
+    inputs.pop("variable_index_mask")
+    runner = StaticShapeInference(model, batch_size=8, seq_len_buckets=[32], num_variable_buckets=[8], height_buckets=[2], compile=True)
+    runner.warmup()
+    num_graphs = counters["stats"]["unique_graphs"]
+    static = runner.predict(**inputs)
+    ## every bucket was compiled by the warmup
+    assert counters["stats"]["unique_graphs"] == num_graphs
+    assert decoded_steps(static) == decoded_steps(dynamic)
@@ -4,16 +4,28 @@ from torch.utils.data import DataLoader
 from transformers import AutoTokenizer, PreTrainedTokenizerFast, AutoModel
 from tqdm import tqdm
 import argparse
-from src.utils import get_optimizers, write_data
+from src.utils import get_optimizers, write_data, get_autocast, get_weights_fingerprint
 import torch
 import torch.nn as nn
 import numpy as np
 import os
 import random
+import time
+import resource
 from src.model.universal_model import UniversalModel, UniversalModel_Roberta
+from src.model.static_inference import StaticShapeInference
+from src.model.onnx_export import export_onnx, OnnxDeductiveRunner
+from src.model.pair_pruning import gold_pair_ranks
+from src.model.beam_search import beam_search
+from src.model.early_exit import calibrate_exit_thresholds
+from src.model.lora import inject_lora, save_lora_model, has_lora_model, load_lora_model
+from src.model.encoder_cache import freeze_encoder, load_or_build_encoder_cache
+from src.model.low_rank import compress_model, save_low_rank_model, has_low_rank_model, load_low_rank_model
+from src.model.distillation import build_student_config, init_student_from_teacher, logits_distillation_loss, hidden_distillation_loss
+from src.model.quantization import quantize_model, save_quantized_model, has_quantized_model, load_quantized_model
 from collections import Counter
 from src.eval.utils import is_value_correct
-from typing import List, Tuple
+from typing import List, Tuple, Dict
 import logging
 from transformers import set_seed
 
@@ -68,13 +80,56 @@ def parse_arguments(parser:argparse.ArgumentParser):
     parser.add_argument('--train_max_height', type=int, default=100, help="the maximum height for training data")
 
     parser.add_argument('--var_update_mode', type=str, default="gru", help="variable update mode")
+    parser.add_argument('--factorized_projection', type=int, default=0, choices=[0, 1], help="project the variables of a pair once per variable (same parameters and logits)")
+    parser.add_argument('--fused_operators', type=int, default=0, choices=[0, 1], help="evaluate all operator layers with one fused projection (checkpoints of both layouts can be loaded)")
+    parser.add_argument('--constant_pair_cache', type=int, default=0, choices=[0, 1], help="score the constant-constant pairs once per batch instead of per instance (cached in evaluation)")
+    parser.add_argument('--eval_early_exit', type=int, default=0, choices=[0, 1], help="in evaluation, stop decoding the instances (and the batch) once they predict the stop label")
+    parser.add_argument('--train_compaction', type=int, default=0, choices=[0, 1], help="in training, only process the instances that still have a gold step at each height")
+    parser.add_argument('--height_parallel', type=int, default=0, choices=[0, 1], help="in training, compute the teacher-forced states first and score the pairs of all heights in one batched pass")
+    parser.add_argument('--incremental_scoring', type=int, default=0, choices=[0, 1], help="in inference without variable update (var_update_mode other than gru/attn), only score the pairs with the new intermediate at each height")
+    parser.add_argument('--star_attention', type=int, default=0, choices=[0, 1], help="with var_update_mode attn, update each variable by attending to itself and the new intermediate only (star-shaped attention in linear time)")
+    parser.add_argument('--pair_chunk_size', type=int, default=0, help="in inference, score the pairs in chunks of this size and keep only the running best pair, bounding the peak memory by the chunk size (0: all pairs at once)")
+    parser.add_argument('--static_inference', type=int, default=0, choices=[0, 1], help="in test mode, decode with the static-shape inference path (padded shape buckets, no host sync)")
+    parser.add_argument('--static_compile', type=int, default=1, choices=[0, 1], help="compile the static-shape inference path with torch.compile (each bucket once at startup)")
+    parser.add_argument('--static_seq_len_buckets', type=int, nargs='+', default=[64, 128, 256, 512], help="sequence length buckets of the static-shape inference")
+    parser.add_argument('--static_num_variable_buckets', type=int, nargs='+', default=[4, 8, 16, 32], help="number of quantities buckets of the static-shape inference")
+    parser.add_argument('--static_height_buckets', type=int, nargs='+', default=[2, 4, 8], help="height buckets of the static-shape inference, the model height is always the last one")
+    parser.add_argument('--pair_recall_ks', type=int, nargs='+', default=[5, 10, 20, 50, 100], help="in pair_recall mode, the k values of the gold-pair recall@k of the top-k pruning first stage")
+    parser.add_argument('--quantize', type=int, default=0, choices=[0, 1], help="in test mode, also evaluate the dynamic int8 quantized model on CPU (saved/loaded as a quantized checkpoint in the model folder) and report the accuracy before vs. after")
+    parser.add_argument('--activation_checkpointing', type=int, default=0, choices=[0, 1], help="in training, checkpoint the encoder layers and the pair scoring of each height (recomputed in backward), trading time for activation memory")
+    parser.add_argument('--pair_top_k', type=int, default=0, help="in inference, keep the top-k pairs per instance and height by the sum of the variable_scorer scores, and only score those with the operator layers and the stopper (0: all pairs)")
+    parser.add_argument('--sampled_negatives', type=int, default=0, help="in training, score only the gold pair and this number of sampled negative pairs at each height instead of all pairs (0: all pairs)")
+    parser.add_argument('--negative_source', type=str, default="scorer", choices=["scorer", "random"], help="how the negative pairs are sampled: scorer (the pairs with the top variable_scorer sums) or random (uniform over the valid pairs)")
+    parser.add_argument('--adaptive_exit', type=int, default=0, choices=[0, 1], help="in test mode, exit the encoder early at the exit_layers when the first-step margin of the exit head reaches the threshold of the exit")
+    parser.add_argument('--exit_thresholds', type=float, nargs='*', default=[], help="the first-step margin threshold of each exit layer (default: calibrated on the dev file)")
+    parser.add_argument('--exit_agreement', type=float, default=0.99, help="the calibrated thresholds keep this agreement of the exiting instances with the first step of the last layer on the dev file")
+    parser.add_argument('--exit_layers', type=int, nargs='*', default=[], help="the encoder layers (1-based) with an exit head, trained with an auxiliary deductive loss each and used by --adaptive_exit in inference")
+    parser.add_argument('--beam_size', type=int, default=1, help="in evaluation, decode with a beam search of this size (the encoder still runs once per problem) and keep the n-best derivations in the result file (1: greedy)")
+    parser.add_argument('--lora_rank', type=int, default=0, help="train low-rank adapters of this rank on the encoder linears with the encoder frozen, and save only the adapters and the deductive head (0: full fine-tuning)")
+    parser.add_argument('--lora_alpha', type=float, default=16.0, help="the scaling of the LoRA update is lora_alpha / lora_rank")
+    parser.add_argument('--lora_dropout', type=float, default=0.0, help="the dropout on the input of the LoRA update")
+    parser.add_argument('--teacher_folder', type=str, default="", help="in distill mode, the model_files folder of the trained teacher")
+    parser.add_argument('--student_num_layers', type=int, default=4, help="in distill mode, the number of encoder layers of the student")
+    parser.add_argument('--student_hidden_size', type=int, default=0, help="in distill mode, the hidden size of the student (0: the teacher's)")
+    parser.add_argument('--student_num_attention_heads', type=int, default=0, help="in distill mode, the number of attention heads of the student (0: the teacher's)")
+    parser.add_argument('--student_intermediate_size', type=int, default=0, help="in distill mode, the intermediate size of the student (0: the teacher's, or 4x the student hidden size)")
+    parser.add_argument('--distill_temperature', type=float, default=1.0, help="in distill mode, the temperature of the logits distillation")
+    parser.add_argument('--distill_gold_weight', type=float, default=1.0, help="in distill mode, the weight of the gold loss of the student")
+    parser.add_argument('--distill_logits_weight', type=float, default=1.0, help="in distill mode, the weight of the KL divergence to the teacher logits of each height")
+    parser.add_argument('--distill_hidden_weight', type=float, default=1.0, help="in distill mode, the weight of the mean squared error to the teacher hidden states")
+    parser.add_argument('--low_rank', type=int, default=0, help="in test mode, also evaluate the model with the operator layers and the stopper transformation compressed to this rank by SVD (saved/loaded as a low-rank checkpoint in the model folder) and report the accuracy before vs. after (0: no compression)")
+    parser.add_argument('--low_rank_finetune_epochs', type=int, default=0, help="fine-tune the deductive head of the low-rank model on the training file for this number of epochs before saving it (0: no fine-tuning)")
+    parser.add_argument('--frozen_encoder_cache', type=int, default=0, choices=[0, 1], help="freeze the encoder, cache its variable states of the training set in a memory-mapped fp16 file and train only the deductive head on the cache")
+    parser.add_argument('--encoder_cache_dir', type=str, default="", help="the folder of the encoder output cache (default: model_files/{model_folder}/encoder_cache)")
+    parser.add_argument('--full_scoring_interval', type=int, default=0, help="with sampled_negatives, train every this number of epochs with all pairs scored (0: never)")
 
     # training
-    parser.add_argument('--mode', type=str, default="train", choices=["train", "test"], help="learning rate of the AdamW optimizer")
+    parser.add_argument('--mode', type=str, default="train", choices=["train", "test", "export_onnx", "pair_recall", "distill"], help="learning rate of the AdamW optimizer")
     parser.add_argument('--learning_rate', type=float, default=2e-5, help="learning rate of the AdamW optimizer")
     parser.add_argument('--max_grad_norm', type=float, default=1.0, help="The maximum gradient norm")
     parser.add_argument('--num_epochs', type=int, default=20, help="The number of epochs to run")
     parser.add_argument('--fp16', type=int, default=0, choices=[0,1], help="using fp16 to train the model")
+    parser.add_argument('--precision', type=str, default="fp32", choices=["fp32", "bf16", "fp16"], help="autocast precision of training and evaluation on the device (cuda or cpu), e.g., bf16 on CPU")
 
     parser.add_argument('--parallel', type=int, default=0, choices=[0,1], help="parallelizing model")
 
@@ -92,6 +147,16 @@ def parse_arguments(parser:argparse.ArgumentParser):
     return args
 
 
+def get_peak_memory_info(dev: torch.device) -> str:
+    """
+    Peak memory since the last reset: allocated tensors on GPU, resident set size of the process on CPU.
+    """
+    if dev.type == "cuda":
+        return f"peak GPU memory: {torch.cuda.max_memory_allocated(dev) / 1024 ** 2:.0f}MB"
+    ## ru_maxrss is in KB on Linux
+    return f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f}MB"
+
+
 def train(config: Config, train_dataloader: DataLoader, num_epochs: int,
           bert_model_name: str, num_labels: int,
           dev: torch.device, tokenizer: PreTrainedTokenizerFast, valid_dataloader: DataLoader = None, test_dataloader: DataLoader = None,
@@ -106,7 +171,39 @@ def train(config: Config, train_dataloader: DataLoader, num_epochs: int,
                                            num_labels=num_labels,
                                            height=config.height,
                                            constant_num=constant_num,
-                                            var_update_mode=config.var_update_mode, return_dict=True).to(dev)
+                                            var_update_mode=config.var_update_mode,
+                                            factorized_projection=config.factorized_projection,
+                                            fused_operators=config.fused_operators,
+                                            constant_pair_cache=config.constant_pair_cache,
+                                            eval_early_exit=config.eval_early_exit,
+                                            train_compaction=config.train_compaction,
+                                            height_parallel=config.height_parallel,
+                                            incremental_scoring=config.incremental_scoring,
+                                            star_attention=config.star_attention,
+                                            pair_chunk_size=config.pair_chunk_size,
+                                            activation_checkpointing=config.activation_checkpointing,
+                                            pair_top_k=config.pair_top_k,
+                                            sampled_negatives=config.sampled_negatives,
+                                            negative_source=config.negative_source,
+                                            exit_layers=config.exit_layers,
+                                            return_dict=True).to(dev)
+
+    if config.lora_rank > 0:
+        wrapped = inject_lora(model, config.lora_rank, alpha=config.lora_alpha, dropout=config.lora_dropout)
+        logger.info(f"[Model Info] LoRA rank {config.lora_rank} on {len(wrapped)} encoder linears, trainable parameters: "
+                    f"{sum(p.numel() for p in model.parameters() if p.requires_grad)} / {sum(p.numel() for p in model.parameters())}")
+
+    encoder_cache = None
+    if config.frozen_encoder_cache:
+        assert config.lora_rank == 0, "the encoder output cache needs a frozen encoder, it cannot be used with LoRA"
+        freeze_encoder(model)
+        cache_dir = config.encoder_cache_dir if config.encoder_cache_dir else f"model_files/{config.model_folder}/encoder_cache"
+        cache_file = f"{cache_dir}/{os.path.basename(config.train_file)}.{bert_model_name.replace('/', '_')}.f16"
+        ## the cache rows are the `instance_id` of the (shuffled) training features
+        encoder_cache = load_or_build_encoder_cache(model, train_dataloader.dataset, cache_file, dev, batch_size=config.batch_size,
+                                                    precision=config.precision, encoder_name=bert_model_name)
+        logger.info(f"[Model Info] Frozen encoder, training the deductive head on the encoder output cache {cache_file} "
+                    f"({encoder_cache.meta['num_instances']} instances)")
 
     scaler = None
     if config.fp16:
@@ -121,9 +218,15 @@ def train(config: Config, train_dataloader: DataLoader, num_epochs: int,
     for epoch in range(num_epochs):
         total_loss = 0
         model.train()
+        ## the periodic full-scoring epoch keeps the sampled objective honest
+        full_scoring = config.full_scoring_interval > 0 and epoch % config.full_scoring_interval == config.full_scoring_interval - 1
+        model.sampled_objective_enabled = not full_scoring
+        epoch_start_time = time.time()
+        if dev.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(dev)
         for iter, feature in tqdm(enumerate(train_dataloader, 1), desc="--training batch", total=len(train_dataloader)):
             optimizer.zero_grad()
-            with torch.cuda.amp.autocast(enabled=bool(config.fp16)):
+            with get_autocast(config.precision, dev):
                 loss = model(input_ids=feature.input_ids.to(dev), attention_mask=feature.attention_mask.to(dev),
                              token_type_ids=feature.token_type_ids.to(dev),
                              variable_indexs_start=feature.variable_indexs_start.to(dev),
@@ -131,6 +234,7 @@ def train(config: Config, train_dataloader: DataLoader, num_epochs: int,
                              num_variables = feature.num_variables.to(dev),
                              variable_index_mask= feature.variable_index_mask.to(dev),
                              labels=feature.labels.to(dev), label_height_mask= feature.label_height_mask.to(dev),
+                             var_hidden_states=encoder_cache.get(feature.instance_id, feature.variable_indexs_start.size(1)).to(dev) if encoder_cache is not None else None,
                              return_dict=True).loss
             if config.fp16:
                 scaler.scale(loss).backward()
@@ -149,11 +253,14 @@ def train(config: Config, train_dataloader: DataLoader, num_epochs: int,
             if iter % 1000 == 0:
                 logger.info(f"epoch: {epoch}, iteration: {iter}, current mean loss: {total_loss/iter:.2f}")
         logger.info(f"Finish epoch: {epoch}, loss: {total_loss:.2f}, mean loss: {total_loss/len(train_dataloader):.2f}")
+        logger.info(f"[Train Info] epoch: {epoch}, training time: {time.time() - epoch_start_time:.1f}s, {get_peak_memory_info(dev)}, "
+                    f"activation checkpointing: {config.activation_checkpointing}, "
+                    f"objective: {'sampled negatives' if config.sampled_negatives > 0 and not full_scoring else 'all pairs'}")
         if valid_dataloader is not None:
-            equ_acc, val_acc_performance = evaluate(valid_dataloader, model, dev, uni_labels=config.uni_labels, fp16=bool(config.fp16), constant_values=constant_values)
+            equ_acc, val_acc_performance = evaluate(valid_dataloader, model, dev, uni_labels=config.uni_labels, precision=config.precision, constant_values=constant_values)
             test_equ_acc, test_val_acc = -1, -1
             if test_dataloader is not None:
-                test_equ_acc, test_val_acc = evaluate(test_dataloader, model, dev, uni_labels=config.uni_labels, fp16=bool(config.fp16), constant_values=constant_values,
+                test_equ_acc, test_val_acc = evaluate(test_dataloader, model, dev, uni_labels=config.uni_labels, precision=config.precision, constant_values=constant_values,
                          res_file=res_file, err_file=error_file)
             if val_acc_performance > best_val_acc_performance:
                 logger.info(f"[Model Info] Saving the best model with best valid val acc {val_acc_performance:.6f} at epoch {epoch} ("
@@ -162,68 +269,236 @@ def train(config: Config, train_dataloader: DataLoader, num_epochs: int,
                             f")")
                 best_val_acc_performance = val_acc_performance
                 model_to_save = model.module if hasattr(model, "module") else model
-                model_to_save.save_pretrained(f"model_files/{config.model_folder}")
+                if config.lora_rank > 0:
+                    ## only the adapters and the deductive head
+                    save_lora_model(model_to_save, f"model_files/{config.model_folder}")
+                else:
+                    model_to_save.save_pretrained(f"model_files/{config.model_folder}")
                 tokenizer.save_pretrained(f"model_files/{config.model_folder}")
     logger.info(f"[Model Info] Best validation performance: {best_val_acc_performance}")
-    model = MODEL_CLASS.from_pretrained(f"model_files/{config.model_folder}",
+    ## the LoRA checkpoint is loaded into the base pretrained model
+    model = MODEL_CLASS.from_pretrained(bert_model_name if config.lora_rank > 0 else f"model_files/{config.model_folder}",
                                            num_labels=num_labels,
                                            height=config.height,
-                                           constant_num=constant_num, var_update_mode=config.var_update_mode).to(dev)
+                                           constant_num=constant_num, var_update_mode=config.var_update_mode,
+                                           factorized_projection=config.factorized_projection,
+                                           fused_operators=config.fused_operators,
+                                            constant_pair_cache=config.constant_pair_cache,
+                                            eval_early_exit=config.eval_early_exit,
+                                            train_compaction=config.train_compaction,
+                                            height_parallel=config.height_parallel,
+                                            incremental_scoring=config.incremental_scoring,
+                                            star_attention=config.star_attention,
+                                            pair_chunk_size=config.pair_chunk_size,
+                                            activation_checkpointing=config.activation_checkpointing,
+                                            pair_top_k=config.pair_top_k,
+                                            sampled_negatives=config.sampled_negatives,
+                                            negative_source=config.negative_source,
+                                            exit_layers=config.exit_layers).to(dev)
+    if config.lora_rank > 0:
+        load_lora_model(model, f"model_files/{config.model_folder}")
     if config.fp16:
         model.half()
-        model.save_pretrained(f"model_files/{config.model_folder}")
-        tokenizer.save_pretrained(f"model_files/{config.model_folder}")
+        if config.lora_rank == 0:
+            model.save_pretrained(f"model_files/{config.model_folder}")
+            tokenizer.save_pretrained(f"model_files/{config.model_folder}")
     return model
 
-def get_batched_prediction_consider_multiple_m0(feature, all_logits: torch.FloatTensor, constant_num: int):
-    batch_size, max_num_variable = feature.variable_indexs_start.size()
-    device = feature.variable_indexs_start.device
-    batched_prediction = [[] for _ in range(batch_size)]
-    for k, logits in enumerate(all_logits):
-        current_max_num_variable = max_num_variable + constant_num + k
-        num_var_range = torch.arange(0, current_max_num_variable, device=feature.variable_indexs_start.device)
-        combination = torch.combinations(num_var_range, r=2, with_replacement=True)  ##number_of_combinations x 2
-        num_combinations, _ = combination.size()
-
-        best_temp_logits, best_temp_stop_label = logits.max(dim=-1)  ## batch_size, num_combinations/num_m0, num_labels
-        best_temp_score, best_temp_label = best_temp_logits.max(dim=-1)  ## batch_size, num_combinations
-        best_m0_score, best_comb = best_temp_score.max(dim=-1)  ## batch_size
-        best_label = torch.gather(best_temp_label, 1, best_comb.unsqueeze(-1)).squeeze(-1)  ## batch_size
-        b_idxs = [bidx for bidx in range(batch_size)]
-        best_stop_label = best_temp_stop_label[b_idxs, best_comb, best_label] ## batch size
-
-        # batch_size x 2
-        best_comb_var_idxs = torch.gather(combination.unsqueeze(0).expand(batch_size, num_combinations, 2), 1,
-                                          best_comb.unsqueeze(1).unsqueeze(2).expand(batch_size, 1, 2).to(device)).squeeze(1)
-        best_comb_var_idxs = best_comb_var_idxs.cpu().numpy()
-        best_labels = best_label.cpu().numpy()
-        curr_best_stop_labels = best_stop_label.cpu().numpy()
-        for b_idx, (best_comb_idx, best_label, stop_label) in enumerate(zip(best_comb_var_idxs, best_labels, curr_best_stop_labels)):  ## within each instances:
-            left, right = best_comb_idx
-            curr_label = [left, right, best_label, stop_label]
-            batched_prediction[b_idx].append(curr_label)
-    return batched_prediction
-
-
-def evaluate(valid_dataloader: DataLoader, model: nn.Module, dev: torch.device, fp16:bool, constant_values: List, uni_labels:List,
-             res_file: str= None, err_file:str = None) -> Tuple[float, float]:
+
+def get_model_kwargs(config: Config, constant_num: int) -> Dict:
+    """
+    The arguments of the model classes besides the config (distillation teacher and student).
+    """
+    return dict(height=config.height,
+                constant_num=constant_num,
+                var_update_mode=config.var_update_mode,
+                factorized_projection=config.factorized_projection,
+                fused_operators=config.fused_operators,
+                constant_pair_cache=config.constant_pair_cache,
+                eval_early_exit=config.eval_early_exit,
+                train_compaction=config.train_compaction,
+                height_parallel=config.height_parallel,
+                incremental_scoring=config.incremental_scoring,
+                star_attention=config.star_attention,
+                pair_chunk_size=config.pair_chunk_size,
+                activation_checkpointing=config.activation_checkpointing,
+                pair_top_k=config.pair_top_k,
+                sampled_negatives=config.sampled_negatives,
+                negative_source=config.negative_source,
+                exit_layers=config.exit_layers)
+
+
+def distill(config: Config, train_dataloader: DataLoader, num_epochs: int,
+            bert_model_name: str, num_labels: int,
+            dev: torch.device, tokenizer: PreTrainedTokenizerFast, valid_dataloader: DataLoader = None,
+            constant_values: List = None):
+    """
+    Train a smaller student (`build_student_config`) from the trained teacher in `model_files/{config.teacher_folder}`, everything loaded locally.
+    The student is trained with its gold loss plus the distillation losses of the teacher-forced logits and the encoder hidden states,
+    evaluated with `evaluate` and the best one is saved in `model_files/{config.model_folder}`.
+    """
+    t_total = int(len(train_dataloader) * num_epochs)
+    constant_num = len(constant_values) if constant_values else 0
+    MODEL_CLASS = class_name_2_model[bert_model_name]
+    model_kwargs = get_model_kwargs(config, constant_num)
+    teacher = MODEL_CLASS.from_pretrained(f"model_files/{config.teacher_folder}", num_labels=num_labels, **model_kwargs).to(dev)
+    teacher.eval()
+    student_config = build_student_config(teacher.config, num_hidden_layers=config.student_num_layers, hidden_size=config.student_hidden_size,
+                                          num_attention_heads=config.student_num_attention_heads, intermediate_size=config.student_intermediate_size)
+    ## the exit layers of the teacher are not meaningful for the student
+    student = MODEL_CLASS(student_config, **dict(model_kwargs, exit_layers=[])).to(dev)
+    copied = init_student_from_teacher(student, teacher)
+    logger.info(f"[Model Info] student: {student_config.num_hidden_layers} layers, hidden size {student_config.hidden_size}, "
+                f"{sum(p.numel() for p in student.parameters())} parameters ({len(copied)} tensors copied from the teacher"
+                f"{'' if len(copied) > 0 else ', randomly initialized: the hidden sizes differ'}), "
+                f"teacher: {sum(p.numel() for p in teacher.parameters())} parameters")
+    ## the full logits of all pairs are distilled
+    teacher.sampled_objective_enabled = False
+    student.sampled_objective_enabled = False
+    hidden_projection = nn.Linear(student_config.hidden_size, teacher.config.hidden_size).to(dev) if student_config.hidden_size != teacher.config.hidden_size else None
+    distill_modules = nn.ModuleDict({"student": student})
+    if hidden_projection is not None:
+        distill_modules["hidden_projection"] = hidden_projection
+
+    scaler = None
+    if config.fp16:
+        scaler = torch.cuda.amp.GradScaler(enabled=bool(config.fp16))
+    optimizer, scheduler = get_optimizers(config, distill_modules, t_total)
+    distill_modules.zero_grad()
+
+    best_val_acc_performance = -1
+    os.makedirs(f"model_files/{config.model_folder}", exist_ok=True)
+    for epoch in range(num_epochs):
+        total_loss = 0
+        distill_modules.train()
+        epoch_start_time = time.time()
+        for iter, feature in tqdm(enumerate(train_dataloader, 1), desc="--distillation batch", total=len(train_dataloader)):
+            optimizer.zero_grad()
+            inputs = dict(input_ids=feature.input_ids.to(dev), attention_mask=feature.attention_mask.to(dev),
+                          token_type_ids=feature.token_type_ids.to(dev),
+                          variable_indexs_start=feature.variable_indexs_start.to(dev),
+                          variable_indexs_end=feature.variable_indexs_end.to(dev),
+                          num_variables=feature.num_variables.to(dev),
+                          variable_index_mask=feature.variable_index_mask.to(dev),
+                          labels=feature.labels.to(dev), label_height_mask=feature.label_height_mask.to(dev),
+                          output_hidden_states=True, return_dict=True)
+            with get_autocast(config.precision, dev):
+                with torch.no_grad():
+                    teacher_output = teacher(**inputs)
+                student_output = student(**inputs)
+                loss = (config.distill_gold_weight * student_output.loss
+                        + config.distill_logits_weight * logits_distillation_loss(student_output.all_logits, teacher_output.all_logits,
+                                                                                  inputs["label_height_mask"], temperature=config.distill_temperature)
+                        + config.distill_hidden_weight * hidden_distillation_loss(student_output.hidden_states, teacher_output.hidden_states,
+                                                                                  inputs["attention_mask"], hidden_projection))
+            if config.fp16:
+                scaler.scale(loss).backward()
+                scaler.unscale_(optimizer)
+            else:
+                loss.backward()
+            torch.nn.utils.clip_grad_norm_(distill_modules.parameters(), config.max_grad_norm)
+            total_loss += loss.item()
+            if config.fp16:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            scheduler.step()
+            distill_modules.zero_grad()
+            if iter % 1000 == 0:
+                logger.info(f"epoch: {epoch}, iteration: {iter}, current mean loss: {total_loss/iter:.2f}")
+        logger.info(f"Finish epoch: {epoch}, loss: {total_loss:.2f}, mean loss: {total_loss/len(train_dataloader):.2f}, "
+                    f"distillation time: {time.time() - epoch_start_time:.1f}s")
+        if valid_dataloader is not None:
+            equ_acc, val_acc_performance = evaluate(valid_dataloader, student, dev, uni_labels=config.uni_labels, precision=config.precision, constant_values=constant_values)
+            if val_acc_performance > best_val_acc_performance:
+                logger.info(f"[Model Info] Saving the best student with best valid val acc {val_acc_performance:.6f} at epoch {epoch} (valid_equ: {equ_acc:.6f})")
+                best_val_acc_performance = val_acc_performance
+                student.save_pretrained(f"model_files/{config.model_folder}")
+                tokenizer.save_pretrained(f"model_files/{config.model_folder}")
+    logger.info(f"[Model Info] Best validation performance of the student: {best_val_acc_performance}")
+    return MODEL_CLASS.from_pretrained(f"model_files/{config.model_folder}", num_labels=num_labels, **dict(model_kwargs, exit_layers=[])).to(dev)
+
+
+def check_onnx_parity(valid_dataloader: DataLoader, model: nn.Module, runner: OnnxDeductiveRunner, dev: torch.device) -> float:
+    """
+    Compare the predictions of the onnxruntime loop with `deductive_forward` (up to the first stop label) and log the latency of both.
+    :return: the ratio of instances with the same predictions
+    """
+    model.eval()
+    num_same, num_total = 0, 0
+    torch_time, onnx_time = 0.0, 0.0
+    for feature in tqdm(valid_dataloader, desc="--onnx parity", total=len(valid_dataloader)):
+        start_time = time.time()
+        with torch.no_grad():
+            torch_prediction = model(input_ids=feature.input_ids.to(dev), attention_mask=feature.attention_mask.to(dev),
+                                     token_type_ids=feature.token_type_ids.to(dev),
+                                     variable_indexs_start=feature.variable_indexs_start.to(dev),
+                                     variable_indexs_end=feature.variable_indexs_end.to(dev),
+                                     num_variables=feature.num_variables.to(dev),
+                                     variable_index_mask=feature.variable_index_mask.to(dev),
+                                     return_dict=True, is_eval=True, return_all_logits=False).predictions.cpu().numpy().tolist()
+        torch_time += time.time() - start_time
+        start_time = time.time()
+        onnx_prediction = runner.predict(feature.input_ids.numpy(), feature.attention_mask.numpy(), feature.token_type_ids.numpy(),
+                                         feature.variable_indexs_start.numpy(), feature.variable_indexs_end.numpy(),
+                                         feature.num_variables.numpy()).tolist()
+        onnx_time += time.time() - start_time
+        for inst_torch_prediction, inst_onnx_prediction in zip(torch_prediction, onnx_prediction):
+            truncated = []
+            for inst_prediction in [inst_torch_prediction, inst_onnx_prediction]:
+                inst_prediction = [[int(v) for v in step] for step in inst_prediction]
+                for p, (left, right, op_id, stop_id) in enumerate(inst_prediction):
+                    if stop_id == 1:
+                        inst_prediction = inst_prediction[:(p + 1)]
+                        break
+                truncated.append(inst_prediction)
+            num_same += int(truncated[0] == truncated[1])
+            num_total += 1
+    logger.info(f"[ONNX Info] same predictions: {num_same}/{num_total} = {num_same / num_total * 100:.2f}%, "
+                f"pytorch time: {torch_time:.2f}s, onnxruntime time: {onnx_time:.2f}s")
+    return num_same / num_total
+
+
+def evaluate(valid_dataloader: DataLoader, model: nn.Module, dev: torch.device, precision: str, constant_values: List, uni_labels:List,
+             res_file: str= None, err_file:str = None, static_runner: StaticShapeInference = None, beam_size: int = 1) -> Tuple[float, float]:
     model.eval()
     predictions = []
     labels = []
+    nbest_derivations = []
+    exit_depths = []  ## the encoder layer each instance is decoded from, with early exit in the encoder
     constant_num = len(constant_values) if constant_values else 0
     with torch.no_grad():
         for index, feature in tqdm(enumerate(valid_dataloader), desc="--validation", total=len(valid_dataloader)):
-            with torch.cuda.amp.autocast(enabled=fp16):
+            with get_autocast(precision, dev):
                 module = model.module if hasattr(model, 'module') else model
-                all_logits = module(input_ids=feature.input_ids.to(dev), attention_mask=feature.attention_mask.to(dev),
+                if static_runner is not None:
+                    batched_prediction = static_runner.predict(input_ids=feature.input_ids.to(dev), attention_mask=feature.attention_mask.to(dev),
+                                                               token_type_ids=feature.token_type_ids.to(dev),
+                                                               variable_indexs_start=feature.variable_indexs_start.to(dev),
+                                                               variable_indexs_end=feature.variable_indexs_end.to(dev),
+                                                               num_variables=feature.num_variables.to(dev)).cpu().numpy().tolist()
+                elif beam_size > 1:
+                    batched_nbest = beam_search(module, module.base_model, input_ids=feature.input_ids.to(dev), attention_mask=feature.attention_mask.to(dev),
+                                                token_type_ids=feature.token_type_ids.to(dev),
+                                                variable_indexs_start=feature.variable_indexs_start.to(dev),
+                                                variable_indexs_end=feature.variable_indexs_end.to(dev),
+                                                num_variables=feature.num_variables.to(dev), beam_size=beam_size)
+                    batched_prediction = [nbest[0][1] for nbest in batched_nbest]
+                    nbest_derivations.extend(batched_nbest)
+                else:
+                    output = module(input_ids=feature.input_ids.to(dev), attention_mask=feature.attention_mask.to(dev),
                              token_type_ids=feature.token_type_ids.to(dev),
                              variable_indexs_start=feature.variable_indexs_start.to(dev),
                              variable_indexs_end=feature.variable_indexs_end.to(dev),
                              num_variables = feature.num_variables.to(dev),
                              variable_index_mask= feature.variable_index_mask.to(dev),
                              labels=feature.labels.to(dev), label_height_mask= feature.label_height_mask.to(dev),
-                             return_dict=True, is_eval=True).all_logits
-                batched_prediction = get_batched_prediction_consider_multiple_m0(feature=feature, all_logits=all_logits, constant_num=constant_num)
+                             return_dict=True, is_eval=True, return_all_logits=False)
+                    ## a single copy to CPU per batch of the (batch_size, height, 4) predictions
+                    batched_prediction = output.predictions.cpu().numpy().tolist()
+                    if output.exit_layers is not None:
+                        exit_depths.extend(output.exit_layers.tolist())
                 for b, inst_predictions in enumerate(batched_prediction):
                     for p, prediction_step in enumerate(inst_predictions):
                         left, right, op_id, stop_id = prediction_step
@@ -243,10 +518,15 @@ def evaluate(valid_dataloader: DataLoader, model: nn.Module, dev: torch.device,
     corr = 0
     num_label_step_corr = Counter()
     num_label_step_total = Counter()
+    num_exit_corr = Counter()
+    num_exit_val_corr = Counter()
+    num_exit_total = Counter()
+    inst_exit_depths = exit_depths if len(exit_depths) > 0 else [None] * len(predictions)
     insts = valid_dataloader.dataset.insts
     number_instances_remove = valid_dataloader.dataset.number_instances_remove
-    for inst_predictions, inst_labels in zip(predictions, labels):
+    for inst_predictions, inst_labels, exit_depth in zip(predictions, labels, inst_exit_depths):
         num_label_step_total[len(inst_labels)] += 1
+        num_exit_total[exit_depth] += 1
         if len(inst_predictions) != len(inst_labels):
             continue
         is_correct = True
@@ -256,6 +536,7 @@ def evaluate(valid_dataloader: DataLoader, model: nn.Module, dev: torch.device,
                 break
         if is_correct:
             num_label_step_corr[len(inst_labels)] += 1
+            num_exit_corr[exit_depth] += 1
             corr += 1
     total = len(labels)
     adjusted_total = total + number_instances_remove
@@ -267,12 +548,13 @@ def evaluate(valid_dataloader: DataLoader, model: nn.Module, dev: torch.device,
     num_label_step_val_corr = Counter()
     err = []
     corr = 0
-    for inst_predictions, inst_labels, inst in zip(predictions, labels, insts):
+    for inst_predictions, inst_labels, inst, exit_depth in zip(predictions, labels, insts, inst_exit_depths):
         num_list = inst["num_list"]
         is_value_corr, predict_value, gold_value, pred_ground_equation, gold_ground_equation = is_value_correct(inst_predictions, inst_labels, num_list, num_constant=constant_num, uni_labels=uni_labels, constant_values=constant_values)
         val_corr += 1 if is_value_corr else 0
         if is_value_corr:
             num_label_step_val_corr[len(inst_labels)] += 1
+            num_exit_val_corr[exit_depth] += 1
             corr += 1
         else:
             err.append(inst)
@@ -280,6 +562,8 @@ def evaluate(valid_dataloader: DataLoader, model: nn.Module, dev: torch.device,
         inst["gold_value"] = gold_value
         inst['pred_ground_equation'] = pred_ground_equation
         inst['gold_ground_equation'] = gold_ground_equation
+    for nbest, inst in zip(nbest_derivations, insts):
+        inst["nbest_predictions"] = [{"score": score, "steps": steps} for score, steps in nbest]
     val_acc = val_corr * 1.0 / adjusted_total
     logger.info(f"[Info] Value accuracy: {val_acc * 100:.2f}%, total: {total}, corr: {val_corr}, adjusted_total: {adjusted_total}")
     for key in num_label_step_total:
@@ -287,12 +571,189 @@ def evaluate(valid_dataloader: DataLoader, model: nn.Module, dev: torch.device,
         curr_val_corr = num_label_step_val_corr[key]
         curr_total = num_label_step_total[key]
         logger.info(f"[Info] step num: {key} Acc.:{curr_corr*1.0/curr_total * 100:.2f} ({curr_corr}/{curr_total}) val acc: {curr_val_corr*1.0/curr_total * 100:.2f} ({curr_val_corr}/{curr_total})")
+    if len(exit_depths) > 0:
+        ## the layer-exit histogram and the accuracy per exit depth
+        for key in sorted(num_exit_total):
+            curr_corr = num_exit_corr[key]
+            curr_val_corr = num_exit_val_corr[key]
+            curr_total = num_exit_total[key]
+            logger.info(f"[Exit Info] exit layer: {key} instances: {curr_total} ({curr_total*1.0/total * 100:.2f}%) Acc.:{curr_corr*1.0/curr_total * 100:.2f} "
+                        f"({curr_corr}/{curr_total}) val acc: {curr_val_corr*1.0/curr_total * 100:.2f} ({curr_val_corr}/{curr_total})")
     if res_file is not None:
         write_data(file=res_file, data=insts)
     if err_file is not None:
         write_data(file=err_file, data=err)
     return acc, val_acc
 
+def report_pair_recall(valid_dataloader: DataLoader, model: nn.Module, dev: torch.device, ks: List[int]) -> Counter:
+    """
+    Gold-pair recall@k of the first stage of the top-k pair pruning, over all the gold steps and per height.
+    :return: the number of gold steps kept for each k
+    """
+    num_kept = Counter()
+    num_height_kept = Counter()
+    num_height_total = Counter()
+    for feature in tqdm(valid_dataloader, desc="--pair recall", total=len(valid_dataloader)):
+        ranks = gold_pair_ranks(model, input_ids=feature.input_ids.to(dev), attention_mask=feature.attention_mask.to(dev),
+                                token_type_ids=feature.token_type_ids.to(dev),
+                                variable_indexs_start=feature.variable_indexs_start.to(dev),
+                                variable_indexs_end=feature.variable_indexs_end.to(dev),
+                                num_variables=feature.num_variables.to(dev),
+                                labels=feature.labels.to(dev), label_height_mask=feature.label_height_mask.to(dev)).cpu().numpy()
+        for height in range(ranks.shape[1]):
+            height_ranks = ranks[:, height][ranks[:, height] >= 0]
+            num_height_total[height] += len(height_ranks)
+            for k in ks:
+                kept = int((height_ranks < k).sum())
+                num_kept[k] += kept
+                num_height_kept[(height, k)] += kept
+    total = sum(num_height_total.values())
+    for k in ks:
+        per_height = ", ".join(f"h{height}: {num_height_kept[(height, k)] * 100.0 / num_height_total[height]:.2f}"
+                               for height in sorted(num_height_total) if num_height_total[height] > 0)
+        logger.info(f"[Pair Recall] recall@{k}: {num_kept[k] * 100.0 / total:.2f} ({num_kept[k]}/{total}), per height: {per_height}")
+    return num_kept
+
+
+def time_inference(valid_dataloader: DataLoader, model: nn.Module, dev: torch.device, precision: str, num_repeats: int = 3,
+                   num_warmup_batches: int = 2) -> float:
+    """
+    The median time over `num_repeats` passes of the batched inference of `evaluate` (without the decoding of the predictions).
+    The batches are collated once beforehand, and `num_warmup_batches` batches are run first so that the first-call costs
+    (lazy initialization, allocator, kernel selection) are not counted.
+    """
+    model.eval()
+    features = list(valid_dataloader)
+
+    def run(batches: List) -> None:
+        with torch.no_grad():
+            for feature in batches:
+                with get_autocast(precision, dev):
+                    model(input_ids=feature.input_ids.to(dev), attention_mask=feature.attention_mask.to(dev),
+                          token_type_ids=feature.token_type_ids.to(dev),
+                          variable_indexs_start=feature.variable_indexs_start.to(dev),
+                          variable_indexs_end=feature.variable_indexs_end.to(dev),
+                          num_variables=feature.num_variables.to(dev),
+                          variable_index_mask=feature.variable_index_mask.to(dev),
+                          return_dict=True, is_eval=True, return_all_logits=False)
+        if dev.type == "cuda":
+            torch.cuda.synchronize(dev)
+
+    run(features[:num_warmup_batches])
+    pass_times = []
+    for _ in range(num_repeats):
+        start_time = time.time()
+        run(features)
+        pass_times.append(time.time() - start_time)
+    return float(np.median(pass_times))
+
+
+def evaluate_quantization(valid_dataloader: DataLoader, model: nn.Module, conf: Config, constant_values: List,
+                          res_file: str = None, err_file: str = None):
+    """
+    Evaluate the float model, then the dynamic int8 quantized model on CPU, and report the accuracy of both.
+    The speed-up compares the warmed-up inference time of the float and the int8 model, both on CPU.
+    The quantized checkpoint is loaded from the model folder if it was quantized from the same float weights,
+    otherwise the model is quantized and saved there.
+    """
+    equ_acc, val_acc = evaluate(valid_dataloader, model, conf.device, uni_labels=conf.uni_labels, precision=conf.precision, constant_values=constant_values)
+    model.cpu()
+    float_time = time_inference(valid_dataloader, model, torch.device("cpu"), precision="fp32")
+    quantized_folder = f"model_files/{conf.model_folder}"
+    fingerprint = get_weights_fingerprint(model)
+    if has_quantized_model(quantized_folder, fingerprint):
+        logger.info(f"[Model Info] Loading the quantized model from {quantized_folder}")
+        load_quantized_model(model, quantized_folder)
+    else:
+        logger.info(f"[Model Info] Quantizing the model and saving it to {quantized_folder} (no quantized model of these weights)")
+        quantize_model(model)
+        save_quantized_model(model, quantized_folder, fingerprint)
+    quantized_equ_acc, quantized_val_acc = evaluate(valid_dataloader, model, torch.device("cpu"), uni_labels=conf.uni_labels, precision="fp32",
+                                                    constant_values=constant_values, res_file=res_file, err_file=err_file)
+    quantized_time = time_inference(valid_dataloader, model, torch.device("cpu"), precision="fp32")
+    logger.info(f"[Quantization Info] float: equ acc ({conf.device}): {equ_acc * 100:.2f}, val acc: {val_acc * 100:.2f}, time (cpu): {float_time:.2f}s per pass")
+    logger.info(f"[Quantization Info] int8: equ acc (cpu): {quantized_equ_acc * 100:.2f}, val acc: {quantized_val_acc * 100:.2f}, time (cpu): {quantized_time:.2f}s per pass")
+    logger.info(f"[Quantization Info] difference: equ acc: {(quantized_equ_acc - equ_acc) * 100:+.2f}, val acc: {(quantized_val_acc - val_acc) * 100:+.2f}, "
+                f"speed-up: {float_time / quantized_time:.2f}x")
+
+
+def finetune_low_rank(model: nn.Module, train_dataloader: DataLoader, conf: Config, num_epochs: int):
+    """
+    Briefly fine-tune the deductive head of the low-rank model (the encoder is frozen) to recover the accuracy.
+    """
+    dev = conf.device
+    freeze_encoder(model)
+    optimizer, scheduler = get_optimizers(conf, model, len(train_dataloader) * num_epochs)
+    scaler = torch.cuda.amp.GradScaler(enabled=bool(conf.fp16))
+    for epoch in range(num_epochs):
+        total_loss = 0
+        model.train()
+        for feature in tqdm(train_dataloader, desc="--low-rank fine-tuning batch", total=len(train_dataloader)):
+            optimizer.zero_grad()
+            with get_autocast(conf.precision, dev):
+                loss = model(input_ids=feature.input_ids.to(dev), attention_mask=feature.attention_mask.to(dev),
+                             token_type_ids=feature.token_type_ids.to(dev),
+                             variable_indexs_start=feature.variable_indexs_start.to(dev),
+                             variable_indexs_end=feature.variable_indexs_end.to(dev),
+                             num_variables=feature.num_variables.to(dev),
+                             variable_index_mask=feature.variable_index_mask.to(dev),
+                             labels=feature.labels.to(dev), label_height_mask=feature.label_height_mask.to(dev),
+                             return_dict=True).loss
+            scaler.scale(loss).backward()
+            scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), conf.max_grad_norm)
+            total_loss += loss.item()
+            scaler.step(optimizer)
+            scaler.update()
+            scheduler.step()
+        logger.info(f"Finish low-rank fine-tuning epoch: {epoch}, loss: {total_loss:.2f}, mean loss: {total_loss/len(train_dataloader):.2f}")
+    for param in model.parameters():
+        param.requires_grad = True
+
+
+def get_low_rank_settings(model: nn.Module, conf: Config) -> Dict:
+    """
+    What a low-rank checkpoint is built from: the full weights and the fine-tuning settings.
+    """
+    settings = {"fingerprint": get_weights_fingerprint(model), "finetune_epochs": conf.low_rank_finetune_epochs}
+    if conf.low_rank_finetune_epochs > 0:
+        settings.update({"train_file": conf.train_file, "train_num": conf.train_num, "learning_rate": conf.learning_rate})
+    return settings
+
+
+def evaluate_low_rank(valid_dataloader: DataLoader, model: nn.Module, conf: Config, constant_values: List, low_rank_settings: Dict,
+                      train_dataloader: DataLoader = None, res_file: str = None, err_file: str = None):
+    """
+    Evaluate the full model, then the model with the operator layers and the stopper transformation compressed to `conf.low_rank`,
+    and report the accuracy and the warmed-up inference time (`time_inference`) of both. The low-rank checkpoint is loaded from the
+    model folder if it was built with the same `low_rank_settings` (`get_low_rank_settings`), otherwise the model is compressed
+    (and fine-tuned on `train_dataloader` if given) and saved there.
+    """
+    equ_acc, val_acc = evaluate(valid_dataloader, model, conf.device, uni_labels=conf.uni_labels, precision=conf.precision, constant_values=constant_values)
+    full_time = time_inference(valid_dataloader, model, conf.device, precision=conf.precision)
+    num_full_params = sum(p.numel() for module in [model.linears, model.stopper_transformation] for p in module.parameters())
+    low_rank_folder = f"model_files/{conf.model_folder}"
+    if has_low_rank_model(low_rank_folder, conf.low_rank, low_rank_settings):
+        logger.info(f"[Model Info] Loading the rank-{conf.low_rank} model from {low_rank_folder}")
+        load_low_rank_model(model, low_rank_folder, conf.low_rank)
+    else:
+        compressed = compress_model(model, conf.low_rank)
+        logger.info(f"[Model Info] Compressed {len(compressed)} layers to rank {conf.low_rank}, saving the model to {low_rank_folder}")
+        if train_dataloader is not None:
+            finetune_low_rank(model, train_dataloader, conf, num_epochs=conf.low_rank_finetune_epochs)
+        save_low_rank_model(model, low_rank_folder, conf.low_rank, low_rank_settings)
+    num_low_rank_params = sum(p.numel() for module in [model.linears, model.stopper_transformation] for p in module.parameters())
+    low_rank_equ_acc, low_rank_val_acc = evaluate(valid_dataloader, model, conf.device, uni_labels=conf.uni_labels, precision=conf.precision,
+                                                  constant_values=constant_values, res_file=res_file, err_file=err_file)
+    low_rank_time = time_inference(valid_dataloader, model, conf.device, precision=conf.precision)
+    logger.info(f"[Low-Rank Info] full: equ acc: {equ_acc * 100:.2f}, val acc: {val_acc * 100:.2f}, time: {full_time:.2f}s per pass, "
+                f"operator and stopper parameters: {num_full_params}")
+    logger.info(f"[Low-Rank Info] rank {conf.low_rank}: equ acc: {low_rank_equ_acc * 100:.2f}, val acc: {low_rank_val_acc * 100:.2f}, "
+                f"time: {low_rank_time:.2f}s per pass, operator and stopper parameters: {num_low_rank_params}")
+    logger.info(f"[Low-Rank Info] difference: equ acc: {(low_rank_equ_acc - equ_acc) * 100:+.2f}, val acc: {(low_rank_val_acc - val_acc) * 100:+.2f}, "
+                f"speed-up: {full_time / low_rank_time:.2f}x")
+
+
 def main():
     parser = argparse.ArgumentParser(description="classificaton")
     opt = parse_arguments(parser)
@@ -301,7 +762,8 @@ def main():
     os.makedirs("results", exist_ok=True)
     bert_model_name = conf.bert_model_name if conf.bert_folder == "" or conf.bert_folder=="none" else f"{conf.bert_folder}/{conf.bert_model_name}"
 
-    tokenizer = AutoTokenizer.from_pretrained(bert_model_name, use_fast=True)
+    ## the distillation only uses local files: the tokenizer saved with the teacher
+    tokenizer = AutoTokenizer.from_pretrained(f"model_files/{conf.teacher_folder}" if opt.mode == "distill" else bert_model_name, use_fast=True)
 
 
     uni_labels = [
@@ -343,7 +805,7 @@ def main():
 
 
     # Read dataset
-    if opt.mode == "train":
+    if opt.mode in ["train", "distill"]:
         logger.info("[Data Info] Reading training data")
         dataset = UniversalDataset(file=conf.train_file, tokenizer=tokenizer, uni_labels=conf.uni_labels, number=conf.train_num, filtered_steps=opt.train_filtered_steps,
                                    constant2id=constant2id, constant_values=constant_values,
@@ -374,32 +836,107 @@ def main():
 
         res_file = f"results/{conf.model_folder}.res.json"
         err_file = f"results/{conf.model_folder}.err.json"
-        # Train the model
-        model = train(conf, train_dataloader,
-                      num_epochs= conf.num_epochs,
-                      bert_model_name = bert_model_name,
-                      valid_dataloader = valid_dataloader, test_dataloader=test_loader,
-                      dev=conf.device, tokenizer=tokenizer, num_labels=num_labels,
-                      constant_values=constant_values, res_file=res_file, error_file=err_file)
-        evaluate(valid_dataloader, model, conf.device, fp16=bool(conf.fp16), constant_values=constant_values, uni_labels=conf.uni_labels)
+        if opt.mode == "distill":
+            model = distill(conf, train_dataloader, num_epochs=conf.num_epochs, bert_model_name=bert_model_name,
+                            valid_dataloader=valid_dataloader, dev=conf.device, tokenizer=tokenizer, num_labels=num_labels,
+                            constant_values=constant_values)
+        else:
+            # Train the model
+            model = train(conf, train_dataloader,
+                          num_epochs= conf.num_epochs,
+                          bert_model_name = bert_model_name,
+                          valid_dataloader = valid_dataloader, test_dataloader=test_loader,
+                          dev=conf.device, tokenizer=tokenizer, num_labels=num_labels,
+                          constant_values=constant_values, res_file=res_file, error_file=err_file)
+        evaluate(valid_dataloader, model, conf.device, precision=conf.precision, constant_values=constant_values, uni_labels=conf.uni_labels,
+                 beam_size=conf.beam_size)
     else:
         logger.info(f"Testing the model now.")
         MODEL_CLASS = class_name_2_model[bert_model_name]
-        model = MODEL_CLASS.from_pretrained(f"model_files/{conf.model_folder}",
+        ## a LoRA checkpoint only has the adapters and the deductive head, it is loaded into the base pretrained model
+        lora_checkpoint = has_lora_model(f"model_files/{conf.model_folder}")
+        model = MODEL_CLASS.from_pretrained(bert_model_name if lora_checkpoint else f"model_files/{conf.model_folder}",
                                                num_labels=num_labels,
                                                height = conf.height,
                                                constant_num = constant_number,
-                                            var_update_mode=conf.var_update_mode).to(conf.device)
+                                            var_update_mode=conf.var_update_mode,
+                                            factorized_projection=conf.factorized_projection,
+                                            fused_operators=conf.fused_operators,
+                                            constant_pair_cache=conf.constant_pair_cache,
+                                            eval_early_exit=conf.eval_early_exit,
+                                            train_compaction=conf.train_compaction,
+                                            height_parallel=conf.height_parallel,
+                                            incremental_scoring=conf.incremental_scoring,
+                                            star_attention=conf.star_attention,
+                                            pair_chunk_size=conf.pair_chunk_size,
+                                            activation_checkpointing=conf.activation_checkpointing,
+                                            pair_top_k=conf.pair_top_k,
+                                            sampled_negatives=conf.sampled_negatives,
+                                            negative_source=conf.negative_source,
+                                            exit_layers=conf.exit_layers).to(conf.device)
+        if lora_checkpoint:
+            load_lora_model(model, f"model_files/{conf.model_folder}")
         logger.info("[Data Info] Reading test data")
         eval_dataset = UniversalDataset(file=conf.test_file, tokenizer=tokenizer, uni_labels=conf.uni_labels, number=conf.dev_num, filtered_steps=opt.test_filtered_steps,
                                         constant2id=constant2id, constant_values=constant_values, data_max_height=conf.height, pretrained_model_name=bert_model_name)
         valid_dataloader = DataLoader(eval_dataset, batch_size=conf.batch_size, shuffle=False, num_workers=0,
                                       collate_fn=eval_dataset.collate_function)
+        if opt.mode == "export_onnx":
+            onnx_folder = f"model_files/{conf.model_folder}/onnx"
+            logger.info(f"[Model Info] Exporting the model to {onnx_folder}")
+            export_onnx(model, onnx_folder)
+            runner = OnnxDeductiveRunner(onnx_folder, max_height=conf.height)
+            check_onnx_parity(valid_dataloader, model, runner, conf.device)
+            return
+        if opt.mode == "pair_recall":
+            report_pair_recall(valid_dataloader, model, conf.device, ks=sorted(set(conf.pair_recall_ks + ([conf.pair_top_k] if conf.pair_top_k > 0 else []))))
+            return
         os.makedirs("results", exist_ok=True)
         res_file= f"results/{conf.model_folder}.res.json"
         err_file = f"results/{conf.model_folder}.err.json"
-        evaluate(valid_dataloader, model, conf.device, uni_labels=conf.uni_labels, fp16=bool(conf.fp16), constant_values=constant_values,
-                 res_file=res_file, err_file=err_file)
+        if conf.adaptive_exit:
+            if len(conf.exit_thresholds) > 0:
+                assert len(conf.exit_thresholds) == len(conf.exit_layers), "one threshold per exit layer"
+                model.exit_thresholds = conf.exit_thresholds
+            else:
+                logger.info("[Data Info] Reading the dev data for the exit calibration")
+                calibration_dataset = UniversalDataset(file=conf.dev_file, tokenizer=tokenizer, uni_labels=conf.uni_labels, number=conf.dev_num,
+                                                       filtered_steps=opt.test_filtered_steps, constant2id=constant2id, constant_values=constant_values,
+                                                       data_max_height=conf.height, pretrained_model_name=bert_model_name)
+                calibration_dataloader = DataLoader(calibration_dataset, batch_size=conf.batch_size, shuffle=False, num_workers=0,
+                                                    collate_fn=calibration_dataset.collate_function)
+                model.exit_thresholds = calibrate_exit_thresholds(model, calibration_dataloader, conf.device, precision=conf.precision,
+                                                                  target_agreement=conf.exit_agreement)
+            logger.info(f"[Model Info] exit layers: {conf.exit_layers}, thresholds: {model.exit_thresholds}")
+        static_runner = None
+        if conf.static_inference:
+            model.eval()
+            static_runner = StaticShapeInference(model, batch_size=conf.batch_size, seq_len_buckets=conf.static_seq_len_buckets,
+                                                 num_variable_buckets=conf.static_num_variable_buckets, height_buckets=conf.static_height_buckets,
+                                                 compile=conf.static_compile)
+            if conf.static_compile:
+                logger.info("[Model Info] Compiling the static-shape inference buckets")
+                warmup_start_time = time.time()
+                static_runner.warmup()
+                logger.info(f"[Model Info] Warm-up done in {time.time() - warmup_start_time:.1f}s")
+        if conf.quantize:
+            evaluate_quantization(valid_dataloader, model, conf, constant_values=constant_values, res_file=res_file, err_file=err_file)
+            return
+        if conf.low_rank > 0:
+            train_dataloader = None
+            low_rank_settings = get_low_rank_settings(model, conf)
+            if conf.low_rank_finetune_epochs > 0 and not has_low_rank_model(f"model_files/{conf.model_folder}", conf.low_rank, low_rank_settings):
+                logger.info("[Data Info] Reading the training data for the low-rank fine-tuning")
+                dataset = UniversalDataset(file=conf.train_file, tokenizer=tokenizer, uni_labels=conf.uni_labels, number=conf.train_num,
+                                           filtered_steps=opt.train_filtered_steps, constant2id=constant2id, constant_values=constant_values,
+                                           data_max_height=opt.train_max_height, pretrained_model_name=bert_model_name)
+                train_dataloader = DataLoader(dataset, batch_size=conf.batch_size, shuffle=True, num_workers=conf.num_workers,
+                                              collate_fn=dataset.collate_function)
+            evaluate_low_rank(valid_dataloader, model, conf, constant_values=constant_values, low_rank_settings=low_rank_settings,
+                              train_dataloader=train_dataloader, res_file=res_file, err_file=err_file)
+            return
+        evaluate(valid_dataloader, model, conf.device, uni_labels=conf.uni_labels, precision=conf.precision, constant_values=constant_values,
+                 res_file=res_file, err_file=err_file, static_runner=static_runner, beam_size=conf.beam_size)
 
 if __name__ == "__main__":
     # logger.addHandler(logging.StreamHandler())
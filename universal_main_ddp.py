@@ -11,6 +11,7 @@ import numpy as np
 import os
 import random
 from src.model.universal_model import UniversalModel, UniversalModel_Roberta
+from src.model.pair_index import index_to_pair
 from collections import Counter
 from src.eval.utils import is_value_correct
 from typing import List, Tuple
@@ -165,13 +166,9 @@ def train(config: Config, train_dataloader: DataLoader, num_epochs: int,
 
 def get_batched_prediction_consider_multiple_m0(feature, all_logits: torch.FloatTensor, constant_num: int, add_replacement: bool = False):
     batch_size, max_num_variable = feature.variable_indexs_start.size()
-    device = feature.variable_indexs_start.device
     batched_predictions = []
     for k, logits in enumerate(all_logits):
         current_max_num_variable = max_num_variable + constant_num + k
-        num_var_range = torch.arange(0, current_max_num_variable, device=feature.variable_indexs_start.device)
-        combination = torch.combinations(num_var_range, r=2, with_replacement=True)  ##number_of_combinations x 2
-        num_combinations, _ = combination.size()
 
         best_temp_logits, best_temp_stop_label = logits.max(dim=-1)  ## batch_size, num_combinations/num_m0, num_labels
         best_temp_score, best_temp_label = best_temp_logits.max(dim=-1)  ## batch_size, num_combinations
@@ -181,8 +178,7 @@ def get_batched_prediction_consider_multiple_m0(feature, all_logits: torch.Float
         best_stop_label = best_temp_stop_label[b_idxs, best_comb, best_label] ## batch size
 
         # batch_size x 2
-        best_comb_var_idxs = torch.gather(combination.unsqueeze(0).expand(batch_size, num_combinations, 2), 1,
-                                          best_comb.unsqueeze(1).unsqueeze(2).expand(batch_size, 1, 2).to(device)).squeeze(1)
+        best_comb_var_idxs = index_to_pair(best_comb, current_max_num_variable)
         batched_predictions.append(torch.cat([best_comb_var_idxs, best_label.unsqueeze(-1), best_stop_label.unsqueeze(-1)], dim=-1))
     return torch.stack(batched_predictions, dim=1)
 